@@ -0,0 +1,104 @@
+"""Time and peak memory of the background jobs and the preview route
+
+Usage (in the CKAN test environment with S3 object storage, e.g. the
+MinIO instance of the GitHub Actions workflow)::
+
+    pytest -s --ckan-ini=/srv/app/ckan.ini benchmarks/bench_ckan.py
+
+This benchmark complements `bench_stages.py` with the stages that
+involve the CKAN database and S3: `job_create_preview` (with and
+without the preview cache), `job_create_metadata_html`,
+`meta.render_metadata_html` (artifact on S3 and in-memory cache),
+and the `dcpreview` route (S3 existence check and cached URL).
+"""
+from unittest import mock
+import pathlib
+import tempfile
+
+import pytest
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+from ckanext.dc_view import jobs, meta, preview_cache, route_funcs
+
+from bench_util import (
+    data_path, make_synthetic_dataset, measure, print_results
+)
+
+
+DATASETS = [("calibration_beads_47", None, None),
+            ("trace-10000", "trace", 10000),
+            ("trace-100000", "trace", 100000),
+            ]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+@pytest.mark.parametrize("name,features,size", DATASETS)
+def test_bench_ckan(enqueue_job_mock, app, name, features, size):
+    with tempfile.TemporaryDirectory(prefix="bench_dc_view_") as td:
+        if features is None:
+            path = data_path / f"{name}.rtdc"
+        else:
+            path = make_synthetic_dataset(pathlib.Path(td) / f"{name}.rtdc",
+                                          size=size,
+                                          features=features)
+        user = factories.User()
+        owner_org = factories.Organization(users=[{
+            'name': user['id'],
+            'capacity': 'admin'
+        }])
+        create_context = {'ignore_auth': False,
+                          'user': user['name'],
+                          'api_version': 3}
+        ds_dict, res_dict = make_dataset_via_s3(create_context,
+                                                owner_org,
+                                                resource_path=path,
+                                                activate=True)
+    rid = res_dict["id"]
+    did = ds_dict["id"]
+    res_dict = helpers.call_action("resource_show", id=rid)
+    results = []
+
+    def add(stage, func, *args, **kwargs):
+        result, duration, peak = measure(func, *args, **kwargs)
+        results.append({"dataset": name, "stage": stage,
+                        "time": duration, "peak": peak})
+        return result
+
+    with mock.patch.object(preview_cache, "copy_preview_from_cache",
+                           return_value=False):
+        add("job preview (render)",
+            jobs.job_create_preview, res_dict, override=True)
+    add("job preview (cache)",
+        jobs.job_create_preview, res_dict, override=True)
+    add("job metadata html",
+        jobs.job_create_metadata_html, res_dict, override=True)
+
+    def render_metadata_uncached():
+        meta.metadata_html_cache.clear()
+        return meta.render_metadata_html(res_dict)
+
+    add("metadata html (render)", render_metadata_uncached)
+    add("metadata html (S3)", meta.get_stored_metadata_html,
+        resource_id=rid, organization_id=owner_org["id"],
+        metadata_hash=meta.get_metadata_hash(res_dict))
+    add("metadata html (cached)", meta.render_metadata_html, res_dict)
+
+    url = f"/dataset/{did}/resource/{rid}/preview.jpg"
+
+    def get_preview_uncached():
+        route_funcs.preview_url_cache.clear()
+        return app.get(url, follow_redirects=False)
+
+    assert add("dcpreview (S3)", get_preview_uncached).status_code == 302
+    assert add("dcpreview (cached)", app.get, url,
+               follow_redirects=False).status_code == 302
+
+    print()
+    print_results(results)
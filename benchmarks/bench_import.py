@@ -0,0 +1,103 @@
+"""Import time and memory of the modules loaded by CKAN web processes
+
+Usage::
+
+    python benchmarks/bench_import.py
+
+Each module is imported in a fresh Python process. The time and the
+increase in resident memory are measured relative to a process that
+already imported `dcor_shared` (which is loaded by all DCOR extensions
+anyway). The modules imported by the CKAN web server must not load
+the modules in :const:`HEAVY_MODULES`, which are only needed by the
+background job workers, and the request handlers (`plugin` and its
+imports) must not load the data reading code in :const:`DATA_MODULES`
+either. Since `dcor_shared` already loads dclab and h5py, only the
+modules newly loaded by the import are checked. If a module loads
+forbidden modules, the benchmark exits with an error
+(`ckanext/dc_view/tests/test_imports.py` guards against this as well).
+"""
+import json
+import subprocess
+import sys
+
+
+#: Modules that must not be imported by the CKAN web processes
+HEAVY_MODULES = ["matplotlib"]
+
+#: Modules that must not be imported by the request handlers
+DATA_MODULES = HEAVY_MODULES + ["dclab",
+                                "h5py",
+                                "ckanext.dc_view.preview_data",
+                                "ckanext.dc_view.raster",
+                                "ckanext.dc_view.scatter_histogram",
+                                ]
+
+#: Modules to benchmark and the modules they must not load
+MODULES = [("ckanext.dc_view.plugin", DATA_MODULES),
+           ("ckanext.dc_view.route_funcs", DATA_MODULES),
+           ("ckanext.dc_view.preview_variants", DATA_MODULES),
+           ("ckanext.dc_view.meta", HEAVY_MODULES),
+           ("ckanext.dc_view.jobs", HEAVY_MODULES),
+           ("ckanext.dc_view.cli", []),
+           ]
+
+CODE = """
+import importlib, json, sys, time
+import dcor_shared
+
+def rss():
+    with open("/proc/self/statm") as fd:
+        return int(fd.read().split()[1]) * 4096
+
+rss0 = rss()
+before = set(sys.modules)
+t0 = time.perf_counter()
+importlib.import_module({module!r})
+print(json.dumps({{
+    "time": time.perf_counter() - t0,
+    "rss": rss() - rss0,
+    "heavy": sorted({{p for m in set(sys.modules) - before
+                     for p in {forbidden!r}
+                     if m == p or m.startswith(p + ".")}}),
+}}))
+"""
+
+
+def measure_import(module, forbidden):
+    """Import `module` in a new process and return the measurements
+
+    The list "heavy" of the measurements contains the entries of
+    `forbidden` that were loaded by the import.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-c", CODE.format(module=module,
+                                           forbidden=forbidden)],
+        capture_output=True, text=True)
+    if proc.returncode:
+        # e.g. CKAN not installed
+        return None
+    return json.loads(proc.stdout.strip().split("\n")[-1])
+
+
+def main():
+    header = (f"{'module':<30s} {'time [ms]':>10s} {'RSS [MiB]':>10s} "
+              f"heavy modules")
+    print(header)
+    print("-" * len(header))
+    failed = []
+    for module, forbidden in MODULES:
+        res = measure_import(module, forbidden)
+        if res is None:
+            print(f"{module:<30s} {'(import failed)':>21s}")
+            continue
+        print(f"{module:<30s} {res['time'] * 1000:10.1f} "
+              f"{res['rss'] / 2**20:10.2f} {', '.join(res['heavy'])}")
+        if res["heavy"]:
+            failed.append(module)
+    if failed:
+        sys.exit(f"Modules imported by the web server load modules "
+                 f"they must not load: {failed}")
+
+
+if __name__ == "__main__":
+    main()
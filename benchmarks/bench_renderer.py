@@ -0,0 +1,54 @@
+"""Compare the throughput of the preview rendering engines
+
+Usage::
+
+    python benchmarks/bench_renderer.py [NUMBER_OF_REPETITIONS]
+
+This benchmark does not require a running CKAN instance. It renders
+the preview image of the test dataset and of a synthetic dataset with
+5000 events using the "matplotlib" and the "raster" engine and prints
+the mean time per preview for each engine.
+"""
+import pathlib
+import sys
+import tempfile
+import time
+import warnings
+
+import dclab
+import numpy as np
+
+from ckanext.dc_view import jobs
+
+from bench_util import data_path, make_synthetic_dataset
+
+
+def benchmark(path, renderer, repetitions):
+    times = []
+    with tempfile.TemporaryDirectory(prefix="bench_dc_view_") as td:
+        path_out = pathlib.Path(td) / "preview.jpg"
+        for _ in range(repetitions):
+            with dclab.new_dataset(path) as ds:
+                t0 = time.perf_counter()
+                jobs.render_preview(ds, path_out, renderer=renderer)
+                times.append(time.perf_counter() - t0)
+    return np.mean(times)
+
+
+def main(repetitions=5):
+    warnings.simplefilter("ignore")
+    with tempfile.TemporaryDirectory(prefix="bench_dc_view_") as td:
+        paths = [data_path / "calibration_beads_47.rtdc",
+                 make_synthetic_dataset(pathlib.Path(td) / "synth.rtdc")]
+        for path in paths:
+            print(f"{path.name}:")
+            results = {}
+            for renderer in jobs.PREVIEW_RENDERERS:
+                results[renderer] = benchmark(path, renderer, repetitions)
+                print(f"  {renderer:>10s}: {results[renderer]*1000:8.1f} ms")
+            speedup = results["matplotlib"] / results["raster"]
+            print(f"  {'speedup':>10s}: {speedup:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
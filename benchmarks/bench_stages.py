@@ -0,0 +1,116 @@
+"""Time and peak memory of the individual stages of preview generation
+
+Usage::
+
+    python benchmarks/bench_stages.py [--sizes 1000,10000,100000]
+                                      [--threads 4] [--json results.json]
+
+This benchmark does not require a running CKAN instance. For the test
+dataset and for synthetic datasets of growing size and with growing
+feature sets (see :const:`bench_util.FEATURE_SETS`), it measures the
+stages of `job_create_preview` and `job_create_metadata_html` that do
+not involve the database or S3 (see `bench_ckan.py` for those).
+Reading and rendering are also measured with a thread pool of
+``--threads`` threads, which shows whether setting
+"ckanext.dc_view.preview_threads" (default 1) speeds up the preview
+jobs on a machine.
+Use the ``--json`` option to store the results for comparison with
+later runs.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import pathlib
+import tempfile
+import warnings
+
+import dclab
+
+from ckanext.dc_view import jobs, meta, raster, scatter_histogram
+from ckanext.dc_view.preview_data import get_preview_data
+from ckanext.dc_view.preview_variants import encode_preview_variants
+
+from bench_util import (
+    FEATURE_SETS, data_path, make_synthetic_dataset, measure, print_results
+)
+
+
+def stage_plot_matplotlib(ds, data):
+    fig = jobs.overview_plot(rtdc_ds=ds, data=data)
+    fig.savefig(io.BytesIO(), format="jpg", dpi=raster.DPI)
+    jobs.get_pyplot().close(fig)
+
+
+def stage_metadata(ds):
+    res_dict = meta.get_metadata_from_config(ds.config)
+    return meta.render_metadata_html_uncached(res_dict)
+
+
+def benchmark_dataset(path, name, threads=4):
+    """Return the results for all stages for one dataset"""
+    results = []
+
+    def add(stage, func, *args, **kwargs):
+        result, duration, peak = measure(func, *args, **kwargs)
+        results.append({"dataset": name, "stage": stage,
+                        "time": duration, "peak": peak})
+        return result
+
+    add("open dataset", lambda: dclab.new_dataset(path).close())
+    with dclab.new_dataset(path) as ds:
+        data = add("read data", get_preview_data, ds)
+        add("render matplotlib", stage_plot_matplotlib, ds, data)
+        img = add("render raster", raster.overview_raster, ds, data)
+        with ThreadPoolExecutor(threads) as executor:
+            add("read data (threads)", get_preview_data, ds,
+                executor=executor)
+            add("render raster (threads)", raster.overview_raster, ds,
+                data, executor=executor)
+        add("encode variants", encode_preview_variants, img)
+        add("scatter histogram",
+            lambda: scatter_histogram.encode_scatter_histogram(
+                scatter_histogram.compute_scatter_histogram(
+                    ds, lims=data["scatter"]["lims"])))
+        add("metadata html", stage_metadata, ds)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma-separated numbers of events of the "
+                             "synthetic datasets")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="number of threads for the threaded stages")
+    parser.add_argument("--json", type=pathlib.Path,
+                        help="path to a JSON file for storing the results")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    warnings.simplefilter("ignore")
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_dc_view_") as td:
+        td = pathlib.Path(td)
+        datasets = [(data_path / "calibration_beads_47.rtdc",
+                     "calibration_beads_47")]
+        for features in FEATURE_SETS:
+            for size in sizes:
+                name = f"{features}-{size}"
+                datasets.append(
+                    (make_synthetic_dataset(td / f"{name}.rtdc",
+                                            size=size,
+                                            features=features),
+                     name))
+        for path, name in datasets:
+            results += benchmark_dataset(path, name, threads=args.threads)
+            if path.parent == td:
+                path.unlink()
+
+    print_results(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
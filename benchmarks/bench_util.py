@@ -0,0 +1,104 @@
+"""Shared helpers for the benchmarks in this directory"""
+import gc
+import pathlib
+import time
+import tracemalloc
+
+import dclab
+import numpy as np
+
+
+data_path = (pathlib.Path(__file__).parent.parent
+             / "ckanext" / "dc_view" / "tests" / "data")
+
+#: Feature sets of the synthetic datasets (each set includes the
+#: features of the previous sets)
+FEATURE_SETS = ["scalar", "image", "trace"]
+
+
+def make_synthetic_dataset(path, size=5000, features="trace"):
+    """Write a synthetic .rtdc file
+
+    Parameters
+    ----------
+    path: pathlib.Path
+        Output path
+    size: int
+        Number of events
+    features: str
+        One of :const:`FEATURE_SETS`; "scalar" only writes scalar
+        features, "image" adds image and mask, and "trace"
+        additionally adds fluorescence traces
+    """
+    level = FEATURE_SETS.index(features)
+    rng = np.random.default_rng(42)
+    with dclab.RTDCWriter(path, mode="reset") as hw:
+        hw.store_metadata({"experiment": {"sample": "synthetic",
+                                          "run index": 1},
+                           "imaging": {"pixel size": 0.34},
+                           "fluorescence": {"samples per event": 200,
+                                            "sample rate": 312500},
+                           "setup": {"channel width": 20,
+                                     "chip region": "channel",
+                                     "flow rate": 0.04},
+                           })
+        hw.store_feature("area_um", rng.normal(50, 10, size))
+        hw.store_feature("deform", rng.lognormal(-4, .5, size))
+        if level >= 1:
+            image = rng.integers(90, 110, size=(80, 250), dtype=np.uint8)
+            mask = np.zeros((80, 250), dtype=bool)
+            mask[30:50, 100:125] = True
+            # write in blocks to keep memory usage low for large sizes
+            for start in range(0, size, 1000):
+                num = min(1000, size - start)
+                hw.store_feature("image",
+                                 np.repeat(image[np.newaxis], num, axis=0))
+                hw.store_feature("mask",
+                                 np.repeat(mask[np.newaxis], num, axis=0))
+        if level >= 2:
+            hw.store_feature("trace", {
+                "fl1_raw": rng.integers(0, 100, (size, 200), dtype=np.int16),
+                "fl2_raw": rng.integers(0, 100, (size, 200), dtype=np.int16),
+            })
+    return path
+
+
+def measure(func, *args, **kwargs):
+    """Run `func` and return its result, duration [s] and peak memory [B]
+
+    `func` is called twice: First with :mod:`tracemalloc` enabled to
+    determine the peak memory allocated by Python (including numpy
+    arrays, but not HDF5 internals) and then without tracing to measure
+    the duration (tracing slows down the execution considerably).
+    The first call also warms up caches (e.g. fonts or imports).
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    gc.collect()
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    duration = time.perf_counter() - t0
+    return result, duration, peak
+
+
+def print_results(results):
+    """Print a table of stage results
+
+    Parameters
+    ----------
+    results: list of dict
+        Each dictionary has the keys "dataset", "stage", "time"
+        (in seconds), and "peak" (in bytes)
+    """
+    header = (f"{'dataset':<28s} {'stage':<22s} "
+              f"{'time [ms]':>10s} {'peak [MiB]':>11s}")
+    print(header)
+    print("-" * len(header))
+    for res in results:
+        print(f"{res['dataset']:<28s} {res['stage']:<22s} "
+              f"{res['time'] * 1000:10.1f} {res['peak'] / 2**20:11.2f}")
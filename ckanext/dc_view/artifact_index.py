@@ -0,0 +1,122 @@
+"""In-memory index of existing S3 artifacts for bulk operations
+
+Checking the existence of an artifact with
+:func:`dcor_shared.s3cc.artifact_exists` requires one HEAD request
+per resource. For sweeps over all resources of a DCOR instance, it
+is much cheaper to list all artifacts of a bucket once.
+"""
+from dcor_shared import get_ckan_config_option, s3
+
+
+#: Key of the S3 object metadata that stores the version of an artifact
+VERSION_METADATA_KEY = "dc-view-version"
+
+
+def get_artifact_object_name(resource_id, artifact):
+    """Return the S3 object name of an artifact of a resource"""
+    rid = resource_id
+    return f"{artifact}/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
+
+
+def get_artifact_version(bucket_name, object_name):
+    """Return the version stored in the metadata of an S3 object
+
+    Returns None if the object does not exist or if no version is
+    stored (e.g. for artifacts created by older versions).
+    """
+    s3_client, _, _ = s3.get_s3()
+    try:
+        resp = s3_client.head_object(Bucket=bucket_name, Key=object_name)
+    except (s3_client.exceptions.NoSuchKey,
+            s3_client.exceptions.ClientError):
+        return None
+    return resp.get("Metadata", {}).get(VERSION_METADATA_KEY)
+
+
+def set_artifact_version(bucket_name, object_name, version):
+    """Store a version in the metadata of an existing S3 object
+
+    The object is copied onto itself with new metadata (server-side,
+    the tags of the object are kept).
+    """
+    s3_client, _, _ = s3.get_s3()
+    s3_client.copy_object(
+        Bucket=bucket_name,
+        Key=object_name,
+        CopySource={"Bucket": bucket_name, "Key": object_name},
+        Metadata={VERSION_METADATA_KEY: version},
+        MetadataDirective="REPLACE",
+    )
+
+
+def get_bucket_name_for_organization(organization_id):
+    """Return the name of the S3 bucket of an organization (circle)"""
+    return get_ckan_config_option(
+        "dcor_object_store.bucket_name").format(
+        organization_id=organization_id)
+
+
+class ArtifactIndex:
+    """Index of all artifacts of one type, populated lazily per bucket
+
+    Parameters
+    ----------
+    artifact: str
+        Artifact type (e.g. "preview"), which is also the prefix
+        of the object names in the S3 bucket
+    """
+    def __init__(self, artifact="preview"):
+        self.artifact = artifact
+        self._buckets = {}
+
+    def exists(self, resource_id, bucket_name):
+        """Check whether the artifact of a resource exists in a bucket
+
+        The first call for a bucket lists all artifacts in that bucket.
+        """
+        if bucket_name not in self._buckets:
+            self._buckets[bucket_name] = self.list_resource_ids(bucket_name)
+        return resource_id in self._buckets[bucket_name]
+
+    def list_resource_ids(self, bucket_name):
+        """Return the set of resource IDs that have the artifact on S3"""
+        s3_client, _, _ = s3.get_s3()
+        paginator = s3_client.get_paginator("list_objects_v2")
+        resource_ids = set()
+        try:
+            for page in paginator.paginate(Bucket=bucket_name,
+                                           Prefix=f"{self.artifact}/"):
+                for obj in page.get("Contents", []):
+                    # object names are "artifact/rid[:3]/rid[3:6]/rid[6:]"
+                    resource_ids.add("".join(obj["Key"].split("/")[1:]))
+        except s3_client.exceptions.NoSuchBucket:
+            # There are no artifacts for this organization yet.
+            pass
+        return resource_ids
+
+
+class ArtifactVersionIndex(ArtifactIndex):
+    """Index of artifacts that were created with a specific version
+
+    Parameters
+    ----------
+    artifact: str
+        Artifact type (e.g. "preview")
+    version: str
+        Version of the artifact (see :func:`get_artifact_version`)
+
+    Notes
+    -----
+    The version is not part of the listing of a bucket, so one
+    additional request is made for every existing artifact.
+    """
+    def __init__(self, artifact, version):
+        super().__init__(artifact=artifact)
+        self.version = version
+
+    def exists(self, resource_id, bucket_name):
+        """Check whether the artifact exists and has the correct version"""
+        if not super().exists(resource_id, bucket_name):
+            return False
+        object_name = get_artifact_object_name(resource_id, self.artifact)
+        return get_artifact_version(bucket_name, object_name) == self.version
@@ -0,0 +1,75 @@
+"""Upload of artifacts to S3 directly from memory
+
+:func:`dcor_shared.s3cc.upload_artifact` uploads artifacts from a file
+on disk and afterwards downloads the object again to verify its SHA256
+checksum, sets the "public" tag, and (for previews) the version is set
+by copying the object onto itself. The artifacts of this extension are
+small and rendered in memory, so :func:`upload_artifact_data` uploads
+them in a single request: the object is verified by S3 via the MD5
+checksum of the upload, and tags and metadata are set with the upload.
+"""
+import base64
+import hashlib
+
+from dcor_shared import get_ckan_config_option, is_resource_private, s3, s3cc
+
+from .artifact_index import VERSION_METADATA_KEY
+
+
+def upload_artifact_data(resource_id, data, artifact, private=None,
+                         version=None, content_type=None, cache_control=None):
+    """Upload an artifact from memory to S3
+
+    Existing objects are overridden.
+
+    Parameters
+    ----------
+    resource_id: str
+        The resource identifier for the artifact
+    data: bytes
+        Content of the artifact
+    artifact: str
+        The artifact type (e.g. "preview")
+    private: bool
+        Whether the dataset that the resource belongs to is private;
+        determined via a database look-up if not given
+    version: str
+        Version of the artifact, stored in the object metadata (see
+        :func:`.artifact_index.get_artifact_version`)
+    content_type: str
+        MIME type of the artifact (e.g. "image/webp")
+    cache_control: str
+        Value of the "Cache-Control" header sent by S3 for the object
+        (e.g. "max-age=86400")
+
+    Returns
+    -------
+    s3_url: str
+        URL to the S3 object
+    """
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact=artifact)
+    if private is None:
+        private = is_resource_private(resource_id)
+    s3_client, _, _ = s3.get_s3()
+    s3.require_bucket(bucket_name)
+    put_kwargs = {
+        # S3 rejects the upload if the data do not match the checksum
+        "ContentMD5": base64.b64encode(hashlib.md5(data).digest()).decode(),
+        "Metadata": {},
+    }
+    if version is not None:
+        put_kwargs["Metadata"][VERSION_METADATA_KEY] = version
+    if content_type is not None:
+        put_kwargs["ContentType"] = content_type
+    if cache_control is not None:
+        put_kwargs["CacheControl"] = cache_control
+    if not private:
+        # picked up by the bucket policy (see `s3.make_object_public`)
+        put_kwargs["Tagging"] = "public=true"
+    s3_client.put_object(Bucket=bucket_name,
+                         Key=object_name,
+                         Body=data,
+                         **put_kwargs)
+    endpoint_url = get_ckan_config_option("dcor_object_store.endpoint_url")
+    return f"{endpoint_url}/{bucket_name}/{object_name}"
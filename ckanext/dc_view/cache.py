@@ -0,0 +1,80 @@
+"""In-memory caches used in the web workers"""
+import collections
+import threading
+import time
+
+
+#: Sentinel returned by :func:`TTLCache.get` for missing entries if
+#: requested (allows storing None in the cache)
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded and thread-safe LRU cache with per-entry expiration time
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries; the least recently used entries
+        are removed when this number is exceeded.
+
+    Notes
+    -----
+    The cache lives in the memory of one process. With multiple
+    web workers, invalidating an entry only affects the worker in
+    which :func:`TTLCache.discard` was called.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        # key -> (expiration time, value)
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return self.get(key, default=MISSING) is not MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._data.clear()
+
+    def discard(self, key):
+        """Remove the entry `key` if it exists"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get(self, key, default=None):
+        """Return the value for `key` or `default` if missing or expired"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._data.pop(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`
+
+        Parameters
+        ----------
+        key: hashable
+            Key of the entry
+        value:
+            Value of the entry
+        ttl: float
+            Lifetime of the entry in seconds; set to None for entries
+            that only expire when they are removed by the LRU policy
+        """
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
@@ -1,4 +1,7 @@
 import datetime
+import functools
+import multiprocessing
+import signal
 import time
 import traceback
 
@@ -6,8 +9,12 @@ import ckan.model as model
 
 import click
 
+from dcor_shared import s3
 
-from . import jobs
+from . import failure_cache, jobs, profiling
+from .artifact_index import (
+    ArtifactIndex, ArtifactVersionIndex, get_bucket_name_for_organization
+)
 
 
 def click_echo(message, am_on_a_new_line):
@@ -16,16 +23,131 @@ def click_echo(message, am_on_a_new_line):
     click.echo(message)
 
 
+def init_worker_process():
+    """Initialize a worker process of the `run_jobs_dc_view` pool
+
+    Connections inherited from the parent process must not be shared
+    with the child, so we make sure new connections are established.
+    Keyboard interrupts are handled by the parent process.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    model.Session.remove()
+    model.meta.engine.dispose(close=False)
+    s3.get_s3.cache_clear()
+
+
+def iter_resource_tasks(datasets, indices=None, failed=None):
+    """Yield the resource dictionaries of all `datasets` and jobs to skip
+
+    Parameters
+    ----------
+    datasets: iterable of ckan.model.Package
+        Datasets to process
+    indices: dict
+        Maps job names to instances of :class:`.ArtifactIndex`. If
+        the artifact of a job already exists, that job is skipped.
+        Resources for which all jobs are skipped are not yielded.
+    failed: set of str
+        IDs of resources for which `job_create_preview` is skipped,
+        because previous attempts failed (see :mod:`.failure_cache`)
+
+    Yields
+    ------
+    res_dict: dict
+        Resource dictionary
+    skip_jobs: list of str
+        Names of the jobs that do not have to be run
+    """
+    indices = indices or {}
+    failed = failed or set()
+    num_jobs = len(jobs.RQJob.get_all_job_methods_in_order(ckanext="dc_view"))
+    for dataset in datasets:
+        bucket_name = None
+        if dataset.owner_org:
+            bucket_name = get_bucket_name_for_organization(dataset.owner_org)
+        for resource in dataset.resources:
+            skip_jobs = []
+            if bucket_name is not None:
+                skip_jobs = [name for name, index in indices.items()
+                             if index.exists(resource.id, bucket_name)]
+            if (resource.id in failed
+                    and "job_create_preview" not in skip_jobs):
+                skip_jobs.append("job_create_preview")
+            if len(skip_jobs) < num_jobs:
+                yield resource.as_dict(), skip_jobs
+
+
+def run_jobs_for_resource(task, force=False):
+    """Run all dc_view jobs for one resource
+
+    Parameters
+    ----------
+    task: tuple
+        Resource dictionary and list of names of the jobs to skip,
+        as yielded by :func:`iter_resource_tasks`
+    force: bool
+        Whether to regenerate existing artifacts
+
+    Returns
+    -------
+    info: dict
+        Dictionary with the keys "package_id", "name", "done" (list
+        of titles of the jobs that were run), and "error" (None or a
+        tuple of exception class name and traceback).
+    """
+    res_dict, skip_jobs = task
+    info = {"package_id": res_dict["package_id"],
+            "name": res_dict["name"],
+            "done": [],
+            "error": None,
+            }
+    try:
+        for job in jobs.RQJob.get_all_job_methods_in_order(ckanext="dc_view"):
+            if job.name in skip_jobs:
+                continue
+            if job.method(res_dict, override=force):
+                info["done"].append(job.title)
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        info["error"] = (e.__class__.__name__, traceback.format_exc())
+    return info
+
+
 @click.option('--modified-days', default=-1,
               help='Only run for datasets modified within this number of days '
                    + 'in the past. Set to -1 to apply to all datasets.')
-@click.option('--force', help="Regenerate preview for all resources",
-              is_flag=True)
+@click.option('--force', is_flag=True,
+              help='Regenerate preview for all resources (including '
+                   + 'resources for which previous attempts failed, see '
+                   + '`list-failed-previews-dc-view`)')
+@click.option('--outdated', is_flag=True,
+              help='Only regenerate previews that are missing or that were '
+                   + 'created with a different preview version (e.g. after '
+                   + 'an update of ckanext-dc_view). An interrupted run can '
+                   + 'be resumed without regenerating finished previews.')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of worker processes used for processing the '
+                   + 'resources in parallel. Set to 1 (default) to process '
+                   + 'all resources sequentially in the current process.')
+@click.option('--enqueue', is_flag=True,
+              help='Do not run the jobs in this process, but submit them '
+                   + 'to the background job queue in batches of '
+                   + '`--batch-size` resources (one batch job per batch).')
+@click.option('--batch-size', default=jobs.BATCH_SIZE,
+              type=click.IntRange(min=1),
+              help='Number of resources per batch job (see `--enqueue`).')
 @click.command()
-def run_jobs_dc_view(modified_days=-1, force=False):
+def run_jobs_dc_view(modified_days=-1, force=False, outdated=False,
+                     workers=1, enqueue=False, batch_size=jobs.BATCH_SIZE):
     """Generate preview image for all DC resources
 
-    This also happens for draft datasets.
+    This also happens for draft datasets. Unless `--force` is given,
+    resources for which previous attempts failed are skipped until
+    their retry time (see `list-failed-previews-dc-view`). The failed
+    previews are not retried automatically at their retry time; run
+    this command periodically (e.g. daily with `--outdated`) to retry
+    them.
     """
     # go through all datasets
     datasets = model.Session.query(model.Package)
@@ -36,35 +158,127 @@ def run_jobs_dc_view(modified_days=-1, force=False):
         past_str = time.strftime("%Y-%m-%d", past.timetuple())
         datasets = datasets.filter(model.Package.metadata_modified >= past_str)
 
-    job_list = jobs.RQJob.get_all_job_methods_in_order(
-        ckanext="dc_view")
+    if force:
+        indices = None
+        failed = None
+    else:
+        # Skip known-bad resources with a single scan of the failure
+        # records instead of one request per resource.
+        version = jobs.get_current_preview_version()
+        failed = {rid for rid, record
+                  in failure_cache.get_all_failures().items()
+                  if failure_cache.is_backing_off(record, version)}
+        if failed:
+            click.echo(f"Skipping previews of {len(failed)} resources "
+                       f"that failed recently")
+        # Check for existing artifacts with a few listing requests per
+        # bucket instead of one request per resource.
+        indices = {name: ArtifactIndex(artifact)
+                   for name, artifact in jobs.JOB_ARTIFACTS.items()}
+        if outdated:
+            # Existing previews are only skipped if they are up-to-date.
+            # Outdated previews are regenerated by `job_create_preview`
+            # even without `force`.
+            indices["job_create_preview"] = ArtifactVersionIndex(
+                artifact="preview",
+                version=jobs.get_current_preview_version())
 
-    nl = False  # new line character
-    for dataset in datasets:
-        nl = False
-        click.echo(f"Checking dataset {dataset.id}\r", nl=False)
+    tasks = iter_resource_tasks(datasets, indices, failed=failed)
 
-        for resource in dataset.resources:
-            res_dict = resource.as_dict()
-            try:
-                for job in job_list:
-                    if job.method(res_dict, override=force):
-                        if not nl:
-                            click.echo("")
-                            nl = True
-                        click.echo(f"OK: {job.title} for {resource.name}")
-            except KeyboardInterrupt:
-                raise
-            except BaseException as e:
-                click.echo(
-                    f"\n{e.__class__.__name__} for {res_dict['name']}!",
-                    err=True)
-                click.echo(traceback.format_exc(), err=True)
-                nl = True
+    if enqueue:
+        num_batches = jobs.enqueue_batch_jobs(tasks,
+                                              override=force,
+                                              batch_size=batch_size)
+        click.echo(f"Enqueued {num_batches} batch jobs")
+        return
+
+    run_jobs = functools.partial(run_jobs_for_resource, force=force)
+
+    pool = None
+    if workers > 1:
+        # Forking makes sure that the worker processes inherit the
+        # CKAN configuration and the registered jobs.
+        pool = multiprocessing.get_context("fork").Pool(
+            processes=workers,
+            initializer=init_worker_process)
+        # Results are returned in the order of the tasks.
+        results = pool.imap(run_jobs, tasks)
+    else:
+        results = map(run_jobs, tasks)
+
+    if workers == 1:
+        # Profile the entire sweep if profiling is enabled (with multiple
+        # workers, each job is profiled individually in the workers).
+        path_dir, trace_memory = profiling.get_profile_settings()
+    else:
+        path_dir, trace_memory = None, False
+
+    nl = False  # new line character
+    package_id = None
+    try:
+        with profiling.profile(name="run_jobs_dc_view",
+                               path_dir=path_dir,
+                               trace_memory=trace_memory):
+            for info in results:
+                if info["package_id"] != package_id:
+                    package_id = info["package_id"]
+                    nl = False
+                    click.echo(f"Checking dataset {package_id}\r", nl=False)
+                for title in info["done"]:
+                    click_echo(f"OK: {title} for {info['name']}", nl)
+                    nl = True
+                if info["error"] is not None:
+                    error_name, error_traceback = info["error"]
+                    click.echo(f"\n{error_name} for {info['name']}!", err=True)
+                    click.echo(error_traceback, err=True)
+                    nl = True
+    except KeyboardInterrupt:
+        click.echo("\nAborting...", err=True)
+        raise click.Abort()
+    finally:
+        if pool is not None:
+            # Either all results have been consumed or the user aborted.
+            pool.terminate()
+            pool.join()
     if not nl:
         click.echo("")
     click.echo("Done!")
 
 
+@click.option('--clear', is_flag=True,
+              help='Remove all failure records, so that the previews '
+                   + 'of the listed resources are created again by the '
+                   + 'next run of `run-jobs-dc-view` or background job.')
+@click.command()
+def list_failed_previews_dc_view(clear=False):
+    """List resources for which the preview could not be created
+
+    For each resource, the error of the last attempt, the number of
+    failed attempts, the preview version, and the time after which
+    the preview job is run again by `run-jobs-dc-view` are shown
+    (nothing retries them automatically). Transient errors (e.g. S3
+    not reachable) are not recorded.
+    """
+    records = failure_cache.get_all_failures()
+    version = jobs.get_current_preview_version()
+    for rid, record in sorted(records.items(),
+                              key=lambda item: item[1]["failed_at"]):
+        failed_at = time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(record["failed_at"]))
+        if failure_cache.is_backing_off(record, version):
+            retry_at = time.strftime("%Y-%m-%d %H:%M:%S",
+                                     time.localtime(record["retry_at"]))
+        else:
+            retry_at = "now"
+        click.echo(f"{rid} {record['error']} (attempts: "
+                   f"{record['attempts']}, version: {record['version']}, "
+                   f"failed: {failed_at}, retry: {retry_at})")
+        click.echo(f"    {record['message']}")
+        if clear:
+            failure_cache.clear_failure(rid)
+    click.echo(f"{len(records)} resources with failed previews"
+               + (" (records removed)" if clear and records else ""))
+
+
 def get_commands():
-    return [run_jobs_dc_view]
+    return [run_jobs_dc_view, list_failed_previews_dc_view]
@@ -0,0 +1,174 @@
+"""Negative cache of failed preview jobs
+
+Corrupt or unsupported resources make `job_create_preview` fail every
+time it is run, and every run downloads (parts of) the resource again.
+When the preview of a resource cannot be created, the failure is
+recorded in the Redis instance of CKAN (error class, error message,
+preview version, and number of attempts). The preview job is not run
+again for that resource before the retry time, which grows
+exponentially with the number of failed attempts (see
+:func:`get_backoff_delay`). Records are removed when the preview is
+created successfully. A failure recorded for a different preview
+version (e.g. after an update of the renderer) does not prevent a
+retry.
+
+Only errors caused by the data of a resource are recorded (e.g. a
+file that dclab cannot read or that cannot be rendered). Transient
+errors (see :const:`TRANSIENT_ERRORS`) are raised, so the RQ job
+fails without putting the resource into backoff.
+
+Nothing schedules the retry at the retry time: Failed previews are
+only created again by the next `run-jobs-dc-view` sweep after the
+retry time (which should therefore be run periodically, e.g. by a
+cron job). Bulk sweeps of `run-jobs-dc-view` load all records at once
+(see :func:`get_all_failures`) and `list-failed-previews-dc-view`
+lists them.
+"""
+import json
+import time
+
+import botocore.exceptions
+
+
+#: Prefix of the Redis keys of the failure records (followed by the
+#: resource ID)
+FAILURE_KEY_PREFIX = "ckanext-dc_view:preview_failure:"
+
+#: Delay before the first retry in seconds (doubled for every further
+#: failed attempt)
+BACKOFF_BASE = 3600
+#: Maximum delay between two retries in seconds
+BACKOFF_MAX = 30 * 86400
+#: Failure records expire this many seconds after the last attempt
+#: (e.g. for deleted resources)
+RECORD_TTL = 90 * 86400
+
+#: Maximum length of the error message stored in a record
+MAX_MESSAGE_LENGTH = 500
+
+#: Errors that are caused by the environment (S3, network) rather than
+#: by the data of a resource; they are not recorded
+TRANSIENT_ERRORS = (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError,
+                    ConnectionError,
+                    TimeoutError,
+                    )
+
+
+def is_transient_error(error):
+    """Whether an error is transient and should not be recorded"""
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def get_redis():
+    """Return a connection to the Redis instance of CKAN"""
+    # Import here so the module can be loaded without ckan available
+    from ckan.lib.jobs import _connect as ckan_redis_connect
+    return ckan_redis_connect()
+
+
+def get_backoff_delay(attempts):
+    """Return the delay before the next retry after `attempts` failures"""
+    return min(BACKOFF_BASE * 2 ** (max(attempts, 1) - 1), BACKOFF_MAX)
+
+
+def is_backing_off(record, version, now=None):
+    """Whether a preview job should not be retried yet
+
+    Parameters
+    ----------
+    record: dict or None
+        Failure record of the resource (see :func:`get_failure`)
+    version: str
+        Current preview version (see :func:`.jobs.get_preview_version`)
+    now: float
+        Current time (seconds since epoch), defaults to `time.time()`
+    """
+    if record is None or record["version"] != version:
+        return False
+    if now is None:
+        now = time.time()
+    return record["retry_at"] > now
+
+
+def record_failure(resource_id, error, version, redis_connect=None):
+    """Record a failed attempt to create the preview of a resource
+
+    Parameters
+    ----------
+    resource_id: str
+        Resource ID
+    error: BaseException
+        Exception that caused the failure
+    version: str
+        Preview version of the attempt; the number of attempts is
+        reset if the previous failure was recorded for a different
+        version
+
+    Returns
+    -------
+    record: dict
+        The failure record, with the keys "error" (exception class
+        name), "message", "version", "attempts", "failed_at", and
+        "retry_at" (both in seconds since epoch)
+    """
+    if redis_connect is None:
+        redis_connect = get_redis()
+    previous = get_failure(resource_id, redis_connect=redis_connect)
+    attempts = 1
+    if previous is not None and previous["version"] == version:
+        attempts = previous["attempts"] + 1
+    now = time.time()
+    record = {"error": error.__class__.__name__,
+              "message": str(error)[:MAX_MESSAGE_LENGTH],
+              "version": version,
+              "attempts": attempts,
+              "failed_at": now,
+              "retry_at": now + get_backoff_delay(attempts),
+              }
+    redis_connect.set(FAILURE_KEY_PREFIX + resource_id,
+                      json.dumps(record),
+                      ex=RECORD_TTL)
+    return record
+
+
+def clear_failure(resource_id, redis_connect=None):
+    """Remove the failure record of a resource (if any)"""
+    if redis_connect is None:
+        redis_connect = get_redis()
+    redis_connect.delete(FAILURE_KEY_PREFIX + resource_id)
+
+
+def get_failure(resource_id, redis_connect=None):
+    """Return the failure record of a resource or None"""
+    if redis_connect is None:
+        redis_connect = get_redis()
+    value = redis_connect.get(FAILURE_KEY_PREFIX + resource_id)
+    return None if value is None else json.loads(value)
+
+
+def get_all_failures(redis_connect=None):
+    """Return all failure records
+
+    Returns
+    -------
+    records: dict
+        Maps resource IDs to failure records (see
+        :func:`record_failure`)
+    """
+    if redis_connect is None:
+        redis_connect = get_redis()
+    keys = list(redis_connect.scan_iter(match=FAILURE_KEY_PREFIX + "*",
+                                        count=1000))
+    records = {}
+    # fetch the records in blocks instead of one request per key
+    for start in range(0, len(keys), 1000):
+        block = keys[start:start + 1000]
+        for key, value in zip(block, redis_connect.mget(block)):
+            if value is None:
+                # expired or cleared in the meantime
+                continue
+            if isinstance(key, bytes):
+                key = key.decode()
+            records[key[len(FAILURE_KEY_PREFIX):]] = json.loads(value)
+    return records
@@ -1,48 +1,761 @@
 from collections import OrderedDict
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import io
+import itertools
 import logging
 import os
 import pathlib
-import shutil
-import tempfile
+import time
 
-import dclab
 from dcor_shared import (
-    DC_MIME_TYPES, get_dc_instance, rqjob_register, s3, s3cc, wait_for_resource
+    DC_MIME_TYPES, get_ckan_config_option, get_dc_instance, get_resource_info,
+    is_resource_private, rqjob_register, s3, s3cc, wait_for_resource
 )
-from dcor_shared import RQJob  # noqa: F401
+from dcor_shared import RQJob
 
 import numpy as np
+from PIL import Image
 
+from . import (
+    failure_cache, meta, preview_cache, profiling, raster, scatter_histogram
+)
+from .artifact_index import (
+    get_artifact_object_name, get_artifact_version,
+    get_bucket_name_for_organization
+)
+from .artifact_upload import upload_artifact_data
+from .metrics import JobMetrics
+from .preview_data import (
+    SAMPLING_STRATEGIES, get_preview_data, get_preview_data_nbytes,
+    read_scatter_data
+)
+from .preview_variants import (
+    CACHE_CONTROL, CONTENT_TYPES, PREVIEW_VARIANTS, encode_preview_variants
+)
 
 log = logging.getLogger(__name__)
 
-# Create a matplotlib config directory, so we can import and use matplotlib
-mpldir = "/tmp/matplotlib"
-pathlib.Path(mpldir).mkdir(exist_ok=True)
-os.environ['MPLCONFIGDIR'] = mpldir
+#: Available engines for rendering the preview image
+PREVIEW_RENDERERS = ["matplotlib", "raster"]
+
+#: Version of the preview images; increment this number whenever the
+#: appearance of the preview images changes. Previews of other versions
+#: are regenerated by `run-jobs-dc-view --outdated` (see
+#: :func:`get_preview_version`).
+PREVIEW_VERSION = 3
+
+#: Default number of threads for reading data and rendering the preview
+#: image of one resource (see :func:`get_preview_executor`)
+PREVIEW_THREADS = 1
+
+#: S3 artifacts created by the jobs (allows skipping jobs in bulk sweeps)
+JOB_ARTIFACTS = {"job_create_preview": "preview",
+                 "job_create_metadata_html": "metadata_html",
+                 "job_create_scatter_histogram": "scatter_histogram",
+                 }
+
+#: All S3 artifacts of a resource created by this extension (see
+#: :func:`job_make_artifacts_public`)
+DC_VIEW_ARTIFACTS = list(dict.fromkeys(list(PREVIEW_VARIANTS)
+                                       + list(JOB_ARTIFACTS.values())))
+
+#: Jobs whose duration depends on the size of the resource; they are
+#: routed to queues according to the size class of the resource
+SIZE_ROUTED_JOBS = ["job_create_preview", "job_create_scatter_histogram"]
+
+#: Size classes of resources for routing preview jobs to queues
+#: (see :func:`get_preview_job_route`)
+PREVIEW_JOB_CLASSES = ["small", "normal", "large"]
+
+#: Default queues and timeouts [s] of the preview job per size class
+PREVIEW_JOB_QUEUES = {"small": "dcor-short",
+                      "normal": "dcor-normal",
+                      "large": "dcor-long",
+                      }
+PREVIEW_JOB_TIMEOUTS = {"small": 600,
+                        "normal": 3600,
+                        "large": 14400,
+                        }
 
-from matplotlib.gridspec import GridSpec  # noqa: E402
-import matplotlib  # noqa: E402
+#: Default size [bytes] and event count thresholds of the size classes
+PREVIEW_JOB_THRESHOLDS = {"small_max_size": 100 * 1024**2,
+                          "small_max_events": 100_000,
+                          "large_min_size": 5 * 1024**3,
+                          "large_min_events": 5_000_000,
+                          }
 
-matplotlib.use('agg')
-import matplotlib.pylab as plt  # noqa: E402
+#: Default number of resources per batch job (see :func:`job_run_batch`)
+BATCH_SIZE = 100
+#: Default maximum timeout [s] of a batch job (see
+#: :func:`enqueue_batch_jobs`)
+BATCH_MAX_TIMEOUT = 14400
 
 
 def admin_context():
     return {'ignore_auth': True, 'user': 'default'}
 
 
+def enqueue_all_jobs(resource):
+    """Enqueue all background jobs of this extension for a resource
+
+    This is equivalent to :func:`RQJob.enqueue_all_jobs`, except that
+    the jobs in :const:`SIZE_ROUTED_JOBS` are routed to the queue (and
+    with the timeout) matching the size of the resource (see
+    :func:`get_preview_job_route`) and that jobs are coalesced per
+    resource (see :func:`enqueue_job`).
+    """
+    # Import here so the module can be loaded without ckan available
+    from ckan.lib.jobs import _connect as ckan_redis_connect
+    redis_connect = ckan_redis_connect()
+
+    for job in RQJob.get_all_job_methods_in_order(ckanext="dc_view"):
+        if job.name in SIZE_ROUTED_JOBS:
+            # shallow copy, so the registered job is not modified
+            job = copy.copy(job)
+            job.queue, job.timeout = get_preview_job_route(resource)
+        enqueue_job(job, resource, redis_connect=redis_connect)
+
+
+def enqueue_job(job, resource, redis_connect):
+    """Enqueue a background job unless it is already pending or running
+
+    The ID of the RQ job is composed of the resource ID and the job
+    name (see :func:`get_job_id`), so there is at most one pending or
+    running job of each type per resource. A request to enqueue a job
+    for which a job with the same ID is queued, deferred, scheduled,
+    or running is absorbed by that job. Finished and failed jobs
+    are replaced.
+
+    Parameters
+    ----------
+    job: dcor_shared.RQJob
+        Registered job
+    resource: dict
+        CKAN resource dictionary
+    redis_connect: redis.Redis
+        Connection to the Redis instance of CKAN
+
+    Returns
+    -------
+    enqueued: bool
+        False if the request was absorbed by an existing job
+    """
+    # Import here so the module can be loaded without ckan available
+    import ckan.plugins.toolkit as toolkit
+
+    rid = resource["id"]
+    jid = get_job_id(job.name, rid)
+    # The lock prevents concurrent requests (e.g. from multiple web
+    # server processes) from enqueueing the same job twice.
+    with redis_connect.lock(f"ckanext-dc_view:enqueue:{jid}", timeout=60):
+        status = get_pending_job_status(jid, redis_connect)
+        if status is not None:
+            log.info(f"Not enqueueing {job.name} for {rid}, "
+                     f"because it is already {status}")
+            return False
+        rq_kwargs = {"timeout": job.timeout,
+                     "at_front": job.at_front,
+                     "job_id": jid,
+                     }
+        if job.depends_on:
+            rq_kwargs["depends_on"] = [get_job_id(dep, rid)
+                                       for dep in job.depends_on]
+        toolkit.enqueue_job(job.method,
+                            [resource],
+                            title=job.title,
+                            queue=job.queue,
+                            rq_kwargs=rq_kwargs)
+    return True
+
+
+def enqueue_batch_jobs(tasks, override=False, batch_size=BATCH_SIZE,
+                       redis_connect=None):
+    """Enqueue the background jobs for many resources in batches
+
+    Instead of one RQ job per resource and job type, one
+    :func:`job_run_batch` job is enqueued for every `batch_size`
+    resources. The batch jobs are enqueued on the queue of the
+    "normal" size class (see :func:`get_preview_job_route`) with
+    the sum of the preview job timeouts of the resources, limited
+    to "ckanext.dc_view.batch_job_max_timeout" (default
+    :const:`BATCH_MAX_TIMEOUT`).
+
+    Like :func:`enqueue_job`, batch jobs are coalesced: The RQ job ID
+    is derived from the resource IDs of the batch (see
+    :func:`get_batch_job_id`), so a batch that is already pending or
+    running is not enqueued again (e.g. when `run-jobs-dc-view
+    --enqueue` is run twice).
+
+    Parameters
+    ----------
+    tasks: iterable
+        Resource dictionaries and lists of names of the jobs to skip,
+        e.g. as yielded by :func:`.cli.iter_resource_tasks`
+    override: bool
+        Whether to regenerate existing artifacts
+    batch_size: int
+        Maximum number of resources per batch job
+    redis_connect: redis.Redis
+        Connection to the Redis instance of CKAN
+
+    Returns
+    -------
+    num_batches: int
+        Number of batch jobs enqueued
+    """
+    # Import here so the module can be loaded without ckan available
+    import ckan.plugins.toolkit as toolkit
+    from ckan.lib.jobs import _connect as ckan_redis_connect
+    if redis_connect is None:
+        redis_connect = ckan_redis_connect()
+
+    queue = (get_ckan_config_option("ckanext.dc_view.preview_job_normal_queue")
+             or PREVIEW_JOB_QUEUES["normal"])
+    max_timeout = int(
+        get_ckan_config_option("ckanext.dc_view.batch_job_max_timeout")
+        or BATCH_MAX_TIMEOUT)
+    tasks = iter(tasks)
+    num_batches = 0
+    while True:
+        batch = list(itertools.islice(tasks, batch_size))
+        if not batch:
+            break
+        resource_ids = [res_dict["id"] for res_dict, _ in batch]
+        skip_jobs = {res_dict["id"]: list(skip)
+                     for res_dict, skip in batch if skip}
+        timeout = min(max_timeout,
+                      sum(get_preview_job_route(res_dict)[1]
+                          for res_dict, _ in batch))
+        jid = get_batch_job_id(resource_ids)
+        with redis_connect.lock(f"ckanext-dc_view:enqueue:{jid}",
+                                timeout=60):
+            status = get_pending_job_status(jid, redis_connect)
+            if status is not None:
+                log.info(f"Not enqueueing batch job {jid}, because it is "
+                         f"already {status}")
+                continue
+            toolkit.enqueue_job(job_run_batch,
+                                [resource_ids],
+                                {"override": override,
+                                 "skip_jobs": skip_jobs},
+                                title=f"Run dc_view jobs for {len(batch)} "
+                                      f"resources",
+                                queue=queue,
+                                rq_kwargs={"timeout": timeout,
+                                           "job_id": jid})
+        num_batches += 1
+    return num_batches
+
+
+def enqueue_make_artifacts_public(dataset, redis_connect=None):
+    """Enqueue :func:`job_make_artifacts_public` for a public dataset
+
+    This is called when a private dataset is published (see
+    :func:`.plugin.package_update`). The job is coalesced per dataset
+    like the jobs in :func:`enqueue_job`. Nothing is enqueued for
+    private datasets.
+
+    Parameters
+    ----------
+    dataset: dict
+        CKAN dataset dictionary (including the resources)
+    redis_connect: redis.Redis
+        Connection to the Redis instance of CKAN
+
+    Returns
+    -------
+    enqueued: bool
+        False if the dataset is private, has no resources, or if
+        the request was absorbed by an existing job
+    """
+    # Import here so the module can be loaded without ckan available
+    import ckan.plugins.toolkit as toolkit
+    from ckan.lib.jobs import _connect as ckan_redis_connect
+
+    resource_ids = [res["id"] for res in dataset.get("resources", [])]
+    if dataset.get("private") or not resource_ids:
+        return False
+    if redis_connect is None:
+        redis_connect = ckan_redis_connect()
+    jid = get_job_id("job_make_artifacts_public", dataset["id"])
+    with redis_connect.lock(f"ckanext-dc_view:enqueue:{jid}", timeout=60):
+        status = get_pending_job_status(jid, redis_connect)
+        if status is not None:
+            log.info(f"Not enqueueing job_make_artifacts_public for "
+                     f"{dataset['id']}, because it is already {status}")
+            return False
+        toolkit.enqueue_job(job_make_artifacts_public,
+                            [resource_ids, dataset["owner_org"]],
+                            title=f"Make dc_view artifacts of "
+                                  f"{dataset['id']} public",
+                            queue="dcor-short",
+                            rq_kwargs={"timeout": 600,
+                                       "job_id": jid})
+    return True
+
+
+def get_batch_job_id(resource_ids):
+    """Return the RQ job ID of a batch job for a set of resources"""
+    digest = hashlib.sha256(
+        ",".join(sorted(resource_ids)).encode("utf-8")).hexdigest()
+    return f"dc_view_batch_{digest[:32]}"
+
+
+def get_job_id(job_name, resource_id):
+    """Return the RQ job ID of a background job for a resource"""
+    return f"dc_view_{resource_id}_{job_name}"
+
+
+def get_pending_job_status(job_id, redis_connect):
+    """Return the status of an RQ job if it is pending or running
+
+    Returns None if there is no such job or if it is finished, failed,
+    stopped, or canceled.
+    """
+    # Import here so the module can be loaded without rq available
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job, JobStatus
+
+    try:
+        status = Job.fetch(job_id, connection=redis_connect).get_status()
+    except NoSuchJobError:
+        return None
+    if status in [JobStatus.QUEUED, JobStatus.DEFERRED,
+                  JobStatus.SCHEDULED, JobStatus.STARTED]:
+        return status
+    return None
+
+
+def job_run_batch(resource_ids, override=False, skip_jobs=None):
+    """Run all background jobs of this extension for a batch of resources
+
+    Processing many resources in one job amortizes the setup cost of
+    a job (forking the RQ work horse, creating the S3 client, loading
+    the fonts of matplotlib, etc.) over the batch. A single matplotlib
+    figure is reused for rendering all previews. Jobs for which a
+    separate RQ job of the same resource is pending or running (see
+    :func:`enqueue_job`) are left to that job.
+
+    Parameters
+    ----------
+    resource_ids: list of str
+        Identifiers of the resources
+    override: bool
+        Whether to regenerate existing artifacts
+    skip_jobs: dict
+        Maps resource IDs to lists of names of jobs that are not run
+
+    Returns
+    -------
+    done: dict
+        Maps resource IDs to the names of the jobs that were run
+        successfully
+    """
+    # Import here so the module can be loaded without ckan available
+    from ckan.lib.jobs import _connect as ckan_redis_connect
+    redis_connect = ckan_redis_connect()
+
+    skip_jobs = skip_jobs or {}
+    done = {}
+    fig = None
+    if get_preview_renderer() == "matplotlib":
+        fig = get_pyplot().figure()
+    try:
+        for rid in resource_ids:
+            done[rid] = []
+            try:
+                _, res_dict = get_resource_info(rid)
+                for job in RQJob.get_all_job_methods_in_order(
+                        ckanext="dc_view"):
+                    if job.name in skip_jobs.get(rid, []):
+                        continue
+                    status = get_pending_job_status(
+                        get_job_id(job.name, rid), redis_connect)
+                    if status is not None:
+                        log.info(f"Not running {job.name} for {rid}, "
+                                 f"because its job is already {status}")
+                        continue
+                    kwargs = {"override": override}
+                    if job.name == "job_create_preview":
+                        kwargs["fig"] = fig
+                    if job.method(res_dict, **kwargs):
+                        done[rid].append(job.name)
+            except Exception:
+                # Do not let one broken resource fail the entire batch
+                log.exception(f"Could not run jobs for resource {rid}")
+    finally:
+        if fig is not None:
+            get_pyplot().close(fig)
+    return done
+
+
+def job_make_artifacts_public(resource_ids, organization_id):
+    """Set the "public" tag of all artifacts of resources on S3
+
+    Artifacts are tagged public when they are uploaded for a public
+    dataset (see :func:`.artifact_upload.upload_artifact_data`).
+    :func:`dcor_shared.s3cc.make_resource_public`, which is called
+    when a private dataset is published, only tags the "condensed",
+    "preview", and "resource" artifacts. This job tags the other
+    artifacts in :const:`DC_VIEW_ARTIFACTS`, so that they can be
+    linked directly (see :func:`.route_funcs.get_public_preview_urls`).
+    Missing artifacts are ignored.
+
+    Parameters
+    ----------
+    resource_ids: list of str
+        Identifiers of the resources
+    organization_id: str
+        Identifier of the organization (circle) of the dataset
+    """
+    bucket_name = get_bucket_name_for_organization(organization_id)
+    for rid in resource_ids:
+        for artifact in DC_VIEW_ARTIFACTS:
+            s3.make_object_public(
+                bucket_name=bucket_name,
+                object_name=get_artifact_object_name(rid, artifact),
+                missing_ok=True)
+    return True
+
+
+def get_preview_job_route(resource):
+    """Return the queue and timeout for the preview job of a resource
+
+    Resources are classified as "small", "normal", or "large" according
+    to their file size and event count. The thresholds are defined by
+    the CKAN configuration options
+    "ckanext.dc_view.preview_job_small_max_size" (in bytes),
+    "ckanext.dc_view.preview_job_small_max_events",
+    "ckanext.dc_view.preview_job_large_min_size" (in bytes), and
+    "ckanext.dc_view.preview_job_large_min_events" (see
+    :const:`PREVIEW_JOB_THRESHOLDS` for the defaults). A resource is
+    "large" if any of the known quantities exceeds the large threshold
+    and "small" if all known quantities are below the small thresholds.
+    If neither the size nor the event count is known, the resource
+    is "normal". This function is called in the web process when a
+    resource is created, so it only uses the resource dictionary and
+    does not look up the size of the resource on S3 (the "size" might
+    not yet have been set by ckanext-dcor_schemas).
+
+    The queues and timeouts of the classes are defined by the options
+    "ckanext.dc_view.preview_job_<class>_queue" and
+    "ckanext.dc_view.preview_job_<class>_timeout" (see
+    :const:`PREVIEW_JOB_QUEUES` and :const:`PREVIEW_JOB_TIMEOUTS`).
+
+    Returns
+    -------
+    queue: str
+        Name of the RQ queue
+    timeout: int
+        Job timeout in seconds
+    """
+    thresholds = {}
+    for key, default in PREVIEW_JOB_THRESHOLDS.items():
+        value = get_ckan_config_option(f"ckanext.dc_view.preview_job_{key}")
+        thresholds[key] = int(value or default)
+
+    size = resource.get("size")
+    size = None if size is None else int(size)
+    events = resource.get("dc:experiment:event count")
+    events = None if events is None else int(events)
+    known = [(val, thresholds[f"small_max_{kind}"],
+              thresholds[f"large_min_{kind}"])
+             for val, kind in [(size, "size"), (events, "events")]
+             if val is not None]
+    if not known:
+        job_class = "normal"
+    elif any(val >= large for val, _, large in known):
+        job_class = "large"
+    elif all(val <= small for val, small, _ in known):
+        job_class = "small"
+    else:
+        job_class = "normal"
+
+    queue = get_ckan_config_option(
+        f"ckanext.dc_view.preview_job_{job_class}_queue")
+    timeout = get_ckan_config_option(
+        f"ckanext.dc_view.preview_job_{job_class}_timeout")
+    return (queue or PREVIEW_JOB_QUEUES[job_class],
+            int(timeout or PREVIEW_JOB_TIMEOUTS[job_class]))
+
+
 @rqjob_register(ckanext="dc_view",
                 queue="dcor-normal",
                 timeout=3600,
                 )
-def job_create_preview(resource, override=False):
-    """Generate a *_preview.png file for a DC resource"""
+@profiling.profiled
+def job_create_preview(resource, override=False, fig=None):
+    """Generate the preview images of a DC resource
+
+    The preview is rendered once and uploaded in all variants defined
+    in :const:`.preview_variants.PREVIEW_VARIANTS` (one S3 artifact
+    per variant). If the SHA256 checksum of the resource is known,
+    the preview images are copied from :mod:`.preview_cache` instead
+    of being rendered, if possible.
+
+    The preview version (see :func:`get_preview_version`) is stored
+    in the S3 object metadata of each variant. Existing previews are
+    only regenerated if `override` is set or if their version differs
+    from the current version.
+
+    Failures are recorded in :mod:`.failure_cache`. Unless `override`
+    is set, the preview of a resource for which the previous attempt
+    failed is not created again before the retry time of the
+    failure record.
+
+    If a matplotlib figure `fig` is given, it is reused for rendering
+    (see :func:`job_run_batch`).
+    """
     if not s3.is_available():
         log.info("S3 not available, not computing condensed resource")
         return False
 
-    # make sure mimetype is defined
+    set_dc_mimetype(resource)
+
+    rid = resource["id"]
+    metrics = JobMetrics("job_create_preview", rid)
+    metrics.status = "skipped"
+    try:
+        with metrics.stage("wait_for_resource"):
+            wait_for_resource(rid)
+        renderer = get_preview_renderer()
+        sampling = get_preview_sampling()
+        version = get_preview_version(renderer=renderer, **sampling)
+        with metrics.stage("check_existing"):
+            # Check whether an up-to-date preview already exists on S3
+            create = (resource.get('mimetype', '') in DC_MIME_TYPES
+                      and (override
+                           or get_stored_preview_version(rid) != version))
+            if create and not override:
+                failure = failure_cache.get_failure(rid)
+                if failure_cache.is_backing_off(failure, version):
+                    retry_at = time.strftime(
+                        "%Y-%m-%d %H:%M:%S",
+                        time.localtime(failure["retry_at"]))
+                    log.info(f"Not creating preview of {rid} before "
+                             f"{retry_at}, because attempt "
+                             f"{failure['attempts']} failed with "
+                             f"{failure['error']}")
+                    metrics.status = "backoff"
+                    return False
+        if create:
+            metrics.status = "ok"
+            created = create_preview(resource, renderer, sampling, version,
+                                     metrics, fig=fig)
+            if created:
+                failure_cache.clear_failure(rid)
+            return created
+        return False
+    finally:
+        metrics.publish(path_dir=get_ckan_config_option(
+            "ckanext.dc_view.metrics_dir"))
+
+
+def create_preview(resource, renderer, sampling, version, metrics,
+                   fig=None):
+    """Create and upload the preview images (see `job_create_preview`)"""
+    rid = resource["id"]
+    sha256 = str(resource.get("sha256", ""))  # can be bool sometimes
+    if len(sha256) != 64:
+        # The checksum might have been set after this job was enqueued.
+        _, res_dict = get_resource_info(rid)
+        sha256 = str(res_dict.get("sha256", ""))
+    use_cache = len(sha256) == 64
+    try:
+        private = is_resource_private(rid)
+        if use_cache:
+            with metrics.stage("cache_lookup"):
+                hit = preview_cache.copy_preview_from_cache(
+                    resource_id=rid,
+                    sha256=sha256,
+                    version=version,
+                    private=private)
+            if hit:
+                log.info(f"Copied preview of {rid} from cache")
+                return True
+        with metrics.stage("open_dataset"):
+            ds = get_dc_instance(rid)
+        with ds, get_preview_executor() as executor:
+            with metrics.stage("read_data") as info:
+                data = get_preview_data(ds, executor=executor, **sampling)
+                info["bytes_read"] = get_preview_data_nbytes(data)
+            with metrics.stage("render"):
+                img = render_preview_image(rtdc_ds=ds,
+                                           renderer=renderer,
+                                           data=data,
+                                           fig=fig,
+                                           executor=executor)
+        # The preview images are encoded and uploaded from memory
+        with metrics.stage("encode") as info:
+            variants = encode_preview_variants(img)
+            info["bytes_written"] = sum(len(v) for v in variants.values())
+        with metrics.stage("upload") as info:
+            for artifact, variant_data in variants.items():
+                upload_artifact_data(
+                    resource_id=rid,
+                    data=variant_data,
+                    artifact=artifact,
+                    private=private,
+                    version=version,
+                    content_type=CONTENT_TYPES[PREVIEW_VARIANTS[artifact][2]],
+                    cache_control=CACHE_CONTROL)
+                info["bytes_written"] += len(variant_data)
+        if use_cache:
+            with metrics.stage("cache_store"):
+                preview_cache.store_preview_in_cache(resource_id=rid,
+                                                     sha256=sha256,
+                                                     version=version)
+    except Exception as e:
+        metrics.status = "error"
+        if failure_cache.is_transient_error(e):
+            # e.g. S3 not reachable, let the RQ job fail instead of
+            # putting the resource into backoff
+            raise
+        log.exception(f"Could not create preview of {rid}")
+        failure_cache.record_failure(rid, error=e, version=version)
+    except BaseException:
+        # e.g. KeyboardInterrupt, must reach the caller
+        metrics.status = "error"
+        raise
+    else:
+        return True
+    return False
+
+
+@rqjob_register(ckanext="dc_view",
+                queue="dcor-short",
+                timeout=300,
+                )
+@profiling.profiled
+def job_create_metadata_html(resource, override=False):
+    """Render the metadata table of a DC resource and store it on S3"""
+    if not s3.is_available():
+        log.info("S3 not available, not rendering metadata table")
+        return False
+
+    set_dc_mimetype(resource)
+
+    rid = resource["id"]
+    metrics = JobMetrics("job_create_metadata_html", rid)
+    metrics.status = "skipped"
+    try:
+        with metrics.stage("wait_for_resource"):
+            wait_for_resource(rid)
+        with metrics.stage("check_existing"):
+            # Check whether the file already exists on S3
+            create = (resource.get('mimetype', '') in DC_MIME_TYPES
+                      and (override
+                           or not s3cc.artifact_exists(
+                               resource_id=rid, artifact="metadata_html")))
+        if not create:
+            return False
+        metrics.status = "ok"
+        # The metadata are taken from the file, because the `dc:*`
+        # metadata of the resource might not yet have been set by
+        # ckanext-dcor_schemas.
+        with metrics.stage("open_dataset"):
+            ds = get_dc_instance(rid)
+        with ds, metrics.stage("read_data"):
+            res_dict = meta.get_metadata_from_config(ds.config)
+        with metrics.stage("render"):
+            html_code = meta.render_metadata_html_uncached(res_dict)
+            header = meta.METADATA_HTML_HEADER.format(
+                meta.get_metadata_hash(res_dict))
+        with metrics.stage("upload") as info:
+            html_data = f"{header}\n{html_code}".encode("utf-8")
+            upload_artifact_data(resource_id=rid,
+                                 data=html_data,
+                                 artifact="metadata_html",
+                                 content_type="text/html; charset=utf-8")
+            info["bytes_written"] = len(html_data)
+        return True
+    finally:
+        metrics.publish(path_dir=get_ckan_config_option(
+            "ckanext.dc_view.metrics_dir"))
+
+
+@rqjob_register(ckanext="dc_view",
+                queue="dcor-normal",
+                timeout=3600,
+                )
+@profiling.profiled
+def job_create_scatter_histogram(resource, override=False):
+    """Compute the scatter histogram of a DC resource and store it on S3
+
+    The histogram (see :mod:`.scatter_histogram`) is binned over all
+    events of the resource, so this job takes longer for larger
+    resources. It is separate from `job_create_preview`, so that the
+    preview does not depend on it. The range of the histogram is
+    derived from the events shown in the preview (see
+    :func:`get_preview_sampling`).
+    """
+    if not s3.is_available():
+        log.info("S3 not available, not computing scatter histogram")
+        return False
+
+    set_dc_mimetype(resource)
+
+    rid = resource["id"]
+    metrics = JobMetrics("job_create_scatter_histogram", rid)
+    metrics.status = "skipped"
+    try:
+        with metrics.stage("wait_for_resource"):
+            wait_for_resource(rid)
+        with metrics.stage("check_existing"):
+            # Check whether the file already exists on S3
+            create = (resource.get('mimetype', '') in DC_MIME_TYPES
+                      and (override
+                           or not s3cc.artifact_exists(
+                               resource_id=rid,
+                               artifact=scatter_histogram.ARTIFACT)))
+        if not create:
+            return False
+        with metrics.stage("open_dataset"):
+            ds = get_dc_instance(rid)
+        with ds:
+            with metrics.stage("read_data") as info:
+                scatter = read_scatter_data(
+                    ds, **get_preview_sampling()).get("scatter")
+                if scatter is not None:
+                    info["bytes_read"] = get_preview_data_nbytes(scatter)
+            if scatter is None or not np.all(np.isfinite(scatter["lims"])):
+                log.info(f"No scatter histogram for {rid}, because "
+                         f"it has no valid scatter plot features")
+                return False
+            metrics.status = "ok"
+            with metrics.stage("histogram") as info:
+                compute = scatter_histogram.compute_scatter_histogram
+                histogram, nbytes = compute(
+                    ds,
+                    lims=scatter["lims"],
+                    xlabel=scatter["xlabel"],
+                    ylabel=scatter["ylabel"],
+                    ret_nbytes=True)
+                # feature data actually read for the histogram
+                info["bytes_read"] = nbytes
+        with metrics.stage("encode") as info:
+            histogram_data = scatter_histogram.encode_scatter_histogram(
+                histogram)
+            info["bytes_written"] = len(histogram_data)
+        with metrics.stage("upload") as info:
+            upload_artifact_data(resource_id=rid,
+                                 data=histogram_data,
+                                 artifact=scatter_histogram.ARTIFACT,
+                                 content_type="application/octet-stream",
+                                 cache_control=CACHE_CONTROL)
+            info["bytes_written"] = len(histogram_data)
+        return True
+    finally:
+        metrics.publish(path_dir=get_ckan_config_option(
+            "ckanext.dc_view.metrics_dir"))
+
+
+def set_dc_mimetype(resource):
+    """Make sure the mimetype of a DC resource is defined"""
     if "mimetype" not in resource:
         suffix = "." + resource["name"].rsplit(".", 1)[-1]
         for mt in DC_MIME_TYPES:
@@ -50,42 +763,209 @@ def job_create_preview(resource, override=False):
                 resource["mimetype"] = mt
                 break
 
-    rid = resource["id"]
-    wait_for_resource(rid)
-    if (resource.get('mimetype', '') in DC_MIME_TYPES
-        # Check whether the file already exists on S3
-        and (override
-             or not s3cc.artifact_exists(resource_id=rid,
-                                         artifact="preview"))):
-        # Create the preview in a temporary location
-        ttd_name = tempfile.mkdtemp(prefix="ckanext-dc_view_")
-        try:
-            path_preview = pathlib.Path(ttd_name) / "preview.jpg"
-            with get_dc_instance(rid) as ds:
-                fig = overview_plot(rtdc_ds=ds)
-                fig.savefig(str(path_preview), dpi=80)
-                plt.close()
-            # Upload the preview to S3
-            s3cc.upload_artifact(resource_id=rid,
-                                 path_artifact=path_preview,
-                                 artifact="preview",
-                                 override=True)
-        except BaseException:
-            pass
-        else:
-            return True
-        finally:
-            shutil.rmtree(ttd_name, ignore_errors=True)
-    return False
 
+@functools.lru_cache(maxsize=1)
+def get_pyplot():
+    """Return :mod:`matplotlib.pyplot` with the "agg" backend
+
+    matplotlib is imported on first use, because it is only required
+    for rendering previews with the "matplotlib" renderer, and not
+    in the CKAN web server processes that import this module.
+    """
+    # Create a matplotlib config directory, so we can import and use
+    # matplotlib
+    mpldir = "/tmp/matplotlib"
+    pathlib.Path(mpldir).mkdir(exist_ok=True)
+    os.environ['MPLCONFIGDIR'] = mpldir
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def get_preview_executor():
+    """Return a thread pool for reading data and rendering a preview
+
+    The data of the individual panels of the preview image are read
+    (see :func:`.preview_data.get_preview_data`) and the panels are
+    drawn (only by the "raster" renderer, see
+    :func:`.raster.compose_panels`) concurrently. The number of threads
+    is defined by the CKAN configuration option
+    "ckanext.dc_view.preview_threads" (default :const:`PREVIEW_THREADS`).
+    For a value of 1, everything runs in the calling thread.
+
+    Concurrency is disabled by default: h5py serializes all calls with
+    a global lock, matplotlib (the default renderer) draws in the
+    calling thread, and all readers share one dataset object. Only
+    use more threads if `benchmarks/bench_stages.py --threads` shows
+    a speedup on the worker machines.
 
-def overview_plot(rtdc_ds):
+    Returns
+    -------
+    executor: concurrent.futures.ThreadPoolExecutor or contextlib.nullcontext
+        Context manager that returns the thread pool (or None)
+    """
+    threads = get_ckan_config_option("ckanext.dc_view.preview_threads")
+    threads = int(threads or PREVIEW_THREADS)
+    if threads < 1:
+        raise ValueError(f"Invalid number of preview threads '{threads}', "
+                         f"expected a positive integer")
+    if threads == 1:
+        return contextlib.nullcontext()
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=threads, thread_name_prefix="dc_view_preview")
+
+
+def get_preview_renderer():
+    """Return the name of the engine used for rendering preview images
+
+    The engine is defined by the CKAN configuration option
+    "ckanext.dc_view.preview_renderer" and can be either "matplotlib"
+    (default, see :func:`overview_plot`) or "raster" (faster, see
+    :func:`.raster.overview_raster`).
+    """
+    renderer = get_ckan_config_option("ckanext.dc_view.preview_renderer")
+    renderer = (renderer or "matplotlib").strip().lower()
+    if renderer not in PREVIEW_RENDERERS:
+        raise ValueError(f"Invalid preview renderer '{renderer}', expected "
+                         f"one of {PREVIEW_RENDERERS}")
+    return renderer
+
+
+def get_preview_sampling():
+    """Return the event sampling settings for the preview image
+
+    The settings are defined by the CKAN configuration options
+    "ckanext.dc_view.preview_sample_size" (number of events shown
+    in the scatter plots, default 5000) and
+    "ckanext.dc_view.preview_sample_strategy" ("first" (default) or
+    "chunks", see :func:`.preview_data.get_preview_data`).
+
+    Returns
+    -------
+    sampling: dict
+        Keyword arguments `size` and `sampling` for
+        :func:`render_preview`
+    """
+    size = get_ckan_config_option("ckanext.dc_view.preview_sample_size")
+    size = int(size or 5000)
+    if size < 1:
+        raise ValueError(f"Invalid preview sample size '{size}', expected "
+                         f"a positive integer")
+    sampling = get_ckan_config_option(
+        "ckanext.dc_view.preview_sample_strategy")
+    sampling = (sampling or "first").strip().lower()
+    if sampling not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Invalid preview sample strategy '{sampling}', "
+                         f"expected one of {SAMPLING_STRATEGIES}")
+    return {"size": size, "sampling": sampling}
+
+
+def get_stored_preview_version(resource_id):
+    """Return the version of the preview of a resource on S3
+
+    Returns None if there is no preview or if the preview was
+    created before versions were recorded.
+    """
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact="preview")
+    return get_artifact_version(bucket_name, object_name)
+
+
+def get_current_preview_version():
+    """Return the preview version for the current CKAN configuration"""
+    return get_preview_version(renderer=get_preview_renderer(),
+                               **get_preview_sampling())
+
+
+def get_preview_version(renderer, size, sampling):
+    """Return a string identifying the appearance of the preview images
+
+    The string is composed of the rendering engine, the
+    :const:`PREVIEW_VERSION`, and the sampling settings, e.g.
+    "raster-3-first-5000".
+    """
+    return f"{renderer}-{PREVIEW_VERSION}-{sampling}-{size}"
+
+
+def render_preview(rtdc_ds, path, renderer=None, size=5000, sampling="first"):
+    """Render the preview image of a dataset and save it as a JPEG file
+
+    Parameters
+    ----------
+    rtdc_ds: dclab.rtdc_dataset.core.RTDCBase
+        Full DC dataset to plot
+    path: str or pathlib.Path
+        Output path of the JPEG file
+    renderer: str
+        Rendering engine to use, defaults to :func:`get_preview_renderer`
+    size: int
+        Number of events shown in the scatter plots
+    sampling: str
+        Strategy for selecting the events shown in the scatter plots
+        (see :func:`.preview_data.get_preview_data`)
+    """
+    img = render_preview_image(rtdc_ds=rtdc_ds,
+                               renderer=renderer,
+                               size=size,
+                               sampling=sampling)
+    img.save(str(path), format="JPEG")
+
+
+def render_preview_image(rtdc_ds, renderer=None, size=5000,
+                         sampling="first", data=None, fig=None,
+                         executor=None):
+    """Render the preview image of a dataset
+
+    The parameters are the same as for :func:`render_preview`. If
+    `data` (see :func:`.preview_data.get_preview_data`) is given,
+    `size` and `sampling` are ignored. If a matplotlib figure `fig`
+    is given, it is cleared and reused by the "matplotlib" renderer
+    (and not closed). If an `executor` is given (see
+    :func:`get_preview_executor`), the data are read concurrently
+    and the "raster" renderer draws the panels concurrently
+    (matplotlib is not thread-safe, so the "matplotlib" renderer
+    draws all panels in the calling thread).
+
+    Returns
+    -------
+    image: PIL.Image.Image
+        RGB preview image
+    """
+    if renderer is None:
+        renderer = get_preview_renderer()
+    if data is None:
+        data = get_preview_data(rtdc_ds, size=size, sampling=sampling,
+                                executor=executor)
+    if renderer == "raster":
+        img = raster.overview_raster(rtdc_ds=rtdc_ds, data=data,
+                                     executor=executor)
+    else:
+        reuse = fig is not None
+        fig = overview_plot(rtdc_ds=rtdc_ds, data=data, fig=fig)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=raster.DPI)
+        if not reuse:
+            get_pyplot().close(fig)
+        buffer.seek(0)
+        img = Image.open(buffer).convert("RGB")
+    return img
+
+
+def overview_plot(rtdc_ds, data=None, fig=None):
     """Simple overview plot adapted from the dclab examples
 
     Parameters
     ----------
     rtdc_ds: dclab.rtdc_dataset.core.RTDCBase
         Full DC dataset to plot
+    data: dict
+        Data to plot as returned by
+        :func:`.preview_data.get_preview_data`; read from `rtdc_ds`
+        with the default settings if not given
+    fig: matplotlib.figure.Figure
+        Figure to draw on (cleared and resized); a new figure is
+        created if not given
 
     .. versionchanged:: 0.5.10
 
@@ -96,36 +976,28 @@ def overview_plot(rtdc_ds):
         Removed `rtdc_ds_cond` argument, since we are now working
         with linked datasets.
 
-    """
-    # Only plot the first 5000 events
-    size = min(len(rtdc_ds), 5000)
-    rtdc_ds.filter.manual[:] = False
-    rtdc_ds.filter.manual[:size] = True
-    rtdc_ds.apply_filter()
-    ds = dclab.new_dataset(rtdc_ds)
+    .. versionchanged:: 1.1.0
 
-    # Features for scatter plot
-    scatter_x = "area_um"
-    scatter_y = "deform"
-    # Event index to display
-    event_index = min(len(ds) - 1, 47)
+        Only the data required for plotting are read from `rtdc_ds`
+        (see :func:`.preview_data.get_preview_data`); added the `data`
+        and `fig` arguments
 
-    xlabel = dclab.dfn.get_feature_label(scatter_x, rtdc_ds=ds)
-    ylabel = dclab.dfn.get_feature_label(scatter_y, rtdc_ds=ds)
+    """
+    if data is None:
+        data = get_preview_data(rtdc_ds)
 
     plots = OrderedDict()
-    plots["scatter_basic"] = scatter_x in ds and scatter_y in ds
-    plots["scatter_kde"] = scatter_x in ds and scatter_y in ds
-    plots["image"] = "image" in ds
-    plots["mask"] = "mask" in ds
-    plots["trace"] = "trace" in ds
+    plots["scatter_basic"] = "scatter" in data
+    plots["scatter_kde"] = "scatter" in data
+    plots["image"] = "image" in data
+    plots["mask"] = "mask" in data
+    plots["trace"] = "trace" in data
 
     numplots = sum(plots.values())
 
     if not numplots:
         # empty plot
-        fig = plt.figure(figsize=(4, 4))
-        return fig
+        return get_figure(fig, figsize=(4, 4))
 
     height_ratios = []
     for key in plots:
@@ -135,87 +1007,91 @@ def overview_plot(rtdc_ds):
             else:
                 height_ratios.append(2)
 
-    fig = plt.figure(figsize=(4, np.sum(height_ratios) * 1.5))
+    fig = get_figure(fig, figsize=(4, np.sum(height_ratios) * 1.5))
 
-    gs = GridSpec(numplots, 1, height_ratios=height_ratios)
+    gs = fig.add_gridspec(numplots, 1, height_ratios=height_ratios)
     ii = 0
 
-    if scatter_x in ds and scatter_y in ds:
+    if "scatter" in data:
+        scatter = data["scatter"]
         ax1 = fig.add_subplot(gs[ii])
         ax1.set_title("Basic scatter plot")
         ii += 1
-        x_start = np.percentile(ds[scatter_x], 1)
-        x_end = np.percentile(ds[scatter_x], 99)
-        y_start = np.percentile(ds[scatter_y], 1)
-        y_end = np.percentile(ds[scatter_y], 99)
+        x_start, x_end, y_start, y_end = scatter["lims"]
 
-        ax1.plot(ds[scatter_x], ds[scatter_y],
+        ax1.plot(scatter["x"], scatter["y"],
                  "o", color="k", alpha=.2, ms=1)
-        ax1.set_xlabel(xlabel)
-        ax1.set_ylabel(ylabel)
+        ax1.set_xlabel(scatter["xlabel"])
+        ax1.set_ylabel(scatter["ylabel"])
         ax1.set_xlim(x_start, x_end)
         ax1.set_ylim(y_start, y_end)
 
         ax2 = fig.add_subplot(gs[ii])
         ax2.set_title("KDE scatter plot")
         ii += 1
-        sc = ax2.scatter(ds[scatter_x], ds[scatter_y],
-                         c=ds.get_kde_scatter(xax=scatter_x,
-                                              yax=scatter_y,
-                                              kde_type="histogram"),
+        sc = ax2.scatter(scatter["x"], scatter["y"],
+                         c=scatter["density"],
                          s=3)
-        plt.colorbar(sc, label="kernel density [a.u]", ax=ax2)
-        ax2.set_xlabel(xlabel)
-        ax2.set_ylabel(ylabel)
+        fig.colorbar(sc, label="kernel density [a.u]", ax=ax2)
+        ax2.set_xlabel(scatter["xlabel"])
+        ax2.set_ylabel(scatter["ylabel"])
         ax2.set_xlim(x_start, x_end)
         ax2.set_ylim(y_start, y_end)
 
-    if "image" in ds:
+    if "image" in data:
         ax3 = fig.add_subplot(gs[ii])
         ax3.set_title("Event image with contour")
         ii += 1
-        ax3.imshow(ds["image"][event_index], cmap="gray")
+        ax3.imshow(data["image"], cmap="gray")
         ax3.set_xlabel("Detector X [px]")
         ax3.set_ylabel("Detector Y [px]")
 
-        if "contour" in ds:
-            ax3.plot(ds["contour"][event_index][:, 0],
-                     ds["contour"][event_index][:, 1],
+        if "contour" in data:
+            ax3.plot(data["contour"][:, 0],
+                     data["contour"][:, 1],
                      c="r")
 
-    if "mask" in ds:
+    if "mask" in data:
         ax4 = fig.add_subplot(gs[ii])
         ax4.set_title("Event mask")
         ii += 1
-        pxsize = ds.config["imaging"]["pixel size"]
-        ax4.imshow(ds["mask"][event_index],
-                   extent=(0, ds["mask"][0].shape[1] * pxsize,
-                           0, ds["mask"][0].shape[0] * pxsize),
+        pxsize = data["pixel size"]
+        ax4.imshow(data["mask"],
+                   extent=(0, data["mask"].shape[1] * pxsize,
+                           0, data["mask"].shape[0] * pxsize),
                    cmap="gray")
         ax4.set_xlabel(u"Detector X [µm]")
         ax4.set_ylabel(u"Detector Y [µm]")
 
-    if "trace" in ds:
+    if "trace" in data:
         ax5 = fig.add_subplot(gs[ii])
         ax5.set_title("Fluorescence traces")
         ii += 1
-        flsamples = ds.config["fluorescence"]["samples per event"]
-        flrate = ds.config["fluorescence"]["sample rate"]
-        fltime = np.arange(flsamples) / flrate * 1e6
-        if "fl1_raw" in ds["trace"]:
-            ax5.plot(fltime, ds["trace"]["fl1_raw"][event_index],
+        fltime = data["fltime"]
+        if "fl1_raw" in data["trace"]:
+            ax5.plot(fltime, data["trace"]["fl1_raw"],
                      c="#15BF00", label="fl1_raw")
-        if "fl2_raw" in ds["trace"]:
-            ax5.plot(fltime, ds["trace"]["fl2_raw"][event_index],
+        if "fl2_raw" in data["trace"]:
+            ax5.plot(fltime, data["trace"]["fl2_raw"],
                      c="#BF8A00", label="fl2_raw")
-        if "fl3_raw" in ds["trace"]:
-            ax5.plot(fltime, ds["trace"]["fl3_raw"][event_index],
+        if "fl3_raw" in data["trace"]:
+            ax5.plot(fltime, data["trace"]["fl3_raw"],
                      c="#BF0C00", label="fl3_raw")
         ax5.legend()
         ax5.set_xlabel(u"Event time [µs]")
         ax5.set_ylabel("Fluorescence [a.u.]")
         ax5.set_xlim(0, fltime[-1])
 
-    plt.tight_layout()
+    fig.tight_layout()
+
+    return fig
+
 
+def get_figure(fig=None, figsize=(4, 4)):
+    """Return a new figure or clear and resize an existing figure"""
+    if fig is None:
+        fig = get_pyplot().figure(figsize=figsize)
+    else:
+        fig.clear()
+        fig.set_size_inches(*figsize)
     return fig
@@ -1,11 +1,158 @@
+import hashlib
 import html
+import json
 import numbers
 
+import botocore.exceptions
 import dclab
-from dclab.features.emodulus.viscosity import ALIAS_MEDIA
+from dcor_shared import s3
+import numpy as np
+
+from .artifact_index import get_bucket_name_for_organization
+from .cache import TTLCache
+
+
+#: Metadata sections shown in the view (in this order)
+SECTIONS = ["experiment", "pipeline", "setup", "imaging", "fluorescence"]
+
+#: Cache for rendered metadata tables, keyed by resource ID and metadata hash
+metadata_html_cache = TTLCache(maxsize=1024)
+
+#: First line of the "metadata_html" artifact stored on S3
+METADATA_HTML_HEADER = "<!-- dc_view metadata hash: {} -->"
+
+
+def _compute_labels(sec, key):
+    """Return sort key, label, and units for a metadata key"""
+    descr = dclab.dfn.get_config_value_descr(sec, key)
+    name = descr
+    # Special cases
+    if sec == "experiment":
+        if key in ["date", "time"]:
+            name, _ = name.split("(")
+        elif key == "sample":
+            name = "Sample name"
+    elif sec == "setup":
+        if key == "chip region":
+            name = name.split(" (")[0]
+        elif key == "module composition":
+            name = "Modules used"
+        elif key == "software version":
+            name = "Software"
+
+    # Units
+    units = None
+    if name.endswith("]"):
+        name, units = name.rsplit(" [", 1)
+        units = units.strip("] ")
+    # Keys are sorted by their description
+    return (descr, key), name, units
+
+
+#: Precomputed sort key, label and units for all known metadata keys
+#: (read-only)
+METADATA_LABELS = {
+    sec: {key: _compute_labels(sec, key) for key in dclab.dfn.config_keys[sec]}
+    for sec in SECTIONS
+}
+
+
+def get_alias_media():
+    """Return a dictionary mapping alias names of media to common names
+
+    The viscosity module of dclab is only imported when needed.
+    """
+    from dclab.features.emodulus.viscosity import ALIAS_MEDIA
+    return ALIAS_MEDIA
+
+
+def get_metadata_from_config(config):
+    """Convert a dclab configuration to `dc:*` resource metadata
+
+    This mimics how ckanext-dcor_schemas stores the metadata of a DC
+    resource (values that are not JSON compliant are ignored), so that
+    :func:`get_metadata_hash` yields the same hash for the returned
+    dictionary and for the resource dictionary.
+    """
+    res_dict = {}
+    for sec in SECTIONS:
+        if sec in config:
+            for key in dclab.dfn.config_keys[sec]:
+                if key in config[sec]:
+                    value = config[sec][key]
+                    if isinstance(value, np.generic):
+                        value = value.item()
+                    try:
+                        json.dumps(value, allow_nan=False, ensure_ascii=False)
+                    except ValueError:
+                        pass
+                    else:
+                        res_dict[f"dc:{sec}:{key}"] = value
+    return res_dict
+
+
+def get_metadata_hash(res_dict):
+    """Return a hash of the displayed DC metadata of a resource
+
+    Only the `dc:*` keys of the sections in :const:`SECTIONS` are
+    taken into account.
+    """
+    meta = {key: res_dict[key] for key in res_dict
+            if key.startswith("dc:") and key.split(":")[1] in SECTIONS}
+    dump = json.dumps(meta, sort_keys=True, default=str)
+    return hashlib.md5(dump.encode("utf-8")).hexdigest()
+
+
+def get_stored_metadata_html(resource_id, organization_id, metadata_hash):
+    """Return the metadata HTML stored on S3 by `job_create_metadata_html`
+
+    This is meant for consumers outside the web server (e.g. scripts
+    or other services); the view renders the tables in the request
+    (see :func:`render_metadata_html`), which is faster than fetching
+    them from S3. Returns None if the artifact does not exist, if it
+    was rendered from metadata that do not match `metadata_hash`, or
+    if S3 cannot be reached.
+    """
+    bucket_name = get_bucket_name_for_organization(organization_id)
+    rid = resource_id
+    s3_client, _, _ = s3.get_s3()
+    try:
+        resp = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=f"metadata_html/{rid[:3]}/{rid[3:6]}/{rid[6:]}")
+    except (s3_client.exceptions.NoSuchKey,
+            s3_client.exceptions.NoSuchBucket,
+            botocore.exceptions.ClientError,
+            botocore.exceptions.BotoCoreError):
+        return None
+    header, html_code = resp["Body"].read().decode("utf-8").split("\n", 1)
+    if header != METADATA_HTML_HEADER.format(metadata_hash):
+        return None
+    return html_code
 
 
 def render_metadata_html(res_dict):
+    """Return the HTML tables of the DC metadata of a resource (cached)
+
+    The rendered HTML is cached for each resource and the hash of its
+    DC metadata (see :func:`get_metadata_hash`), so repeated views
+    of the same resource do not have to render the tables again.
+
+    The tables are always rendered in the web process, which takes
+    less time than fetching the artifact stored on S3 by the
+    `job_create_metadata_html` background job (see
+    :func:`get_stored_metadata_html`) and does not depend on S3
+    being reachable.
+    """
+    key = (res_dict.get("id"), get_metadata_hash(res_dict))
+    html_code = metadata_html_cache.get(key)
+    if html_code is None:
+        html_code = render_metadata_html_uncached(res_dict)
+        metadata_html_cache.set(key, html_code)
+    return html_code
+
+
+def render_metadata_html_uncached(res_dict):
     # build dictionary from metadata
     meta = {}
     for dckey in res_dict:
@@ -16,7 +163,7 @@ def render_metadata_html(res_dict):
             meta[sec][key] = res_dict[dckey]
 
     html_code = []
-    for sec in ["experiment", "pipeline", "setup", "imaging", "fluorescence"]:
+    for sec in SECTIONS:
         if sec in meta:
             html_code += meta_html_table(meta, sec)
             html_code.append("<br>")
@@ -31,34 +178,32 @@ def meta_html_table(meta, sec):
         f'<caption class="dc_view">{sec.capitalize()}</caption>',
     ]
 
-    kn = [(dclab.dfn.config_descr[sec][key], key) for key in meta[sec].keys()]
-    for name, key in sorted(kn):
+    labels = METADATA_LABELS.get(sec, {})
+    rows = []
+    for key in meta[sec]:
+        if key in labels:
+            row = labels[key]
+        else:
+            # unknown key (e.g. from a newer version of dclab); not added
+            # to the shared `METADATA_LABELS`, which must not grow with
+            # arbitrary keys
+            row = _compute_labels(sec, key)
+        rows.append(row + (key,))
+
+    for _, name, units, key in sorted(rows):
         value = meta[sec][key]
         if isinstance(value, numbers.Number):
             value = f"{value:.4g}"
 
         # Special cases
-        if sec == "experiment":
-            if key in ["date", "time"]:
-                name, _ = name.split("(")
-            elif key == "sample":
-                name = "Sample name"
-        elif sec == "setup":
-            if key == "chip region":
-                name = name.split(" (")[0]
-            elif key == "medium" and value in ALIAS_MEDIA:
+        if sec == "setup":
+            if key == "medium":
                 # Convert names to common names
-                value = ALIAS_MEDIA[value]
+                value = get_alias_media().get(value, value)
             elif key == "module composition":
-                name = "Modules used"
                 value = ", ".join(value.split(","))
-            elif key == "software version":
-                name = "Software"
 
-        # Units
-        if name.endswith("]"):
-            name, units = name.rsplit(" [", 1)
-            units = units.strip("] ")
+        if units is not None:
             value += " " + units
 
         html_code += [
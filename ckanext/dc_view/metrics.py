@@ -0,0 +1,263 @@
+"""Per-stage timing and metrics of the background jobs
+
+Each run of a job records the duration, the number of bytes read, and
+the number of bytes written for each of its stages (see
+:class:`JobMetrics`). When a job run is finished, the metrics are
+logged as a structured (JSON) log record and added to the metrics
+of the worker process (:const:`registry`). The metrics can also be
+exported in the Prometheus text exposition format, e.g. for the
+textfile collector of the Prometheus node exporter. RQ forks a new
+work horse process for every job, so the metrics of all job runs are
+accumulated in a single file per directory (see
+:func:`add_to_prometheus_textfile`).
+"""
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+#: Upper bounds of the buckets of the stage duration histograms [s]
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+#: Name of the Prometheus textfile in the metrics directory; the
+#: accumulated metrics are stored in "<name>.json" and the file
+#: "<name>.lock" serializes the updates
+TEXTFILE_NAME = "dc_view.prom"
+
+
+class MetricsRegistry:
+    """Accumulated stage metrics of all job runs in this process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Reset all metrics"""
+        with self._lock:
+            # (job, status) -> number of runs
+            self.runs = collections.Counter()
+            # (job, stage) -> histogram bucket counts, sum, count
+            self.durations = {}
+            # (job, stage) -> total number of bytes
+            self.bytes_read = collections.Counter()
+            self.bytes_written = collections.Counter()
+
+    def add(self, job_metrics):
+        """Add the metrics of a finished job run"""
+        with self._lock:
+            job = job_metrics.job
+            self.runs[(job, job_metrics.status)] += 1
+            for stage in job_metrics.stages:
+                key = (job, stage["stage"])
+                if key not in self.durations:
+                    self.durations[key] = {
+                        "buckets": [0] * len(DURATION_BUCKETS),
+                        "sum": 0.0,
+                        "count": 0}
+                hist = self.durations[key]
+                for ii, bound in enumerate(DURATION_BUCKETS):
+                    if stage["duration"] <= bound:
+                        hist["buckets"][ii] += 1
+                hist["sum"] += stage["duration"]
+                hist["count"] += 1
+                self.bytes_read[key] += stage["bytes_read"]
+                self.bytes_written[key] += stage["bytes_written"]
+
+    def get_state(self):
+        """Return all metrics as a JSON-serializable dictionary"""
+        with self._lock:
+            return {
+                "runs": [[*key, value] for key, value in self.runs.items()],
+                "durations": [[*key, hist]
+                              for key, hist in self.durations.items()],
+                "bytes_read": [[*key, value]
+                               for key, value in self.bytes_read.items()],
+                "bytes_written": [[*key, value] for key, value
+                                  in self.bytes_written.items()],
+            }
+
+    def set_state(self, state):
+        """Replace all metrics with those from :func:`get_state`"""
+        with self._lock:
+            self.runs = collections.Counter(
+                {(job, status): value for job, status, value
+                 in state["runs"]})
+            self.durations = {(job, stage): hist for job, stage, hist
+                              in state["durations"]}
+            self.bytes_read = collections.Counter(
+                {(job, stage): value for job, stage, value
+                 in state["bytes_read"]})
+            self.bytes_written = collections.Counter(
+                {(job, stage): value for job, stage, value
+                 in state["bytes_written"]})
+
+    def to_prometheus_text(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP dc_view_job_runs_total Number of job runs",
+                "# TYPE dc_view_job_runs_total counter",
+            ]
+            for (job, status), value in sorted(self.runs.items()):
+                lines.append(f'dc_view_job_runs_total{{job="{job}",'
+                             f'status="{status}"}} {value}')
+            lines += [
+                "# HELP dc_view_job_stage_duration_seconds Duration of "
+                "the stages of the jobs",
+                "# TYPE dc_view_job_stage_duration_seconds histogram",
+            ]
+            for (job, stage), hist in sorted(self.durations.items()):
+                labels = f'job="{job}",stage="{stage}"'
+                name = "dc_view_job_stage_duration_seconds"
+                for bound, value in zip(DURATION_BUCKETS, hist["buckets"]):
+                    lines.append(
+                        f'{name}_bucket{{{labels},le="{bound}"}} {value}')
+                lines += [
+                    f'{name}_bucket{{{labels},le="+Inf"}} {hist["count"]}',
+                    f'{name}_sum{{{labels}}} {hist["sum"]:.6f}',
+                    f'{name}_count{{{labels}}} {hist["count"]}',
+                ]
+            for kind, counter in [("read", self.bytes_read),
+                                  ("written", self.bytes_written)]:
+                name = f"dc_view_job_stage_bytes_{kind}_total"
+                lines += [
+                    f"# HELP {name} Number of bytes {kind} in the stages "
+                    f"of the jobs",
+                    f"# TYPE {name} counter",
+                ]
+                for (job, stage), value in sorted(counter.items()):
+                    lines.append(
+                        f'{name}{{job="{job}",stage="{stage}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+#: Metrics of all jobs run in this process
+registry = MetricsRegistry()
+
+
+def add_to_prometheus_textfile(job_metrics, path_dir):
+    """Add the metrics of a job run to the Prometheus textfile
+
+    All worker processes that share `path_dir` write to the same file
+    (:const:`TEXTFILE_NAME`). While holding an exclusive lock on
+    "<name>.lock", the accumulated metrics are loaded from
+    "<name>.json", the metrics of the job run are added, and both
+    files are replaced atomically.
+
+    Parameters
+    ----------
+    job_metrics: JobMetrics
+        Metrics of a finished job run
+    path_dir: str or pathlib.Path
+        Directory of the textfile
+
+    Returns
+    -------
+    path: pathlib.Path
+        Path to the Prometheus textfile
+    """
+    path_dir = pathlib.Path(path_dir)
+    path_dir.mkdir(parents=True, exist_ok=True)
+    path = path_dir / TEXTFILE_NAME
+    path_state = path_dir / f"{TEXTFILE_NAME}.json"
+    with open(path_dir / f"{TEXTFILE_NAME}.lock", "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            accumulated = MetricsRegistry()
+            if path_state.exists():
+                accumulated.set_state(
+                    json.loads(path_state.read_text(encoding="utf-8")))
+            accumulated.add(job_metrics)
+            for path_out, text in [
+                    (path_state, json.dumps(accumulated.get_state())),
+                    (path, accumulated.to_prometheus_text())]:
+                path_tmp = path_out.with_name(path_out.name + ".tmp")
+                path_tmp.write_text(text, encoding="utf-8")
+                os.replace(path_tmp, path_out)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    return path
+
+
+class JobMetrics:
+    """Stage metrics of a single job run
+
+    Parameters
+    ----------
+    job: str
+        Name of the job (e.g. "job_create_preview")
+    resource_id: str
+        Identifier of the resource processed by the job
+
+    Examples
+    --------
+    ::
+
+        metrics = JobMetrics("job_create_preview", rid)
+        with metrics.stage("upload") as info:
+            info["bytes_written"] = upload(...)
+        metrics.publish()
+    """
+    def __init__(self, job, resource_id):
+        self.job = job
+        self.resource_id = resource_id
+        self.stages = []
+        self.status = "ok"
+        self.time_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager for recording the metrics of a stage
+
+        Yields a dictionary in which the "bytes_read" and "bytes_written"
+        of the stage may be set. If an exception is raised within the
+        stage, the status of the job run is set to "error".
+        """
+        info = {"stage": name, "bytes_read": 0, "bytes_written": 0}
+        t0 = time.perf_counter()
+        try:
+            yield info
+        except BaseException:
+            self.status = "error"
+            raise
+        finally:
+            info["duration"] = time.perf_counter() - t0
+            self.stages.append(info)
+
+    def to_dict(self):
+        """Return the metrics of this job run as a dictionary"""
+        return {"job": self.job,
+                "resource_id": self.resource_id,
+                "status": self.status,
+                "duration": time.perf_counter() - self.time_start,
+                "stages": self.stages,
+                }
+
+    def publish(self, path_dir=None):
+        """Log the metrics and add them to :const:`registry`
+
+        Parameters
+        ----------
+        path_dir: str or pathlib.Path
+            If given, the metrics of this job run are added to the
+            Prometheus textfile in this directory (see
+            :func:`add_to_prometheus_textfile`)
+        """
+        record = self.to_dict()
+        log.info(json.dumps(record, sort_keys=True),
+                 extra={"dc_view_metrics": record})
+        registry.add(self)
+        if path_dir:
+            try:
+                add_to_prometheus_textfile(self, path_dir)
+            except (OSError, ValueError):
+                log.exception(f"Could not write metrics to {path_dir}")
@@ -1,23 +1,63 @@
+import functools
+import logging
+
 from flask import Blueprint
 import ckan.lib.datapreview as datapreview
+import ckan.model as model
 import ckan.plugins as plugins
 
 from dcor_shared import DC_MIME_TYPES, s3
 
-from .cli import get_commands
-from . import jobs
 from .meta import render_metadata_html
-from .route_funcs import dcpreview
+from .preview_variants import PREVIEW_VARIANTS, THUMBNAIL_WIDTH
+from .route_funcs import (
+    ARTIFACT_FILE_NAMES, dcpreview, get_public_preview_urls,
+    invalidate_preview_url_cache
+)
+
+log = logging.getLogger(__name__)
+
+
+@plugins.toolkit.chained_action
+def package_update(up_func, context, data_dict):
+    """Make the artifacts of a dataset public when it is published
+
+    The `private` flag is compared before and after the update (in the
+    database, because `data_dict` of `package_patch` might not contain
+    it), so the artifacts are only tagged public on the transition from
+    private to public (see :func:`.jobs.job_make_artifacts_public`).
+    """
+    dataset = model.Package.get(data_dict.get("id"))
+    was_private = dataset is not None and dataset.private
+    result = up_func(context, data_dict)
+    if was_private and s3.is_available():
+        dataset = model.Package.get(dataset.id)
+        if not dataset.private:
+            # Imported here, because only the background job workers
+            # need the rendering code.
+            from . import jobs
+            jobs.enqueue_make_artifacts_public(
+                {"id": dataset.id,
+                 "owner_org": dataset.owner_org,
+                 "private": dataset.private,
+                 "resources": [{"id": res.id}
+                               for res in dataset.resources]})
+    return result
 
 
 class DCViewPlugin(plugins.SingletonPlugin):
     """DC data view and route for *_preview.png"""
+    plugins.implements(plugins.IActions, inherit=True)
     plugins.implements(plugins.IBlueprint, inherit=True)
     plugins.implements(plugins.IClick, inherit=True)
     plugins.implements(plugins.IConfigurer, inherit=True)
     plugins.implements(plugins.IResourceController, inherit=True)
     plugins.implements(plugins.IResourceView, inherit=True)
 
+    # IActions
+    def get_actions(self):
+        return {"package_update": package_update}
+
     # IBlueprint
     def get_blueprint(self):
         """"Return a Flask Blueprint object to be registered by the app."""
@@ -31,12 +71,22 @@ class DCViewPlugin(plugins.SingletonPlugin):
              'dcpreview',
              dcpreview),
         ]
+        # other preview variants and the scatter histogram
+        for variant, file_name in ARTIFACT_FILE_NAMES.items():
+            if variant != "preview":
+                rules.append(
+                    (f'/dataset/<uuid:ds_id>/resource/<uuid:res_id>/'
+                     f'{file_name}',
+                     f'dcpreview_{variant}',
+                     functools.partial(dcpreview, variant=variant)))
         for rule in rules:
             blueprint.add_url_rule(*rule)
         return blueprint
 
     # IClick
     def get_commands(self):
+        # Import here, so the web server does not load the jobs
+        from .cli import get_commands
         return get_commands()
 
     # IConfigurer
@@ -50,8 +100,30 @@ class DCViewPlugin(plugins.SingletonPlugin):
         # We only create the preview and upload it to S3 if the file is
         # a DC file and if S3 is available.
         if not context.get("is_background_job") and s3.is_available():
-            # All jobs are defined via decorators in jobs.py
-            jobs.RQJob.enqueue_all_jobs(resource, ckanext="dc_view")
+            # All jobs are defined via decorators in jobs.py (the preview
+            # job is routed to a queue according to the resource size).
+            # They are imported here, because only the background job
+            # workers need the rendering code.
+            from . import jobs
+            jobs.enqueue_all_jobs(resource)
+
+    def after_resource_update(self, context, resource):
+        """Invalidate cached preview URLs"""
+        invalidate_preview_url_cache(resource["id"])
+
+    def before_resource_delete(self, context, resource, resources):
+        """Invalidate cached preview URLs and delete unused cache entries"""
+        invalidate_preview_url_cache(resource["id"])
+        if s3.is_available():
+            # Imported here, because the web server only needs it here
+            from . import preview_cache
+            try:
+                # The cache entries are deleted in a background job.
+                preview_cache.enqueue_release_preview_cache(resource["id"])
+            except Exception:
+                # Do not prevent the deletion of the resource
+                log.exception(f"Could not release cached previews of "
+                              f"{resource['id']}")
 
     # IResourceView
     def info(self):
@@ -75,12 +147,60 @@ class DCViewPlugin(plugins.SingletonPlugin):
     def setup_template_variables(self, context, data_dict):
         ds_id = data_dict["package"]["id"]
         rid = data_dict["resource"]["id"]
-        preview_url = f"/dataset/{ds_id}/resource/{rid}/preview.jpg"
+        url_stem = f"/dataset/{ds_id}/resource/{rid}"
+        route_urls = {variant: f"{url_stem}/{file_name}"
+                      for variant, (file_name, _, _)
+                      in PREVIEW_VARIANTS.items()}
+        urls = route_urls
+        if (not data_dict["package"].get("private")
+                and data_dict["resource"].get("s3_available")
+                and s3.is_available()):
+            # Previews of public datasets are linked directly on S3,
+            # which saves the browser a request to the `dcpreview` route.
+            # If an image cannot be loaded from S3 (e.g. not created or
+            # not tagged public yet), the template falls back to the
+            # route.
+            urls = get_public_preview_urls(
+                rid, organization_id=data_dict["package"]["owner_org"])
+        # Let the browser choose between thumbnail and full size
+        # (`srcset` with width descriptors) and between WebP and JPEG.
+        srcset = get_preview_srcsets(urls)
+        route_srcset = get_preview_srcsets(route_urls)
         metadata_html = render_metadata_html(data_dict["resource"])
         return {
             'metadata_html': metadata_html,
-            'preview_url': preview_url,
+            'preview_url': urls["preview"],
+            'preview_srcset_jpeg': srcset["jpeg"],
+            'preview_srcset_webp': srcset["webp"],
+            'preview_route_url': route_urls["preview"],
+            'preview_route_srcset_jpeg': route_srcset["jpeg"],
+            'preview_route_srcset_webp': route_srcset["webp"],
+            'preview_sizes': f"(max-width: 480px) {THUMBNAIL_WIDTH}px, "
+                             f"{2 * THUMBNAIL_WIDTH}px",
         }
 
     def view_template(self, context, data_dict):
         return 'dc_view.html'
+
+
+def get_preview_srcsets(urls):
+    """Return the `srcset` attributes of the JPEG and WebP previews
+
+    Parameters
+    ----------
+    urls: dict
+        Maps the preview variants to their URLs
+
+    Returns
+    -------
+    srcset: dict
+        `srcset` attribute (thumbnail and full size with width
+        descriptors) for the keys "jpeg" and "webp"
+    """
+    srcset = {}
+    for fmt, suffix in [("jpeg", ""), ("webp", "_webp")]:
+        srcset[fmt] = ", ".join([
+            f"{urls['preview_thumb' + suffix]} {THUMBNAIL_WIDTH}w",
+            f"{urls['preview' + suffix]} {2 * THUMBNAIL_WIDTH}w",
+        ])
+    return srcset
@@ -0,0 +1,254 @@
+"""Content-addressed cache of preview images on S3
+
+Many resources are byte-identical copies of other resources (e.g. in
+copies of datasets). Since the preview only depends on the content
+of the resource and on the settings of the renderer, the preview
+images are stored in a cache keyed by the SHA256 checksum of the
+resource and the preview version (see :func:`.jobs.get_preview_version`).
+On a cache hit, the preview images are copied server-side, without
+downloading the resource or rendering anything.
+
+The cached objects are not artifacts of a resource. They are stored
+in a separate bucket of the DCOR instance (see
+:func:`get_cache_bucket_name`, named like the instance backup bucket),
+which is not a circle bucket, so `dcor-prune-orphaned-s3-artifacts`
+neither reports nor deletes them. The object names start with the ID
+of the organization (circle) of the resource, so that preview images
+are never copied between circles. Cached objects are never public.
+
+Cache entries are deleted
+
+- for all other preview versions when a preview is stored in the
+  cache (only the entry of the current version is kept, see
+  :func:`store_preview_in_cache`) and
+- when a resource is deleted and no other active resource of the same
+  organization has the same checksum (see
+  :func:`release_preview_cache`, which runs as a background job).
+"""
+from dcor_shared import get_ckan_config_option, s3, s3cc
+
+from .preview_variants import PREVIEW_VARIANTS
+
+
+#: Suffix of the name of the cache bucket (appended to the bucket name
+#: prefix of the DCOR instance, see :func:`get_cache_bucket_name`)
+CACHE_BUCKET_SUFFIX = "000000000-preview-cache"
+
+
+def get_cache_bucket_name():
+    """Return the name of the S3 bucket of the preview cache"""
+    bucket_prefix = get_ckan_config_option(
+        "dcor_object_store.bucket_name").format(organization_id="")
+    return f"{bucket_prefix}{CACHE_BUCKET_SUFFIX}"
+
+
+def get_cache_prefix(organization_id, sha256):
+    """Return the prefix of all cached objects of a checksum"""
+    return (f"{organization_id}/"
+            f"{sha256[:3]}/{sha256[3:6]}/{sha256[6:]}/")
+
+
+def get_cache_object_name(organization_id, sha256, version, artifact):
+    """Return the object name of a cached preview variant"""
+    return f"{get_cache_prefix(organization_id, sha256)}{version}/{artifact}"
+
+
+def get_organization_id(resource_id):
+    """Return the ID of the organization (circle) of a resource"""
+    # Import here so the module can be loaded without ckan available
+    import ckan.model as model
+    return model.Resource.get(resource_id).package.owner_org
+
+
+def delete_cache_entries(organization_id, sha256, keep_version=None):
+    """Delete the cached previews of a checksum
+
+    Parameters
+    ----------
+    organization_id: str
+        ID of the organization (circle) of the resource
+    sha256: str
+        SHA256 checksum of the resource
+    keep_version: str
+        If given, the entry of this preview version is not deleted
+
+    Returns
+    -------
+    num_deleted: int
+        Number of deleted objects
+    """
+    s3_client, _, _ = s3.get_s3()
+    bucket_name = get_cache_bucket_name()
+    prefix = get_cache_prefix(organization_id, sha256)
+    keep_prefix = None if keep_version is None else f"{prefix}{keep_version}/"
+    keys = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    try:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if (keep_prefix is None
+                        or not obj["Key"].startswith(keep_prefix)):
+                    keys.append(obj["Key"])
+    except s3_client.exceptions.NoSuchBucket:
+        # nothing cached yet
+        return 0
+    # at most 1000 objects per request
+    for start in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key}
+                                for key in keys[start:start + 1000]],
+                    "Quiet": True})
+    return len(keys)
+
+
+def enqueue_release_preview_cache(resource_id):
+    """Enqueue :func:`release_preview_cache` for a resource being deleted
+
+    Called in the web process (`before_resource_delete`). The checksum
+    and the organization are read from the resource itself (no search
+    over other resources), and the check whether other resources share
+    the checksum runs in the background job.
+
+    Returns
+    -------
+    enqueued: bool
+        False if the resource has no checksum
+    """
+    # Import here so the module can be loaded without ckan available
+    import ckan.model as model
+    import ckan.plugins.toolkit as toolkit
+
+    resource = model.Resource.get(resource_id)
+    if resource is None or resource.package is None:
+        return False
+    sha256 = str(resource.extras.get("sha256", ""))
+    owner_org = resource.package.owner_org
+    if len(sha256) != 64 or not owner_org:
+        return False
+    toolkit.enqueue_job(release_preview_cache,
+                        [resource_id, sha256, owner_org],
+                        title=f"Release cached previews of {resource_id}",
+                        queue="dcor-short",
+                        rq_kwargs={"timeout": 300})
+    return True
+
+
+def release_preview_cache(resource_id, sha256, organization_id):
+    """Delete the cached previews of a deleted resource
+
+    The cache entries (all versions) are only deleted if no other
+    active resource of the same organization has the same checksum.
+    This scans the resources of the organization, so it runs as a
+    background job (see :func:`enqueue_release_preview_cache`).
+
+    Parameters
+    ----------
+    resource_id: str
+        resource ID
+    sha256: str
+        SHA256 checksum of the resource
+    organization_id: str
+        ID of the organization (circle) of the resource
+
+    Returns
+    -------
+    num_deleted: int
+        Number of deleted objects
+    """
+    # Import here so the module can be loaded without ckan available
+    import ckan.model as model
+    import sqlalchemy
+
+    shared = (
+        model.Session.query(model.Resource.id)
+        .join(model.Package, model.Package.id == model.Resource.package_id)
+        .filter(model.Package.owner_org == organization_id,
+                model.Package.state != model.State.DELETED,
+                model.Resource.state == model.State.ACTIVE,
+                model.Resource.id != resource_id,
+                sqlalchemy.cast(model.Resource.extras,
+                                sqlalchemy.UnicodeText).contains(sha256))
+        .first()) is not None
+    if shared:
+        return 0
+    return delete_cache_entries(organization_id=organization_id,
+                                sha256=sha256)
+
+
+def copy_preview_from_cache(resource_id, sha256, version, private):
+    """Copy cached preview images to the artifacts of a resource
+
+    Parameters
+    ----------
+    resource_id: str
+        resource ID
+    sha256: str
+        SHA256 checksum of the resource
+    version: str
+        preview version
+    private: bool
+        whether the dataset of the resource is private
+
+    Returns
+    -------
+    hit: bool
+        True if the preview was found in the cache and copied
+    """
+    artifacts = list(PREVIEW_VARIANTS)
+    organization_id = get_organization_id(resource_id)
+    bucket_name, _ = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact=artifacts[-1])
+    cache_bucket_name = get_cache_bucket_name()
+    # The "preview" artifact is stored last (see `store_preview_in_cache`).
+    if not s3.object_exists(
+            bucket_name=cache_bucket_name,
+            object_name=get_cache_object_name(organization_id, sha256,
+                                              version, artifacts[-1])):
+        return False
+    s3_client, _, _ = s3.get_s3()
+    for artifact in artifacts:
+        _, object_name = s3cc.get_s3_bucket_object_for_artifact(
+            resource_id=resource_id, artifact=artifact)
+        try:
+            s3_client.copy_object(
+                Bucket=bucket_name,
+                Key=object_name,
+                CopySource={
+                    "Bucket": cache_bucket_name,
+                    "Key": get_cache_object_name(organization_id, sha256,
+                                                 version, artifact)},
+                # The tags of the cached objects do not apply to the resource
+                TaggingDirective="REPLACE",
+                Tagging="" if private else "public=true",
+            )
+        except s3_client.exceptions.ClientError:
+            # incomplete cache entry, the preview must be rendered
+            return False
+    return True
+
+
+def store_preview_in_cache(resource_id, sha256, version):
+    """Copy the preview artifacts of a resource to the cache
+
+    The artifacts of all variants in
+    :const:`.preview_variants.PREVIEW_VARIANTS` must exist on S3.
+    Cache entries of other preview versions are deleted.
+    """
+    s3_client, _, _ = s3.get_s3()
+    organization_id = get_organization_id(resource_id)
+    cache_bucket_name = get_cache_bucket_name()
+    s3.require_bucket(cache_bucket_name)
+    for artifact in PREVIEW_VARIANTS:
+        bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+            resource_id=resource_id, artifact=artifact)
+        s3_client.copy_object(
+            Bucket=cache_bucket_name,
+            Key=get_cache_object_name(organization_id, sha256, version,
+                                      artifact),
+            CopySource={"Bucket": bucket_name, "Key": object_name},
+            # Cached objects are never public
+            TaggingDirective="REPLACE",
+            Tagging="",
+        )
+    delete_cache_entries(organization_id, sha256, keep_version=version)
@@ -0,0 +1,330 @@
+"""Bounded reading of the data shown in the preview image
+
+Only a subset of the events of the scalar features and a single event
+of the non-scalar features (image, mask, contour, trace) are read from
+the dataset. Memory usage and time required for reading the data
+thus do not depend on the size of the dataset.
+
+The statistics shown in the preview (axis limits and event density)
+are computed in a single vectorized pass over the scalar features
+(see :func:`compute_scatter_statistics`).
+"""
+from collections import OrderedDict
+
+import dclab
+import h5py
+import numpy as np
+
+
+#: Features shown in the scatter plots
+SCATTER_X = "area_um"
+SCATTER_Y = "deform"
+
+#: Fluorescence traces shown in the trace plot (in this order)
+TRACES = ["fl1_raw", "fl2_raw", "fl3_raw"]
+
+#: Strategies for selecting the events shown in the scatter plots
+SAMPLING_STRATEGIES = ["first", "chunks"]
+
+#: Chunk size assumed for features that are not stored in HDF5 chunks
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def get_preview_data(rtdc_ds, size=5000, sampling="first", seed=42,
+                     event_index=47, executor=None):
+    """Read the data required for rendering the preview image
+
+    Parameters
+    ----------
+    rtdc_ds: dclab.rtdc_dataset.core.RTDCBase
+        Full DC dataset
+    size: int
+        Number of events shown in the scatter plots
+    sampling: str
+        Strategy for selecting the events shown in the scatter plots;
+        "first" uses the first `size` events of the dataset, "chunks"
+        uses whole HDF5 chunks distributed over the entire dataset
+        (see :func:`get_chunk_sample_slices`)
+    seed: int
+        Seed for the random selection of chunks
+    event_index: int
+        Index of the event for which image, contour, mask, and traces
+        are shown
+    executor: concurrent.futures.Executor
+        If given, the data of the individual panels (see
+        :const:`PANEL_READERS`) are read concurrently with this
+        executor (e.g. a thread pool, which speeds up reading data
+        via the network and decompressing image data)
+
+    Returns
+    -------
+    data: dict
+        Dictionary with the keys "scatter" (dictionary with the keys
+        "x", "y", "xlabel", "ylabel", "lims" (1st and 99th percentiles
+        as x_start, x_end, y_start, y_end), and "density"), "image",
+        "contour", "mask", "pixel size", "trace" (ordered dictionary
+        of fluorescence traces), and "fltime" (time axis of the traces
+        in µs). Keys for which there are no data in the dataset are
+        not set.
+    """
+    if sampling not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Invalid sampling strategy '{sampling}', "
+                         f"expected one of {SAMPLING_STRATEGIES}")
+    num_events = len(rtdc_ds)
+    data = {}
+    if num_events == 0 or size < 1:
+        return data
+    event_index = min(num_events - 1, size - 1, event_index)
+
+    kwargs = dict(size=size, sampling=sampling, seed=seed,
+                  event_index=event_index)
+    if executor is None:
+        results = [reader(rtdc_ds, **kwargs) for reader in PANEL_READERS]
+    else:
+        futures = [executor.submit(reader, rtdc_ds, **kwargs)
+                   for reader in PANEL_READERS]
+        results = [future.result() for future in futures]
+    for result in results:
+        data.update(result)
+    return data
+
+
+def read_scatter_data(rtdc_ds, size=5000, sampling="first", seed=42,
+                      **kwargs):
+    """Read the events and compute the statistics of the scatter plots
+
+    See :func:`get_preview_data` for the parameters.
+    """
+    if SCATTER_X not in rtdc_ds or SCATTER_Y not in rtdc_ds:
+        return {}
+    num_events = len(rtdc_ds)
+    if sampling == "chunks":
+        slices = get_chunk_sample_slices(
+            num_events=num_events,
+            size=size,
+            chunk_size=get_feature_chunk_size(rtdc_ds, SCATTER_X),
+            seed=seed)
+    else:
+        slices = [slice(0, min(num_events, size))]
+    # Read both features into one contiguous buffer
+    xy = np.empty((2, sum(sl.stop - sl.start for sl in slices)))
+    for ii, feat in enumerate([SCATTER_X, SCATTER_Y]):
+        pos = 0
+        for sl in slices:
+            read_feature_slice(rtdc_ds, feat, sl,
+                               out=xy[ii, pos:pos + sl.stop - sl.start])
+            pos += sl.stop - sl.start
+    lims, density = compute_scatter_statistics(xy)
+    return {"scatter": {
+        "x": xy[0],
+        "y": xy[1],
+        "xlabel": dclab.dfn.get_feature_label(SCATTER_X, rtdc_ds=rtdc_ds),
+        "ylabel": dclab.dfn.get_feature_label(SCATTER_Y, rtdc_ds=rtdc_ds),
+        "lims": lims,
+        "density": density,
+    }}
+
+
+def read_image_data(rtdc_ds, event_index, **kwargs):
+    """Read image and contour of one event"""
+    data = {}
+    if "image" in rtdc_ds:
+        data["image"] = np.asarray(rtdc_ds["image"][event_index])
+        if "contour" in rtdc_ds:
+            data["contour"] = np.asarray(rtdc_ds["contour"][event_index])
+    return data
+
+
+def read_mask_data(rtdc_ds, event_index, **kwargs):
+    """Read the mask of one event"""
+    data = {}
+    if "mask" in rtdc_ds:
+        data["mask"] = np.asarray(rtdc_ds["mask"][event_index])
+        data["pixel size"] = rtdc_ds.config["imaging"]["pixel size"]
+    return data
+
+
+def read_trace_data(rtdc_ds, event_index, **kwargs):
+    """Read the fluorescence traces of one event"""
+    data = {}
+    if "trace" in rtdc_ds:
+        flsamples = rtdc_ds.config["fluorescence"]["samples per event"]
+        flrate = rtdc_ds.config["fluorescence"]["sample rate"]
+        data["fltime"] = np.arange(flsamples) / flrate * 1e6
+        data["trace"] = OrderedDict()
+        for key in TRACES:
+            if key in rtdc_ds["trace"]:
+                data["trace"][key] = np.asarray(
+                    rtdc_ds["trace"][key][event_index])
+    return data
+
+
+#: Functions that read the data of the individual panels of the preview
+#: image; they are independent of each other and may run concurrently
+#: (see :func:`get_preview_data`)
+PANEL_READERS = [read_scatter_data, read_image_data, read_mask_data,
+                 read_trace_data]
+
+
+def compute_scatter_statistics(xy):
+    """Compute axis limits and event density of a scatter plot
+
+    Parameters
+    ----------
+    xy: np.ndarray of shape (2, N)
+        Contiguous buffer with the x and y values of the events
+
+    Returns
+    -------
+    lims: tuple
+        1st and 99th percentiles of the valid events as (x_start,
+        x_end, y_start, y_end)
+    density: np.ndarray of shape (N,)
+        Histogram-based density at the position of each event
+        (NaN for invalid events)
+    """
+    valid = np.all(np.isfinite(xy), axis=0)
+    density = np.full(xy.shape[1], np.nan)
+    if not np.any(valid):
+        return (np.nan,) * 4, density
+    xyv = xy[:, valid]
+    # all quantiles in one call, shape (2 quantiles, 2 features)
+    (x_start, y_start), (x_end, y_end) = np.percentile(xyv, [1, 99], axis=1)
+    density[valid] = histogram_density(xyv)
+    return (x_start, x_end, y_start, y_end), density
+
+
+def get_chunk_sample_slices(num_events, size, chunk_size, seed=42):
+    """Return slices of whole chunks that are spread over a dataset
+
+    Reading random events from an HDF5 file (especially via S3) results
+    in many small reads of scattered chunks. Here, the dataset is divided
+    into as many strata as chunks are needed for `size` events, and one
+    chunk is randomly selected from each stratum. This results in a
+    representative sample with I/O comparable to reading the first
+    `size` events.
+
+    Parameters
+    ----------
+    num_events: int
+        Number of events in the dataset
+    size: int
+        Number of events to select
+    chunk_size: int
+        Number of events per chunk
+    seed: int
+        Seed for the random number generator
+
+    Returns
+    -------
+    slices: list of slice
+        Sorted, non-overlapping slices of the selected chunks with a
+        total length of at most `size` events
+    """
+    size = min(size, num_events)
+    chunk_size = max(1, int(chunk_size))
+    # only consider complete chunks
+    num_chunks = num_events // chunk_size
+    num_needed = int(np.ceil(size / chunk_size))
+    if num_needed >= num_chunks:
+        return [slice(0, size)]
+    rng = np.random.default_rng(seed)
+    bounds = np.linspace(0, num_chunks, num_needed + 1).astype(int)
+    chunks = [rng.integers(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+    slices = []
+    remaining = size
+    for chunk in chunks:
+        start = chunk * chunk_size
+        stop = start + min(chunk_size, remaining)
+        slices.append(slice(start, stop))
+        remaining -= stop - start
+    return slices
+
+
+def get_feature_chunk_size(rtdc_ds, feat):
+    """Return the number of events per HDF5 chunk of a scalar feature"""
+    h5ds = getattr(rtdc_ds[feat], "h5ds", None)
+    if isinstance(h5ds, h5py.Dataset) and h5ds.chunks:
+        chunk_size = h5ds.chunks[0]
+    else:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    return chunk_size
+
+
+def get_preview_data_nbytes(data):
+    """Return the number of bytes of the arrays in the preview data"""
+    nbytes = 0
+    for value in data.values():
+        if isinstance(value, dict):
+            nbytes += get_preview_data_nbytes(value)
+        elif isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+    return nbytes
+
+
+def histogram_density(xyv):
+    """Vectorized histogram-based density estimate of 2D events
+
+    This is a numpy-only variant of
+    :func:`dclab.kde_methods.kde_histogram`: The events are binned
+    (number of bins from Doane's formula) and the density at each event
+    is linearly interpolated between the centers of the bins.
+
+    Parameters
+    ----------
+    xyv: np.ndarray of shape (2, N)
+        x and y values of the events (finite values only)
+    """
+    num = xyv.shape[1]
+    if num > 2:
+        # Doane's formula for both features at once
+        dev = xyv - np.mean(xyv, axis=1, keepdims=True)
+        var = np.mean(dev**2, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            skew = np.nan_to_num(np.mean(dev**3, axis=1) / var**1.5)
+        sigma_skew = np.sqrt(6 * (num - 2) / ((num + 1) * (num + 3)))
+        bins = 1 + np.log2(num) + np.log2(1 + np.abs(skew) / sigma_skew)
+        bins = np.maximum(5, np.round(bins)).astype(int)
+    else:
+        bins = np.array([5, 5])
+
+    hist, xedges, yedges = np.histogram2d(xyv[0], xyv[1],
+                                          bins=bins, density=True)
+    # lower bin index and interpolation weight of each event
+    coords = []
+    for values, edges in [(xyv[0], xedges), (xyv[1], yedges)]:
+        pos = (values - edges[0]) / (edges[1] - edges[0]) - 0.5
+        pos = np.clip(pos, 0, edges.size - 2)
+        idx = np.minimum(pos.astype(int), edges.size - 3)
+        coords.append((idx, pos - idx))
+    (ix, wx), (iy, wy) = coords
+    return ((1 - wx) * (1 - wy) * hist[ix, iy]
+            + wx * (1 - wy) * hist[ix + 1, iy]
+            + (1 - wx) * wy * hist[ix, iy + 1]
+            + wx * wy * hist[ix + 1, iy + 1])
+
+
+def read_feature_slice(rtdc_ds, feat, index, out=None):
+    """Read a slice of a scalar feature without loading the full feature
+
+    Indexing scalar features of HDF5-based datasets in dclab loads
+    (and caches) the entire feature. Here, the underlying HDF5 dataset
+    is accessed directly if possible, so only the chunks containing
+    the requested events are read.
+
+    If `out` (a float array with the length of the slice) is given,
+    the values are written directly into `out`.
+    """
+    obj = rtdc_ds[feat]
+    h5ds = getattr(obj, "h5ds", None)
+    if out is None:
+        if isinstance(h5ds, h5py.Dataset):
+            values = h5ds[index]
+        else:
+            values = obj[index]
+        out = np.array(values, dtype=float)
+    elif isinstance(h5ds, h5py.Dataset) and out.flags.c_contiguous:
+        h5ds.read_direct(out, source_sel=index)
+    else:
+        out[:] = obj[index]
+    return out
@@ -0,0 +1,111 @@
+"""Image variants of the preview that are stored as separate S3 artifacts
+
+The preview image is rendered once and then encoded in several sizes
+and formats. WebP images are considerably smaller than JPEG images
+of the same quality; the JPEG variants serve as a fallback for clients
+that do not support WebP.
+"""
+from collections import OrderedDict
+import io
+import pathlib
+
+from PIL import Image
+
+
+#: Width of the thumbnail variants in pixels (the full preview is
+#: 320 pixels wide, see :const:`.raster.WIDTH`)
+THUMBNAIL_WIDTH = 160
+
+#: Preview variants as artifact name -> (file name, maximum width in
+#: pixels or None for full size, image format). The "preview" artifact
+#: is the full-size JPEG known from previous versions. It is uploaded
+#: last, so its existence implies that all other variants exist.
+PREVIEW_VARIANTS = OrderedDict([
+    ("preview_thumb_webp", ("preview_thumb.webp", THUMBNAIL_WIDTH, "WEBP")),
+    ("preview_webp", ("preview.webp", None, "WEBP")),
+    ("preview_thumb", ("preview_thumb.jpg", THUMBNAIL_WIDTH, "JPEG")),
+    ("preview", ("preview.jpg", None, "JPEG")),
+])
+
+#: Keyword arguments for :func:`PIL.Image.Image.save` for each format
+SAVE_KWARGS = {
+    "JPEG": {"quality": 75, "optimize": True, "progressive": True},
+    "WEBP": {"quality": 80, "method": 4},
+}
+
+#: Value of the "Cache-Control" header of the preview images on S3
+#: (regenerated previews are picked up by browsers within one day)
+CACHE_CONTROL = "max-age=86400"
+
+#: MIME type of each format (stored as content type on S3)
+CONTENT_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+#: Name and file name of the scatter histogram artifact (see
+#: :mod:`.scatter_histogram`), defined here so that the web server
+#: does not import the data reading code
+SCATTER_HISTOGRAM_ARTIFACT = "scatter_histogram"
+SCATTER_HISTOGRAM_FILE_NAME = "scatter_histogram.npz"
+#: Number of bins per axis of the finest and of the coarsest level of
+#: the scatter histogram
+SCATTER_HISTOGRAM_MAX_BINS = 512
+SCATTER_HISTOGRAM_MIN_BINS = 16
+
+
+def resize_to_width(img, width):
+    """Return a copy of `img` downscaled to `width` (keeping the aspect)"""
+    if width is None or img.width <= width:
+        return img
+    height = max(1, round(img.height * width / img.width))
+    return img.resize((width, height), resample=Image.LANCZOS)
+
+
+def encode_preview_variants(img):
+    """Encode all variants of a preview image in memory
+
+    Parameters
+    ----------
+    img: PIL.Image.Image
+        Full-size RGB preview image
+
+    Returns
+    -------
+    data: collections.OrderedDict
+        Artifact name -> encoded image (bytes) of the variant (in the
+        order of :const:`PREVIEW_VARIANTS`)
+    """
+    data = OrderedDict()
+    resized = {}
+    for artifact, (_, width, fmt) in PREVIEW_VARIANTS.items():
+        if width not in resized:
+            resized[width] = resize_to_width(img, width)
+        buffer = io.BytesIO()
+        resized[width].save(buffer, format=fmt, **SAVE_KWARGS[fmt])
+        data[artifact] = buffer.getvalue()
+    return data
+
+
+def save_preview_variants(img, path_dir):
+    """Save all variants of a preview image to a directory
+
+    Parameters
+    ----------
+    img: PIL.Image.Image
+        Full-size RGB preview image
+    path_dir: str or pathlib.Path
+        Output directory
+
+    Returns
+    -------
+    paths: collections.OrderedDict
+        Artifact name -> path of the variant (in the order of
+        :const:`PREVIEW_VARIANTS`)
+    """
+    path_dir = pathlib.Path(path_dir)
+    paths = OrderedDict()
+    for artifact, data in encode_preview_variants(img).items():
+        paths[artifact] = path_dir / PREVIEW_VARIANTS[artifact][0]
+        paths[artifact].write_bytes(data)
+    return paths
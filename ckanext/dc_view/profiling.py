@@ -0,0 +1,105 @@
+"""On-demand profiling of the background jobs and the CLI
+
+Profiling is enabled by setting a profile directory, either via the
+environment variable "CKANEXT_DC_VIEW_PROFILE_DIR" or via the CKAN
+configuration option "ckanext.dc_view.profile_dir" (the environment
+variable takes precedence). For each profiled call, the cProfile
+statistics are written to "<name>_<time>_<pid>.prof" in that directory
+(inspect with e.g. `python -m pstats` or `snakeviz`).
+
+If, in addition, "CKANEXT_DC_VIEW_PROFILE_TRACEMALLOC" or
+"ckanext.dc_view.profile_tracemalloc" is set to "true", a
+:mod:`tracemalloc` snapshot is written to "<name>_<time>_<pid>.tracemalloc"
+(load with :func:`tracemalloc.Snapshot.load`).
+"""
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import pathlib
+import time
+import tracemalloc
+
+from dcor_shared import get_ckan_config_option
+
+
+log = logging.getLogger(__name__)
+
+#: Whether a profiler is currently running in this process (profiles
+#: are not nested, e.g. jobs run by a profiled CLI sweep)
+_active = False
+
+
+def get_profile_settings():
+    """Return the profile directory and whether to trace memory
+
+    Returns
+    -------
+    path_dir: pathlib.Path or None
+        Output directory for profiles; None if profiling is disabled
+    trace_memory: bool
+        Whether to take a tracemalloc snapshot
+    """
+    path_dir = os.environ.get("CKANEXT_DC_VIEW_PROFILE_DIR")
+    if not path_dir:
+        path_dir = get_ckan_config_option("ckanext.dc_view.profile_dir")
+    trace_memory = os.environ.get("CKANEXT_DC_VIEW_PROFILE_TRACEMALLOC")
+    if trace_memory is None:
+        trace_memory = get_ckan_config_option(
+            "ckanext.dc_view.profile_tracemalloc")
+    trace_memory = str(trace_memory).strip().lower() in ["true", "1", "yes"]
+    return (pathlib.Path(path_dir) if path_dir else None), trace_memory
+
+
+@contextlib.contextmanager
+def profile(name, path_dir, trace_memory=False):
+    """Profile the code executed in this context
+
+    Parameters
+    ----------
+    name: str
+        Name used as prefix of the profile files
+    path_dir: str or pathlib.Path
+        Output directory; if None, nothing is profiled
+    trace_memory: bool
+        Whether to additionally write a tracemalloc snapshot
+    """
+    global _active
+    if path_dir is None or _active:
+        yield
+        return
+    path_dir = pathlib.Path(path_dir)
+    path_dir.mkdir(parents=True, exist_ok=True)
+    stem = f"{name}_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}"
+    _active = True
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _active = False
+        profiler.dump_stats(path_dir / f"{stem}.prof")
+        if trace_memory:
+            tracemalloc.take_snapshot().dump(
+                str(path_dir / f"{stem}.tracemalloc"))
+            tracemalloc.stop()
+        log.info(f"Wrote profile {path_dir / stem}")
+
+
+def profiled(func):
+    """Decorator for profiling a background job if enabled
+
+    The profile files are named after the job and the resource ID.
+    """
+    @functools.wraps(func)
+    def wrapper(resource, *args, **kwargs):
+        path_dir, trace_memory = get_profile_settings()
+        with profile(name=f"{func.__name__}_{resource['id']}",
+                     path_dir=path_dir,
+                     trace_memory=trace_memory):
+            return func(resource, *args, **kwargs)
+    return wrapper
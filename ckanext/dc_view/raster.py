@@ -0,0 +1,448 @@
+"""Fast rendering of the preview image with numpy and Pillow
+
+The functions in this module produce the same layout as
+:func:`ckanext.dc_view.jobs.overview_plot`, but without the overhead
+of building a matplotlib figure. The scatter plots are rasterized via
+vectorized binning of the event positions into pixels and all other
+elements are drawn directly with Pillow.
+
+Like in the matplotlib version, the contrast of the event image is
+stretched to the full gray range and the KDE colorbar has tick labels.
+The remaining differences are cosmetic: a bitmap font is used, the
+markers are single pixels instead of antialiased circles, and the tick
+positions and label offsets are not computed by the matplotlib locators.
+"""
+from collections import OrderedDict
+import functools
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from .preview_data import get_preview_data
+
+
+#: Resolution of the preview image (same as `savefig(dpi=80)`)
+DPI = 80
+#: Width of the preview image in pixels (4 inches)
+WIDTH = 4 * DPI
+#: Height of one panel height unit in pixels (1.5 inches)
+UNIT_HEIGHT = int(1.5 * DPI)
+
+#: Margins around the axes of a panel (left, top, right, bottom)
+MARGINS = (52, 16, 10, 30)
+#: Additional space on the right of the KDE panel for the colorbar
+#: (strip, tick labels, and label)
+COLORBAR_SPACE = 56
+
+#: Viridis colormap anchors (interpolated to a 256-color lookup table)
+VIRIDIS_ANCHORS = np.array([
+    [68, 1, 84],
+    [71, 44, 122],
+    [59, 82, 139],
+    [44, 113, 142],
+    [33, 145, 140],
+    [39, 173, 129],
+    [92, 200, 99],
+    [170, 220, 50],
+    [253, 231, 37],
+], dtype=float)
+
+VIRIDIS_LUT = np.stack(
+    [np.interp(np.linspace(0, 1, 256),
+               np.linspace(0, 1, len(VIRIDIS_ANCHORS)),
+               VIRIDIS_ANCHORS[:, ii]) for ii in range(3)],
+    axis=1).astype(np.uint8)
+
+TRACE_COLORS = OrderedDict([
+    ("fl1_raw", (0x15, 0xBF, 0x00)),
+    ("fl2_raw", (0xBF, 0x8A, 0x00)),
+    ("fl3_raw", (0xBF, 0x0C, 0x00)),
+])
+
+
+def overview_raster(rtdc_ds, data=None, executor=None):
+    """Raster version of :func:`ckanext.dc_view.jobs.overview_plot`
+
+    Parameters
+    ----------
+    rtdc_ds: dclab.rtdc_dataset.core.RTDCBase
+        Full DC dataset to plot
+    data: dict
+        Data to plot as returned by
+        :func:`.preview_data.get_preview_data`; read from `rtdc_ds`
+        with the default settings if not given
+    executor: concurrent.futures.Executor
+        If given, the data are read and the panels are drawn
+        concurrently with this executor (see :func:`compose_panels`)
+
+    Returns
+    -------
+    image: PIL.Image.Image
+        RGB preview image
+    """
+    if data is None:
+        data = get_preview_data(rtdc_ds, executor=executor)
+
+    panels = []
+    if "scatter" in data:
+        scatter = data["scatter"]
+        kwargs = dict(x=scatter["x"], y=scatter["y"], lims=scatter["lims"],
+                      xlabel=scatter["xlabel"], ylabel=scatter["ylabel"])
+        panels.append((2, draw_scatter_basic, kwargs))
+        panels.append((2, draw_scatter_kde,
+                       dict(density=scatter["density"], **kwargs)))
+
+    if "image" in data:
+        panels.append((1, draw_event_image,
+                       dict(image=data["image"],
+                            contour=data.get("contour"))))
+
+    if "mask" in data:
+        panels.append((1, draw_event_mask,
+                       dict(mask=data["mask"],
+                            pixel_size=data["pixel size"])))
+
+    if "trace" in data:
+        panels.append((2, draw_traces,
+                       dict(fltime=data["fltime"],
+                            traces=data["trace"])))
+
+    return compose_panels(panels, executor=executor)
+
+
+def compose_panels(panels, executor=None):
+    """Stack the given panels vertically into one RGB image
+
+    Each panel is drawn on a separate image, which allows drawing the
+    panels concurrently. The panel images are then pasted into the
+    final image.
+
+    Parameters
+    ----------
+    panels: list of tuple
+        Each item consists of the height ratio of the panel, the function
+        that draws the panel, and the keyword arguments for that function.
+        The drawing function is called with the keyword arguments `img`
+        (the :class:`PIL.Image.Image` to draw on) and `box` (the pixel
+        bounding box `(x0, y0, x1, y1)` of the panel).
+    executor: concurrent.futures.Executor
+        If given, the panels are drawn concurrently with this executor
+    """
+    if not panels:
+        # empty plot
+        return Image.new("RGB", (WIDTH, WIDTH), "white")
+
+    if executor is None:
+        panel_images = [draw_panel(*panel) for panel in panels]
+    else:
+        futures = [executor.submit(draw_panel, *panel) for panel in panels]
+        panel_images = [future.result() for future in futures]
+
+    height = sum(p.size[1] for p in panel_images)
+    img = Image.new("RGB", (WIDTH, height), "white")
+    y0 = 0
+    for panel_img in panel_images:
+        img.paste(panel_img, (0, y0))
+        y0 += panel_img.size[1]
+    return img
+
+
+def draw_panel(ratio, func, kwargs):
+    """Draw one panel (see :func:`compose_panels`) on a new image"""
+    height = ratio * UNIT_HEIGHT
+    img = Image.new("RGB", (WIDTH, height), "white")
+    func(img=img, box=(0, 0, WIDTH, height), **kwargs)
+    return img
+
+
+def draw_scatter_basic(img, box, x, y, lims, xlabel, ylabel):
+    """Draw a black scatter plot with 20% opacity per event"""
+    draw = ImageDraw.Draw(img)
+    ax = draw_axes(img, box, title="Basic scatter plot",
+                   xlim=lims[:2], ylim=lims[2:],
+                   xlabel=xlabel, ylabel=ylabel)
+    w = ax[2] - ax[0]
+    h = ax[3] - ax[1]
+    lin, _ = marker_pixels(ax, x, y, lims)
+    counts = np.bincount(lin, minlength=w * h).reshape(h, w)
+    layer = (255 * 0.8 ** counts).astype(np.uint8)
+    img.paste(Image.fromarray(layer).convert("RGB"), (ax[0], ax[1]))
+    draw_frame(draw, ax)
+
+
+def draw_scatter_kde(img, box, x, y, density, lims, xlabel, ylabel):
+    """Draw a scatter plot colored by the density of the events"""
+    draw = ImageDraw.Draw(img)
+    x0, y0, x1, y1 = box
+    ax = draw_axes(img, (x0, y0, x1 - COLORBAR_SPACE, y1),
+                   title="KDE scatter plot",
+                   xlim=lims[:2], ylim=lims[2:],
+                   xlabel=xlabel, ylabel=ylabel)
+    density = np.asarray(density, dtype=float)
+    dmin = np.nanmin(density)
+    dptp = np.nanmax(density) - dmin
+    if dptp == 0:
+        dptp = 1
+    cidx = np.nan_to_num((density - dmin) / dptp * 255).astype(np.intp)
+    w = ax[2] - ax[0]
+    h = ax[3] - ax[1]
+    lin, index = marker_pixels(ax, x, y, lims)
+    cidx = cidx[index]
+    # Events are drawn in order; keep the last event for each pixel.
+    lin_rev = lin[::-1]
+    uidx, first = np.unique(lin_rev, return_index=True)
+    layer = np.full((h * w, 3), 255, dtype=np.uint8)
+    layer[uidx] = VIRIDIS_LUT[cidx[::-1][first]]
+    img.paste(Image.fromarray(layer.reshape(h, w, 3)), (ax[0], ax[1]))
+    draw_frame(draw, ax)
+    # colorbar
+    cb = (ax[2] + 6, ax[1], ax[2] + 14, ax[3])
+    gradient = VIRIDIS_LUT[np.linspace(255, 0, cb[3] - cb[1]).astype(int)]
+    strip = np.repeat(gradient[:, np.newaxis, :], cb[2] - cb[0], axis=1)
+    img.paste(Image.fromarray(strip), (cb[0], cb[1]))
+    draw_frame(draw, cb)
+    font = get_font()
+    label_width = 0
+    for tick in nice_ticks(dmin, dmin + dptp):
+        ty = cb[3] - (tick - dmin) / dptp * (cb[3] - cb[1])
+        draw.line([(cb[2], ty), (cb[2] + 3, ty)], fill="black")
+        label = f"{tick:g}"
+        label_width = max(label_width, draw.textlength(label, font=font))
+        draw.text((cb[2] + 5, ty - 6), label, fill="black", font=font)
+    draw_text_vertical(img,
+                       (cb[2] + 7 + int(np.ceil(label_width)),
+                        (cb[1] + cb[3]) // 2),
+                       "kernel density [a.u]")
+
+
+def draw_event_image(img, box, image, contour=None):
+    """Draw the event image and overlay the contour in red
+
+    The gray values are stretched to the full range like `imshow` does.
+    """
+    draw = ImageDraw.Draw(img)
+    image = normalize_image(image)
+    ih, iw = image.shape
+    ax = draw_axes(img, box, title="Event image with contour",
+                   xlim=(0, iw), ylim=(ih, 0),
+                   xlabel="Detector X [px]", ylabel="Detector Y [px]",
+                   aspect=ih / iw)
+    scale = paste_array(img, ax, image)
+    if contour is not None:
+        cpts = [(ax[0] + (cx + .5) * scale, ax[1] + (cy + .5) * scale)
+                for cx, cy in np.asarray(contour)]
+        draw.line(cpts, fill=(255, 0, 0), width=1)
+    draw_frame(draw, ax)
+
+
+def normalize_image(image):
+    """Scale an image linearly from its min/max to 0..255 (uint8)
+
+    This is the normalization applied by `imshow` with the default
+    `vmin` and `vmax` (a constant image becomes black).
+    """
+    image = np.asarray(image, dtype=float)
+    vmin = np.nanmin(image)
+    vptp = np.nanmax(image) - vmin
+    if vptp == 0:
+        return np.zeros(image.shape, dtype=np.uint8)
+    scaled = np.nan_to_num((image - vmin) / vptp * 256)
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def draw_event_mask(img, box, mask, pixel_size):
+    """Draw the event mask with axes in µm"""
+    draw = ImageDraw.Draw(img)
+    mask = np.asarray(mask)
+    mh, mw = mask.shape
+    ax = draw_axes(img, box, title="Event mask",
+                   xlim=(0, mw * pixel_size), ylim=(0, mh * pixel_size),
+                   xlabel="Detector X [µm]", ylabel="Detector Y [µm]",
+                   aspect=mh / mw)
+    paste_array(img, ax, mask.astype(np.uint8) * 255)
+    draw_frame(draw, ax)
+
+
+def draw_traces(img, box, fltime, traces):
+    """Draw the fluorescence traces of an event"""
+    draw = ImageDraw.Draw(img)
+    if traces:
+        ymin = min(np.min(t) for t in traces.values())
+        ymax = max(np.max(t) for t in traces.values())
+    else:
+        ymin, ymax = 0, 1
+    margin = (ymax - ymin) * .05 or 1
+    ylim = (ymin - margin, ymax + margin)
+    xlim = (0, fltime[-1])
+    ax = draw_axes(img, box, title="Fluorescence traces",
+                   xlim=xlim, ylim=ylim,
+                   xlabel="Event time [µs]", ylabel="Fluorescence [a.u.]")
+    lims = xlim + ylim
+    ly = ax[1] + 4
+    for key, trace in traces.items():
+        color = TRACE_COLORS[key]
+        px, py = data_to_pixels(ax, fltime, trace, lims, clip=False)
+        draw.line(list(zip((px + ax[0]).tolist(), (py + ax[1]).tolist())),
+                  fill=color, width=1)
+        # legend entry
+        lx = ax[2] - 62
+        draw.line([(lx, ly + 6), (lx + 12, ly + 6)], fill=color, width=2)
+        draw.text((lx + 16, ly), key, fill="black", font=get_font())
+        ly += 12
+    draw_frame(draw, ax)
+
+
+def draw_axes(img, box, title, xlim, ylim, xlabel, ylabel, aspect=None):
+    """Draw title, ticks, and labels of a panel and return the axes box
+
+    If `aspect` (height/width) is given, the axes are shrunk such that
+    the pixel aspect ratio is preserved.
+    """
+    draw = ImageDraw.Draw(img)
+    x0, y0, x1, y1 = box
+    ml, mt, mr, mb = MARGINS
+    ax = [x0 + ml, y0 + mt, x1 - mr, y1 - mb]
+    if aspect is not None:
+        w = ax[2] - ax[0]
+        h = ax[3] - ax[1]
+        if h / w > aspect:
+            ax[3] = ax[1] + int(round(w * aspect))
+        else:
+            ax[2] = ax[0] + int(round(h / aspect))
+    font = get_font()
+    # title
+    tw = draw.textlength(title, font=font)
+    draw.text(((ax[0] + ax[2] - tw) / 2, y0 + 2), title,
+              fill="black", font=font)
+    # x ticks
+    for tick in nice_ticks(*xlim):
+        tx = ax[0] + (tick - xlim[0]) / (xlim[1] - xlim[0]) * (ax[2] - ax[0])
+        draw.line([(tx, ax[3]), (tx, ax[3] + 3)], fill="black")
+        label = f"{tick:g}"
+        lw = draw.textlength(label, font=font)
+        draw.text((tx - lw / 2, ax[3] + 4), label, fill="black", font=font)
+    # y ticks
+    for tick in nice_ticks(*ylim):
+        ty = ax[3] - (tick - ylim[0]) / (ylim[1] - ylim[0]) * (ax[3] - ax[1])
+        draw.line([(ax[0] - 3, ty), (ax[0], ty)], fill="black")
+        label = f"{tick:g}"
+        lw = draw.textlength(label, font=font)
+        draw.text((ax[0] - 5 - lw, ty - 6), label, fill="black", font=font)
+    # axis labels
+    xw = draw.textlength(xlabel, font=font)
+    draw.text(((ax[0] + ax[2] - xw) / 2, ax[3] + 16), xlabel,
+              fill="black", font=font)
+    draw_text_vertical(img, (x0 + 2, (ax[1] + ax[3]) // 2), ylabel)
+    return tuple(ax)
+
+
+def draw_frame(draw, ax):
+    """Draw a black frame around the axes box `ax`"""
+    draw.rectangle(ax, outline="black", width=1)
+
+
+def draw_text_vertical(img, anchor, text):
+    """Draw text rotated by 90° centered vertically at `anchor`"""
+    font = get_font()
+    draw = ImageDraw.Draw(img)
+    tw = int(np.ceil(draw.textlength(text, font=font)))
+    timg = Image.new("L", (tw, 12), 0)
+    ImageDraw.Draw(timg).text((0, 0), text, fill=255, font=font)
+    timg = timg.rotate(90, expand=True)
+    ax, ay = anchor
+    img.paste((0, 0, 0), (ax, ay - timg.size[1] // 2), mask=timg)
+
+
+def data_to_pixels(ax, x, y, lims, clip=True, ret_valid=False):
+    """Convert data coordinates to integer pixel positions within `ax`
+
+    If `clip` is True, events outside of the axes limits are removed.
+    The pixel positions are given relative to the top left corner of
+    the axes box.
+    """
+    x0, x1, y0, y1 = lims
+    w = ax[2] - ax[0]
+    h = ax[3] - ax[1]
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    px = np.floor((x - x0) / (x1 - x0) * w).astype(np.intp)
+    py = np.floor((y1 - y) / (y1 - y0) * h).astype(np.intp)
+    valid = np.ones(px.size, dtype=bool)
+    if clip:
+        valid = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+        px = px[valid]
+        py = py[valid]
+    if ret_valid:
+        return px, py, valid
+    return px, py
+
+
+@functools.lru_cache()
+def get_font():
+    """Return the font used for all labels
+
+    DejaVu Sans (the matplotlib default) is used if it is installed,
+    since Pillow's default font does not support characters such as "µ".
+    """
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", 10)
+    except OSError:
+        font = ImageFont.load_default()
+    return font
+
+
+def marker_pixels(ax, x, y, lims):
+    """Return the linear pixel indices covered by the scatter markers
+
+    Each marker is two by two pixels large. The pixels of one marker
+    are contiguous in the returned arrays, so that the original drawing
+    order of the events is preserved.
+
+    Returns
+    -------
+    lin: 1d ndarray
+        Linear pixel index (row-major) relative to the axes box
+    index: 1d ndarray
+        Event index for each entry in `lin`
+    """
+    w = ax[2] - ax[0]
+    h = ax[3] - ax[1]
+    px, py, valid = data_to_pixels(ax, x, y, lims, ret_valid=True)
+    index = np.repeat(np.where(valid)[0], 4)
+    px = np.stack([px, px + 1, px, px + 1], axis=1).ravel()
+    py = np.stack([py, py, py + 1, py + 1], axis=1).ravel()
+    inside = (px < w) & (py < h)
+    return (py * w + px)[inside], index[inside]
+
+
+def nice_ticks(vmin, vmax, num=4):
+    """Return tick positions at round numbers between `vmin` and `vmax`"""
+    lo, hi = sorted([vmin, vmax])
+    span = hi - lo
+    if not np.isfinite(span) or span <= 0:
+        return []
+    raw = span / num
+    mag = 10 ** np.floor(np.log10(raw))
+    for mult in [1, 2, 2.5, 5, 10]:
+        step = mult * mag
+        if span / step <= num:
+            break
+    first = np.ceil(lo / step) * step
+    ticks = np.arange(first, hi + step * 1e-9, step)
+    # avoid values such as "-0" and floating point noise
+    return [float(f"{t:.6g}") + 0.0 for t in ticks]
+
+
+def paste_array(img, ax, array):
+    """Scale a 2D uint8 array to fit the axes box and paste it
+
+    Returns the scaling factor from array to pixel coordinates.
+    """
+    h, w = array.shape
+    aw = ax[2] - ax[0]
+    scale = aw / w
+    ah = max(1, int(round(h * scale)))
+    layer = Image.fromarray(np.asarray(array, dtype=np.uint8))
+    layer = layer.resize((aw, ah), resample=Image.NEAREST)
+    img.paste(layer.convert("RGB"), (ax[0], ax[1]))
+    return scale
@@ -1,13 +1,46 @@
+import hashlib
+import time
+
 from ckan.common import current_user
 from ckan import logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
+from flask import Response, request
+
+from dcor_shared import get_ckan_config_option, s3, s3cc
+
+from .artifact_index import (
+    get_artifact_object_name, get_bucket_name_for_organization
+)
+from .cache import MISSING, TTLCache
+from .preview_variants import (
+    PREVIEW_VARIANTS, SCATTER_HISTOGRAM_ARTIFACT, SCATTER_HISTOGRAM_FILE_NAME
+)
+
 
-from dcor_shared import s3, s3cc
+#: Lifetime of cached presigned URLs relative to their expiration time.
+#: The presigned URLs from :func:`dcor_shared.s3.create_presigned_url`
+#: are valid for at least 90% of the requested expiration time.
+PRESIGNED_URL_CACHE_FRACTION = 0.25
+#: Lifetime of cached negative existence checks in seconds (the preview
+#: might be created by a background job in the meantime)
+MISSING_PREVIEW_CACHE_TTL = 60
+#: Fraction of the remaining lifetime of a presigned URL for which
+#: browsers may cache the redirect to that URL
+REDIRECT_MAX_AGE_FRACTION = 0.5
 
+#: File names of the artifacts served by :func:`dcpreview`
+ARTIFACT_FILE_NAMES = dict(
+    {variant: val[0] for variant, val in PREVIEW_VARIANTS.items()},
+    **{SCATTER_HISTOGRAM_ARTIFACT: SCATTER_HISTOGRAM_FILE_NAME})
 
-def dcpreview(ds_id, res_id):
-    """Redirect to a preview image on S3 for a DC resource
+#: Cache for preview URLs, keyed by resource ID, privacy level, and
+#: preview variant (None is stored if the preview does not exist)
+preview_url_cache = TTLCache(maxsize=4096)
+
+
+def dcpreview(ds_id, res_id, variant="preview"):
+    """Redirect to a preview image (or another preview artifact) on S3
 
     Parameters
     ----------
@@ -15,42 +48,183 @@ def dcpreview(ds_id, res_id):
         dataset ID
     res_id: str
         resource ID for which to return the preview image
+    variant: str
+        preview variant (artifact name, see
+        :const:`.preview_variants.PREVIEW_VARIANTS`) or
+        "scatter_histogram" (see :mod:`.scatter_histogram`); if a
+        preview variant does not exist (previews created by older
+        versions), the full-size JPEG preview is returned instead
     """
     # Code borrowed from ckan/controllers/package.py:resource_download
     context = {'model': model, 'session': model.Session,
                'user': current_user.name, 'auth_user_obj': current_user}
     did = str(ds_id)
     rid = str(res_id)
+    # We only need the name of the resource, its `s3_available` flag and
+    # the `private` flag of the dataset. Instead of calling the
+    # `resource_show` and `package_show` actions, which build the full
+    # dataset dictionary (including all resources), we access the database
+    # models directly and only run the authorization functions.
+    resource = model.Resource.get(rid)
     try:
-        res_dict = toolkit.get_action('resource_show')(context, {'id': rid})
-        ds_dict = toolkit.get_action('package_show')(context, {'id': did})
+        if resource is None or resource.state != model.State.ACTIVE:
+            raise logic.NotFound()
+        # The `private` flag and the authorization are taken from the
+        # dataset of the resource, which must be the dataset in the URL.
+        dataset = resource.package
+        if dataset is None or dataset.id != did:
+            raise logic.NotFound()
+        toolkit.check_access('resource_show', context, {'id': rid})
+        toolkit.check_access('package_show', context, {'id': dataset.id})
     except (logic.NotFound, logic.NotAuthorized):
         # Treat not found and not authorized equally, to not leak information
         # to unprivileged users.
         return toolkit.abort(404, toolkit._('Resource not found'))
 
-    res_stem = res_dict["name"].rsplit(".", 1)[0]
-    prev_name = f"{res_stem}_preview.jpg"
+    if s3.is_available() and resource.extras.get('s3_available'):
+        ps_url = get_preview_url(resource_id=rid,
+                                 resource_name=resource.name,
+                                 private=dataset.private,
+                                 variant=variant,
+                                 ret_expiration=True)
+        if ps_url is None and variant in PREVIEW_VARIANTS \
+                and variant != "preview":
+            ps_url = get_preview_url(resource_id=rid,
+                                     resource_name=resource.name,
+                                     private=dataset.private,
+                                     ret_expiration=True)
+        if ps_url is not None:
+            return make_preview_response(*ps_url, private=dataset.private)
+
+    return toolkit.abort(404, toolkit._('No preview available'))
+
+
+def make_preview_response(ps_url, expires_at, private):
+    """Return a cacheable redirect to a presigned preview URL
+
+    The redirect may be cached by the browser (and, for public
+    datasets, by proxies) for a fraction of the remaining lifetime of
+    the presigned URL (see :const:`REDIRECT_MAX_AGE_FRACTION`). The
+    ETag is derived from the presigned URL, so conditional requests
+    are answered with "304 Not Modified" as long as the cached
+    presigned URL is valid.
+
+    Parameters
+    ----------
+    ps_url: str
+        Presigned URL
+    expires_at: int
+        Expiration time of `ps_url` (seconds since epoch)
+    private: bool
+        whether the dataset of the resource is private
+    """
+    etag = hashlib.sha256(ps_url.encode("utf-8")).hexdigest()[:32]
+    max_age = max(0, int((expires_at - time.time())
+                         * REDIRECT_MAX_AGE_FRACTION))
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = toolkit.redirect_to(ps_url)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = \
+        f"{'private' if private else 'public'}, max-age={max_age}"
+    return response
+
 
-    if s3.is_available() and res_dict.get('s3_available'):
+def get_preview_url(resource_id, resource_name, private, variant="preview",
+                    ret_expiration=False):
+    """Return a presigned URL to the preview image on S3 (cached)
+
+    Parameters
+    ----------
+    resource_id: str
+        resource ID
+    resource_name: str
+        resource name (used for the filename of the preview image)
+    private: bool
+        whether the dataset of the resource is private
+    variant: str
+        preview variant (artifact name, see :const:`ARTIFACT_FILE_NAMES`)
+    ret_expiration: bool
+        Return the expiration time of the presigned URL as well
+
+    Returns
+    -------
+    ps_url: str or None
+        Presigned URL or None if there is no preview image on S3
+    expires_at: int, optional
+        Expiration time of the presigned URL (seconds since epoch)
+    """
+    key = (resource_id, private, variant)
+    item = preview_url_cache.get(key, default=MISSING)
+    if item is MISSING:
         # check if the corresponding S3 object exists
-        if s3cc.artifact_exists(resource_id=rid, artifact="preview"):
-            # We have an S3 object that we can redirect to. We are making use
-            # of presigned URLs to be able to specify a filename for download
-            # (otherwise, users that download via the web interface will
-            # just get a hash as a file name without any suffix or human-
-            # readable identifier).
-            if ds_dict["private"]:
+        if s3cc.artifact_exists(resource_id=resource_id, artifact=variant):
+            # We have an S3 object that we can redirect to. We are making
+            # use of presigned URLs to be able to specify a filename for
+            # download (otherwise, users that download via the web
+            # interface will just get a hash as a file name without any
+            # suffix or human-readable identifier).
+            if private:
                 expiration = 3600
             else:
                 expiration = 86400
-            bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
-                resource_id=rid, artifact="preview")
-            ps_url = s3.create_presigned_url(
+            res_stem = resource_name.rsplit(".", 1)[0]
+            file_name = ARTIFACT_FILE_NAMES[variant]
+            bucket_name, object_name = \
+                s3cc.get_s3_bucket_object_for_artifact(
+                    resource_id=resource_id, artifact=variant)
+            # (presigned URL, expiration time)
+            item = s3.create_presigned_url(
                 bucket_name=bucket_name,
                 object_name=object_name,
-                filename=prev_name,
-                expiration=expiration)
-            return toolkit.redirect_to(ps_url)
+                filename=f"{res_stem}_{file_name}",
+                expiration=expiration,
+                ret_expiration=True)
+            ttl = expiration * PRESIGNED_URL_CACHE_FRACTION
+        else:
+            item = None
+            ttl = MISSING_PREVIEW_CACHE_TTL
+        preview_url_cache.set(key, item, ttl=ttl)
+    if item is None:
+        return None
+    return item if ret_expiration else item[0]
 
-    return toolkit.abort(404, toolkit._('No preview available'))
+
+def get_public_preview_urls(resource_id, organization_id):
+    """Return direct (unsigned) S3 URLs of the previews of a public resource
+
+    The preview objects of public datasets are publicly accessible,
+    so the view can link them directly instead of via :func:`dcpreview`
+    (no additional request to CKAN and stable, cacheable URLs). The
+    URLs are composed from the known object names without any S3
+    request. A variant might not be accessible (not created yet, a
+    preview created by an older version of this extension, or not
+    tagged public yet after the dataset was published, see
+    :func:`.jobs.job_make_artifacts_public`), so the view falls back
+    to :func:`dcpreview` if the image cannot be loaded.
+
+    Parameters
+    ----------
+    resource_id: str
+        resource ID
+    organization_id: str
+        ID of the organization (circle) of the dataset of the resource
+
+    Returns
+    -------
+    urls: dict
+        Maps the preview variants to their URLs
+    """
+    endpoint_url = get_ckan_config_option("dcor_object_store.endpoint_url")
+    bucket_name = get_bucket_name_for_organization(organization_id)
+    return {variant: f"{endpoint_url}/{bucket_name}/"
+                     f"{get_artifact_object_name(resource_id, variant)}"
+            for variant in PREVIEW_VARIANTS}
+
+
+def invalidate_preview_url_cache(resource_id):
+    """Remove all cached preview URLs of a resource"""
+    for private in [True, False]:
+        for variant in ARTIFACT_FILE_NAMES:
+            preview_url_cache.discard((resource_id, private, variant))
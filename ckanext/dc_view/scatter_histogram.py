@@ -0,0 +1,135 @@
+"""Multi-resolution 2D histogram of the scatter plot features
+
+The static preview image cannot be zoomed. For interactive exploration
+of the scatter plot (e.g. area_um vs. deform) without downloading the
+entire resource, all events of a dataset are binned into a 2D histogram
+which is stored as the "scatter_histogram" artifact on S3. The
+histogram is stored at several resolutions (a pyramid, the number of
+bins per axis is halved from level to level), so that a client can
+load a coarse overview first and zoom in on the finer levels. The
+event density (as shown in the KDE scatter plot of the preview) can be
+obtained by smoothing the counts.
+
+The artifact is a compressed numpy ``.npz`` file (kilobytes to a few
+hundred kilobytes, independent of the number of events)
+with the following arrays:
+
+- "x_feature", "y_feature", "x_label", "y_label": feature names and
+  axis labels
+- "x_range", "y_range": lower and upper edges of the histogram
+- "num_events": number of events within the range
+- "num_outside": number of valid events outside of the range
+- "counts_<bins>": event counts of shape (bins, bins) for every level
+  (the first axis corresponds to the x feature)
+"""
+import io
+
+import numpy as np
+
+from .preview_data import (
+    SCATTER_X, SCATTER_Y, get_feature_chunk_size, read_feature_slice
+)
+# Name and file name of the S3 artifact and number of bins per axis
+# of the finest and of the coarsest level
+from .preview_variants import (  # noqa: F401
+    SCATTER_HISTOGRAM_ARTIFACT as ARTIFACT,
+    SCATTER_HISTOGRAM_FILE_NAME as FILE_NAME,
+    SCATTER_HISTOGRAM_MAX_BINS as MAX_BINS,
+    SCATTER_HISTOGRAM_MIN_BINS as MIN_BINS,
+)
+
+#: Margin added to both sides of the range of the scatter plot of
+#: the preview image, relative to the width of that range
+RANGE_MARGIN = 0.5
+
+#: Approximate number of events read at once
+READ_SIZE = 100_000
+
+
+def compute_scatter_histogram(rtdc_ds, lims, xfeat=SCATTER_X,
+                              yfeat=SCATTER_Y, xlabel=None, ylabel=None,
+                              ret_nbytes=False):
+    """Bin all events of a dataset into a multi-resolution 2D histogram
+
+    The events are read in blocks of whole HDF5 chunks, so the memory
+    usage does not depend on the size of the dataset.
+
+    Parameters
+    ----------
+    rtdc_ds: dclab.rtdc_dataset.core.RTDCBase
+        Full DC dataset
+    lims: tuple
+        Axis limits (x_start, x_end, y_start, y_end) of the scatter
+        plot of the preview image (see
+        :func:`.preview_data.compute_scatter_statistics`); the range of
+        the histogram is widened by :const:`RANGE_MARGIN`
+    xfeat, yfeat: str
+        Features on the x and y axis
+    xlabel, ylabel: str
+        Axis labels (default to the feature names)
+    ret_nbytes: bool
+        Also return the number of bytes of feature data read
+
+    Returns
+    -------
+    histogram: dict
+        Arrays of the "scatter_histogram" artifact (see module
+        docstring)
+    nbytes: int, optional
+        Number of bytes of feature data read from `rtdc_ds`
+    """
+    x_start, x_end, y_start, y_end = lims
+    # (fixed margin if all events have the same value)
+    x_margin = (x_end - x_start) * RANGE_MARGIN or 0.5
+    y_margin = (y_end - y_start) * RANGE_MARGIN or 0.5
+    x_range = (x_start - x_margin, x_end + x_margin)
+    y_range = (y_start - y_margin, y_end + y_margin)
+
+    num_events = len(rtdc_ds)
+    chunk_size = get_feature_chunk_size(rtdc_ds, xfeat)
+    step = max(1, READ_SIZE // chunk_size) * chunk_size
+    counts = np.zeros((MAX_BINS, MAX_BINS), dtype=np.uint32)
+    buffer = np.empty((2, min(step, num_events)))
+    num_valid = 0
+    nbytes = 0
+    for start in range(0, num_events, step):
+        stop = min(start + step, num_events)
+        xy = buffer[:, :stop - start]
+        read_feature_slice(rtdc_ds, xfeat, slice(start, stop), out=xy[0])
+        read_feature_slice(rtdc_ds, yfeat, slice(start, stop), out=xy[1])
+        nbytes += xy.nbytes
+        xyv = xy[:, np.all(np.isfinite(xy), axis=0)]
+        num_valid += xyv.shape[1]
+        hist, _, _ = np.histogram2d(xyv[0], xyv[1],
+                                    bins=MAX_BINS,
+                                    range=(x_range, y_range))
+        counts += hist.astype(np.uint32)
+
+    num_in_range = int(counts.sum(dtype=np.uint64))
+    histogram = {
+        "x_feature": np.array(xfeat),
+        "y_feature": np.array(yfeat),
+        "x_label": np.array(xlabel or xfeat),
+        "y_label": np.array(ylabel or yfeat),
+        "x_range": np.array(x_range),
+        "y_range": np.array(y_range),
+        "num_events": np.array(num_in_range),
+        "num_outside": np.array(num_valid - num_in_range),
+    }
+    bins = MAX_BINS
+    while bins >= MIN_BINS:
+        histogram[f"counts_{bins}"] = counts
+        # sum 2x2 blocks of bins for the next coarser level
+        bins //= 2
+        counts = counts.reshape(bins, 2, bins, 2).sum(axis=(1, 3),
+                                                      dtype=np.uint32)
+    if ret_nbytes:
+        return histogram, nbytes
+    return histogram
+
+
+def encode_scatter_histogram(histogram):
+    """Return the histogram as a compressed .npz file (bytes)"""
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **histogram)
+    return buffer.getvalue()
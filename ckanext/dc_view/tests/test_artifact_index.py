@@ -0,0 +1,89 @@
+from unittest import mock
+import pathlib
+
+import pytest
+
+import ckan.tests.factories as factories
+
+from dcor_shared import s3cc
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+from ckanext.dc_view import jobs
+from ckanext.dc_view.artifact_index import (
+    ArtifactIndex, ArtifactVersionIndex, get_artifact_object_name,
+    get_artifact_version, get_bucket_name_for_organization,
+    set_artifact_version
+)
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_artifact_index_preview(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context,
+        owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    assert s3cc.artifact_exists(resource_id=rid, artifact="preview")
+
+    bucket_name = get_bucket_name_for_organization(owner_org["id"])
+    assert bucket_name == s3cc.get_s3_bucket_name_for_resource(rid)
+
+    index = ArtifactIndex(artifact="preview")
+    assert index.exists(rid, bucket_name)
+    assert not index.exists("a" * 36, bucket_name)
+    assert not ArtifactIndex(artifact="peter").exists(rid, bucket_name)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_artifact_version_index_preview(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context,
+        owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    bucket_name = get_bucket_name_for_organization(owner_org["id"])
+    object_name = get_artifact_object_name(rid, "preview")
+    assert (bucket_name, object_name) == \
+        s3cc.get_s3_bucket_object_for_artifact(rid, artifact="preview")
+
+    # the job records the preview version
+    version = jobs.get_current_preview_version()
+    assert get_artifact_version(bucket_name, object_name) == version
+    assert jobs.get_stored_preview_version(rid) == version
+    assert ArtifactVersionIndex("preview", version).exists(rid, bucket_name)
+    assert not ArtifactVersionIndex("preview", "old").exists(rid, bucket_name)
+
+    # up-to-date previews are not regenerated
+    assert not jobs.job_create_preview(res_dict)
+    # outdated previews are regenerated
+    set_artifact_version(bucket_name, object_name, "old")
+    assert get_artifact_version(bucket_name, object_name) == "old"
+    assert jobs.job_create_preview(res_dict)
+    assert get_artifact_version(bucket_name, object_name) == version
@@ -0,0 +1,56 @@
+from unittest import mock
+import pathlib
+
+import pytest
+import requests
+
+import ckan.tests.factories as factories
+
+from dcor_shared import s3, s3cc
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+from ckanext.dc_view.artifact_index import get_artifact_version
+from ckanext.dc_view.artifact_upload import upload_artifact_data
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_upload_artifact_data(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context,
+        owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True,
+        private=False)
+    rid = res_dict["id"]
+    s3_url = upload_artifact_data(resource_id=rid,
+                                  data=b"peter",
+                                  artifact="preview_webp",
+                                  version="test-1",
+                                  content_type="image/webp")
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=rid, artifact="preview_webp")
+    assert s3_url.endswith(f"/{bucket_name}/{object_name}")
+    assert get_artifact_version(bucket_name, object_name) == "test-1"
+    # the object of a public dataset is publicly accessible
+    response = requests.get(s3_url)
+    assert response.ok
+    assert response.content == b"peter"
+    assert response.headers["content-type"] == "image/webp"
+    s3_client, _, _ = s3.get_s3()
+    tags = s3_client.get_object_tagging(Bucket=bucket_name,
+                                        Key=object_name)["TagSet"]
+    assert {"Key": "public", "Value": "true"} in tags
@@ -0,0 +1,38 @@
+import time
+
+from ckanext.dc_view.cache import MISSING, TTLCache
+
+
+def test_cache_lru():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" is the least recently used entry
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_cache_none_value_and_discard():
+    cache = TTLCache()
+    cache.set("a", None)
+    assert "a" in cache
+    assert cache.get("a", default=MISSING) is None
+    cache.discard("a")
+    assert cache.get("a", default=MISSING) is MISSING
+    # discarding missing keys is fine
+    cache.discard("a")
+
+
+def test_cache_ttl():
+    cache = TTLCache()
+    cache.set("a", 1, ttl=0.05)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert cache.get("b") == 2
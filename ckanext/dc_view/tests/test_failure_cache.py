@@ -0,0 +1,60 @@
+import uuid
+
+import botocore.exceptions
+import pytest
+
+from ckanext.dc_view import failure_cache
+
+
+def test_backoff_delay():
+    assert failure_cache.get_backoff_delay(1) == failure_cache.BACKOFF_BASE
+    assert failure_cache.get_backoff_delay(2) == 2 * failure_cache.BACKOFF_BASE
+    assert failure_cache.get_backoff_delay(4) == 8 * failure_cache.BACKOFF_BASE
+    assert failure_cache.get_backoff_delay(100) == failure_cache.BACKOFF_MAX
+
+
+def test_is_backing_off():
+    record = {"version": "raster-3-first-5000", "retry_at": 1000}
+    assert failure_cache.is_backing_off(record, "raster-3-first-5000",
+                                        now=999)
+    assert not failure_cache.is_backing_off(record, "raster-3-first-5000",
+                                            now=1001)
+    # a new preview version is tried immediately
+    assert not failure_cache.is_backing_off(record, "raster-4-first-5000",
+                                            now=999)
+    assert not failure_cache.is_backing_off(None, "raster-3-first-5000")
+
+
+def test_is_transient_error():
+    assert failure_cache.is_transient_error(
+        botocore.exceptions.EndpointConnectionError(endpoint_url="peter"))
+    assert failure_cache.is_transient_error(ConnectionResetError())
+    # data errors (e.g. a corrupt HDF5 file)
+    assert not failure_cache.is_transient_error(OSError("corrupt file"))
+    assert not failure_cache.is_transient_error(ValueError("bad data"))
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+def test_record_failure():
+    rid = str(uuid.uuid4())
+    try:
+        record = failure_cache.record_failure(rid, OSError("broken file"),
+                                              version="raster-3-first-5000")
+        assert record["attempts"] == 1
+        assert record["error"] == "OSError"
+        assert failure_cache.get_failure(rid) == record
+        assert failure_cache.is_backing_off(record, "raster-3-first-5000")
+        record = failure_cache.record_failure(rid, KeyError("deform"),
+                                              version="raster-3-first-5000")
+        assert record["attempts"] == 2
+        assert record["retry_at"] - record["failed_at"] \
+            == 2 * failure_cache.BACKOFF_BASE
+        assert failure_cache.get_all_failures()[rid] == record
+        # the attempts are counted per preview version
+        record = failure_cache.record_failure(rid, KeyError("deform"),
+                                              version="raster-4-first-5000")
+        assert record["attempts"] == 1
+    finally:
+        failure_cache.clear_failure(rid)
+    assert failure_cache.get_failure(rid) is None
+    assert rid not in failure_cache.get_all_failures()
@@ -0,0 +1,45 @@
+"""The CKAN web processes must not import the rendering libraries"""
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize("module", ["ckanext.dc_view.jobs",
+                                    "ckanext.dc_view.meta",
+                                    ])
+def test_import_without_matplotlib(module):
+    code = (f"import sys; import {module}; "
+            f"assert 'matplotlib' not in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_matplotlib_imported_on_demand():
+    code = ("import sys; from ckanext.dc_view import jobs; "
+            "jobs.get_pyplot(); "
+            "assert 'matplotlib.pyplot' in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+@pytest.mark.parametrize("module", ["ckanext.dc_view.plugin",
+                                    "ckanext.dc_view.route_funcs",
+                                    "ckanext.dc_view.preview_variants",
+                                    ])
+def test_import_without_data_modules(module):
+    """The request handlers must not load the data reading code
+
+    dclab and h5py are already loaded by dcor_shared, so only modules
+    that are newly loaded by the import are checked.
+    """
+    data_modules = ["dclab", "h5py", "matplotlib",
+                    "ckanext.dc_view.preview_data",
+                    "ckanext.dc_view.raster",
+                    "ckanext.dc_view.scatter_histogram",
+                    ]
+    code = (f"import sys; import dcor_shared; "
+            f"before = set(sys.modules); import {module}; "
+            f"new = [m for m in set(sys.modules) - before "
+            f"       for p in {data_modules!r} "
+            f"       if m == p or m.startswith(p + '.')]; "
+            f"assert not new, new")
+    subprocess.run([sys.executable, "-c", code], check=True)
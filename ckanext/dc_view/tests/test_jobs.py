@@ -9,11 +9,14 @@ synchronously instead of asynchronously
 """
 from unittest import mock
 import pathlib
+import uuid
 
+import botocore.exceptions
 import pytest
 import requests
 
 import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
 
 import dcor_shared
 from dcor_shared import s3cc
@@ -21,6 +24,9 @@ from dcor_shared.testing import (
     make_dataset_via_s3, make_resource_via_s3, synchronous_enqueue_job
 )
 
+from ckanext.dc_view import failure_cache, jobs, meta, preview_cache
+from ckanext.dc_view.preview_variants import PREVIEW_VARIANTS
+
 data_path = pathlib.Path(__file__).parent / "data"
 
 
@@ -53,6 +59,22 @@ def test_create_preview_s3_job(enqueue_job_mock):
     # the preview is generated by the background job
     assert s3cc.artifact_exists(resource_id=rid,
                                 artifact="preview")
+    # all variants of the preview are uploaded
+    for artifact in PREVIEW_VARIANTS:
+        assert s3cc.artifact_exists(resource_id=rid,
+                                    artifact=artifact)
+    # the scatter histogram is created by a separate job
+    assert s3cc.artifact_exists(resource_id=rid,
+                                artifact="scatter_histogram")
+    res_dict = helpers.call_action("resource_show", id=rid)
+    with mock.patch("ckanext.dc_view.scatter_histogram."
+                    "compute_scatter_histogram",
+                    side_effect=ValueError("broken histogram")):
+        # the preview does not depend on the histogram
+        assert jobs.job_create_preview(res_dict, override=True)
+        with pytest.raises(ValueError, match="broken histogram"):
+            jobs.job_create_scatter_histogram(res_dict, override=True)
+    assert failure_cache.get_failure(rid) is None
 
 
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
@@ -85,3 +107,302 @@ def test_create_preview_s3_job_alternate(enqueue_job_mock):
     response = requests.get(prev_url)
     assert response.ok, "resource is public"
     assert response.status_code == 200
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_create_preview_s3_job_from_cache(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    path = data_path / "calibration_beads_47.rtdc"
+    ds_dict, res_dict_1 = make_dataset_via_s3(create_context,
+                                              owner_org,
+                                              resource_path=path,
+                                              activate=False)
+    rid_2 = make_resource_via_s3(resource_path=path,
+                                 organization_id=owner_org['id'],
+                                 dataset_id=ds_dict['id'],
+                                 resource_name="copy.rtdc")
+    sha256 = dcor_shared.sha256sum(path)
+    res_dict_1["sha256"] = sha256
+    res_dict_2 = helpers.call_action("resource_show", id=rid_2)
+    res_dict_2["sha256"] = sha256
+
+    # rendering the first resource populates the cache
+    assert jobs.job_create_preview(res_dict_1, override=True)
+    # the second resource is byte-identical and not rendered
+    with mock.patch.object(jobs, "render_preview_image") as render:
+        assert jobs.job_create_preview(res_dict_2, override=True)
+        render.assert_not_called()
+    for artifact in PREVIEW_VARIANTS:
+        assert s3cc.artifact_exists(resource_id=rid_2, artifact=artifact)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_preview_cache_cleanup(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    path = data_path / "calibration_beads_47.rtdc"
+    _, res_dict = make_dataset_via_s3(create_context,
+                                      owner_org,
+                                      resource_path=path,
+                                      activate=False)
+    rid = res_dict["id"]
+    sha256 = dcor_shared.sha256sum(path)
+    res_dict["sha256"] = sha256
+    assert jobs.job_create_preview(res_dict, override=True)
+    version = jobs.get_current_preview_version()
+
+    def cache_exists(version):
+        return dcor_shared.s3.object_exists(
+            bucket_name=preview_cache.get_cache_bucket_name(),
+            object_name=preview_cache.get_cache_object_name(
+                owner_org["id"], sha256, version, "preview"))
+
+    assert cache_exists(version)
+    # storing a new preview version removes the old one
+    preview_cache.store_preview_in_cache(resource_id=rid,
+                                         sha256=sha256,
+                                         version="raster-0-first-10")
+    assert cache_exists("raster-0-first-10")
+    assert not cache_exists(version)
+    # the cache is not in a circle bucket (not flagged as orphans)
+    assert preview_cache.get_cache_bucket_name() not in list(
+        dcor_shared.s3.iter_buckets())
+    # no other resource has the same checksum
+    assert preview_cache.release_preview_cache(
+        rid, sha256=sha256, organization_id=owner_org["id"]) > 0
+    assert not cache_exists("raster-0-first-10")
+    # deleting the resource enqueues the cleanup job
+    with mock.patch("ckan.plugins.toolkit.enqueue_job") as enqueue_mock:
+        assert preview_cache.enqueue_release_preview_cache(rid)
+    assert enqueue_mock.call_args.args[0] \
+        is preview_cache.release_preview_cache
+    assert enqueue_mock.call_args.args[1] == [rid, sha256, owner_org["id"]]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_create_metadata_html_s3_job(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context,
+        owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    # the metadata table is rendered by the background job
+    assert s3cc.artifact_exists(resource_id=rid,
+                                artifact="metadata_html")
+    res_dict = helpers.call_action("resource_show", id=rid)
+    metadata_hash = meta.get_metadata_hash(res_dict)
+    html_stored = meta.get_stored_metadata_html(
+        resource_id=rid,
+        organization_id=owner_org["id"],
+        metadata_hash=metadata_hash)
+    assert html_stored is not None, "metadata hash must match"
+    assert html_stored == meta.render_metadata_html_uncached(res_dict)
+    # a different hash means that the stored table is outdated
+    assert meta.get_stored_metadata_html(
+        resource_id=rid,
+        organization_id=owner_org["id"],
+        metadata_hash="peter") is None
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.ckan_config('ckanext.dc_view.preview_job_small_max_size', 1000)
+@pytest.mark.ckan_config('ckanext.dc_view.preview_job_large_min_events',
+                         10000)
+@pytest.mark.ckan_config('ckanext.dc_view.preview_job_large_queue',
+                         'dcor-huge')
+def test_preview_job_route():
+    # small file
+    assert jobs.get_preview_job_route(
+        {"id": "a", "size": 500, "dc:experiment:event count": 47}) \
+        == ("dcor-short", 600)
+    # unknown number of events
+    assert jobs.get_preview_job_route({"id": "a", "size": 500}) \
+        == ("dcor-short", 600)
+    # small file, but too many events
+    assert jobs.get_preview_job_route(
+        {"id": "a", "size": 500, "dc:experiment:event count": 5000}) \
+        == ("dcor-normal", 3600)
+    # large number of events
+    assert jobs.get_preview_job_route(
+        {"id": "a", "size": 500, "dc:experiment:event count": 20000}) \
+        == ("dcor-huge", 14400)
+    # unknown size and number of events (no S3 request)
+    with mock.patch.object(jobs.s3cc,
+                           "get_s3_attributes_for_artifact") as attrs_mock:
+        assert jobs.get_preview_job_route({"id": "a"}) \
+            == ("dcor-normal", 3600)
+    attrs_mock.assert_not_called()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_create_preview_failure_backoff(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False, 'user': user['name'],
+                      'api_version': 3}
+    dataset = make_dataset_via_s3(create_context,
+                                  owner_org,
+                                  activate=False)
+    rid = make_resource_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        organization_id=owner_org['id'],
+        dataset_id=dataset['id'],
+    )
+    res_dict = helpers.call_action("resource_show", id=rid)
+    # pretend that the resource cannot be opened
+    res_dict.pop("sha256", None)
+    with mock.patch("ckanext.dc_view.jobs.get_dc_instance",
+                    side_effect=OSError("corrupt file")) as open_mock, \
+            mock.patch("ckanext.dc_view.jobs.get_stored_preview_version",
+                       return_value=None), \
+            mock.patch("ckanext.dc_view.preview_cache."
+                       "copy_preview_from_cache", return_value=False):
+        try:
+            assert not jobs.job_create_preview(res_dict)
+            record = failure_cache.get_failure(rid)
+            assert record["error"] == "OSError"
+            assert record["attempts"] == 1
+            assert open_mock.call_count == 1
+            # the failed resource is not tried again
+            assert not jobs.job_create_preview(res_dict)
+            assert open_mock.call_count == 1
+            # unless the preview is regenerated explicitly
+            assert not jobs.job_create_preview(res_dict, override=True)
+            assert open_mock.call_count == 2
+            assert failure_cache.get_failure(rid)["attempts"] == 2
+        finally:
+            failure_cache.clear_failure(rid)
+
+    # transient errors are raised and not recorded
+    error = botocore.exceptions.EndpointConnectionError(
+        endpoint_url="http://127.0.0.1:9")
+    with mock.patch("ckanext.dc_view.jobs.get_dc_instance",
+                    side_effect=error), \
+            mock.patch("ckanext.dc_view.jobs.get_stored_preview_version",
+                       return_value=None), \
+            mock.patch("ckanext.dc_view.preview_cache."
+                       "copy_preview_from_cache", return_value=False):
+        with pytest.raises(botocore.exceptions.EndpointConnectionError):
+            jobs.job_create_preview(res_dict)
+        assert failure_cache.get_failure(rid) is None
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+def test_enqueue_job_coalesced():
+    from ckan.lib.jobs import _connect as ckan_redis_connect
+    from rq.job import Job
+    redis_connect = ckan_redis_connect()
+    job = [j for j in jobs.RQJob.get_all_job_methods_in_order("dc_view")
+           if j.name == "job_create_metadata_html"][0]
+    resource = {"id": str(uuid.uuid4()),
+                "name": "data.rtdc",
+                "package_id": str(uuid.uuid4()),
+                "position": 0,
+                }
+    jid = jobs.get_job_id(job.name, resource["id"])
+    try:
+        assert jobs.enqueue_job(job, resource, redis_connect)
+        # the pending job absorbs the second request
+        assert not jobs.enqueue_job(job, resource, redis_connect)
+        assert Job.fetch(jid, connection=redis_connect).get_status() \
+            == "queued"
+    finally:
+        Job.fetch(jid, connection=redis_connect).delete()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+def test_enqueue_batch_jobs_coalesced():
+    from ckan.lib.jobs import _connect as ckan_redis_connect
+    from rq.job import Job
+    redis_connect = ckan_redis_connect()
+    # large resources (long timeouts)
+    tasks = [({"id": str(uuid.uuid4()),
+               "size": 10 * 1024**3,
+               "dc:experiment:event count": 10_000_000}, [])
+             for _ in range(5)]
+    jid = jobs.get_batch_job_id([res_dict["id"] for res_dict, _ in tasks])
+    try:
+        assert jobs.enqueue_batch_jobs(tasks, redis_connect=redis_connect) \
+            == 1
+        # the pending batch job absorbs the second request
+        assert jobs.enqueue_batch_jobs(tasks[::-1],
+                                       redis_connect=redis_connect) == 0
+        job = Job.fetch(jid, connection=redis_connect)
+        assert job.get_status() == "queued"
+        # the timeout is limited
+        assert job.timeout == jobs.BATCH_MAX_TIMEOUT
+    finally:
+        Job.fetch(jid, connection=redis_connect).delete()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_run_batch_job(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    rids = []
+    for _ in range(2):
+        _, res_dict = make_dataset_via_s3(
+            create_context,
+            owner_org,
+            resource_path=data_path / "calibration_beads_47.rtdc",
+            activate=True)
+        rids.append(res_dict["id"])
+    missing = str(uuid.uuid4())
+
+    done = jobs.job_run_batch(
+        rids + [missing],
+        override=True,
+        skip_jobs={rids[1]: ["job_create_metadata_html"]})
+    assert done == {
+        rids[0]: ["job_create_preview", "job_create_metadata_html",
+                  "job_create_scatter_histogram"],
+        rids[1]: ["job_create_preview", "job_create_scatter_histogram"],
+        # errors are logged and do not abort the batch
+        missing: [],
+    }
@@ -0,0 +1,74 @@
+from unittest import mock
+
+import boto3
+import botocore.config
+
+from ckanext.dc_view import meta
+
+
+def get_res_dict():
+    return {
+        "id": "a0e2b8c3-4d1e-4d0a-9d8e-1b2c3d4e5f60",
+        "name": "data.rtdc",
+        "dc:experiment:sample": "calibration beads",
+        "dc:experiment:date": "2020-01-02",
+        "dc:setup:flow rate": 0.04,
+        "dc:setup:medium": "CellCarrierB",
+        "dc:setup:module composition": "AcCellerator,Fluorescence",
+    }
+
+
+def test_render_metadata_html():
+    html_code = meta.render_metadata_html(get_res_dict())
+    assert '<caption class="dc_view">Experiment</caption>' in html_code
+    assert '<caption class="dc_view">Setup</caption>' in html_code
+    assert "Imaging" not in html_code
+    assert "Sample name" in html_code
+    assert "calibration beads" in html_code
+    # units are appended to the value
+    assert "0.04 µL/s" in html_code
+    assert "AcCellerator, Fluorescence" in html_code
+    assert "Modules used" in html_code
+
+
+def test_render_metadata_html_cached():
+    meta.metadata_html_cache.clear()
+    res_dict = get_res_dict()
+    html_1 = meta.render_metadata_html(res_dict)
+    html_2 = meta.render_metadata_html(dict(res_dict))
+    assert html_1 is html_2
+    assert len(meta.metadata_html_cache) == 1
+    # changing the metadata results in a new cache entry
+    res_dict["dc:setup:flow rate"] = 0.08
+    html_3 = meta.render_metadata_html(res_dict)
+    assert "0.08 µL/s" in html_3
+    assert len(meta.metadata_html_cache) == 2
+
+
+def test_render_metadata_html_unknown_key():
+    res_dict = get_res_dict()
+    res_dict["dc:setup:peter"] = "pan"
+    html_code = meta.render_metadata_html(res_dict)
+    assert "peter" in html_code
+    assert "pan" in html_code
+    # the precomputed labels are not modified
+    assert "peter" not in meta.METADATA_LABELS["setup"]
+
+
+def test_stored_metadata_html_s3_unreachable():
+    # nothing listens on this port (EndpointConnectionError)
+    s3_client = boto3.client(
+        "s3",
+        endpoint_url="http://127.0.0.1:9",
+        region_name="us-east-1",
+        aws_access_key_id="peter",
+        aws_secret_access_key="pan",
+        config=botocore.config.Config(retries={"max_attempts": 0}))
+    with mock.patch.object(meta.s3, "get_s3",
+                           return_value=(s3_client, None, None)), \
+            mock.patch.object(meta, "get_bucket_name_for_organization",
+                              return_value="circle-peter"):
+        assert meta.get_stored_metadata_html(
+            resource_id=get_res_dict()["id"],
+            organization_id="peter",
+            metadata_hash=meta.get_metadata_hash(get_res_dict())) is None
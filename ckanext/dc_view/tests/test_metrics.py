@@ -0,0 +1,93 @@
+import json
+import logging
+import subprocess
+import sys
+
+import pytest
+
+from ckanext.dc_view.metrics import JobMetrics, MetricsRegistry, registry
+
+
+def test_job_metrics_stages():
+    metrics = JobMetrics("job_test", "rid")
+    with metrics.stage("read") as info:
+        info["bytes_read"] = 100
+    with pytest.raises(ValueError):
+        with metrics.stage("write") as info:
+            info["bytes_written"] = 50
+            raise ValueError("test")
+    data = metrics.to_dict()
+    assert data["status"] == "error"
+    assert [s["stage"] for s in data["stages"]] == ["read", "write"]
+    assert data["stages"][0]["bytes_read"] == 100
+    assert data["stages"][1]["bytes_written"] == 50
+    assert all(s["duration"] >= 0 for s in data["stages"])
+
+
+def test_job_metrics_publish(tmp_path, caplog):
+    registry.clear()
+    metrics = JobMetrics("job_test", "rid")
+    with metrics.stage("upload") as info:
+        info["bytes_written"] = 1024
+    with caplog.at_level(logging.INFO, logger="ckanext.dc_view.metrics"):
+        metrics.publish(path_dir=tmp_path)
+    # structured log record
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["job"] == "job_test"
+    assert record["stages"][0]["stage"] == "upload"
+    assert caplog.records[-1].dc_view_metrics["status"] == "ok"
+    # Prometheus textfile
+    text = (tmp_path / "dc_view.prom").read_text()
+    assert 'dc_view_job_runs_total{job="job_test",status="ok"} 1' in text
+    assert ('dc_view_job_stage_bytes_written_total{job="job_test",'
+            'stage="upload"} 1024') in text
+    registry.clear()
+
+
+def test_registry_histogram():
+    reg = MetricsRegistry()
+    for duration in [0.02, 0.3, 1000]:
+        metrics = JobMetrics("job_test", "rid")
+        metrics.stages.append({"stage": "render", "duration": duration,
+                               "bytes_read": 0, "bytes_written": 0})
+        reg.add(metrics)
+    text = reg.to_prometheus_text()
+    name = "dc_view_job_stage_duration_seconds"
+    labels = 'job="job_test",stage="render"'
+    assert f'{name}_bucket{{{labels},le="0.05"}} 1' in text
+    assert f'{name}_bucket{{{labels},le="0.5"}} 2' in text
+    assert f'{name}_bucket{{{labels},le="300"}} 2' in text
+    assert f'{name}_bucket{{{labels},le="+Inf"}} 3' in text
+    assert f'{name}_count{{{labels}}} 3' in text
+
+
+def test_prometheus_textfile_multiple_processes(tmp_path):
+    # RQ forks a new process for every job; all of them must add their
+    # metrics to the same textfile
+    code = ("from ckanext.dc_view.metrics import JobMetrics\n"
+            "for ii in range(20):\n"
+            "    metrics = JobMetrics('job_test', 'rid')\n"
+            "    with metrics.stage('upload') as info:\n"
+            "        info['bytes_written'] = 10\n"
+            f"    metrics.publish(path_dir={str(tmp_path)!r})\n")
+    procs = [subprocess.Popen([sys.executable, "-c", code])
+             for _ in range(2)]
+    assert [proc.wait() for proc in procs] == [0, 0]
+    assert [p.name for p in tmp_path.glob("*.prom")] == ["dc_view.prom"]
+    text = (tmp_path / "dc_view.prom").read_text()
+    assert 'dc_view_job_runs_total{job="job_test",status="ok"} 40' in text
+    assert ('dc_view_job_stage_bytes_written_total{job="job_test",'
+            'stage="upload"} 400') in text
+    assert ('dc_view_job_stage_duration_seconds_count{job="job_test",'
+            'stage="upload"} 40') in text
+
+
+def test_registry_state():
+    reg = MetricsRegistry()
+    metrics = JobMetrics("job_test", "rid")
+    with metrics.stage("render") as info:
+        info["bytes_read"] = 5
+    reg.add(metrics)
+    reg2 = MetricsRegistry()
+    reg2.set_state(json.loads(json.dumps(reg.get_state())))
+    assert reg2.to_prometheus_text() == reg.to_prometheus_text()
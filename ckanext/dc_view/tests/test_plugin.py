@@ -1,4 +1,7 @@
 """Tests for plugin.py."""
+import subprocess
+import sys
+
 import ckanext.dc_view.plugin as plugin  # noqa: F401
 
 
@@ -6,3 +9,11 @@ def test_plugin_info():
     p = plugin.DCViewPlugin()
     info = p.info()
     assert info["name"] == "dc_view"
+
+
+def test_plugin_import_without_matplotlib():
+    # The plugin is loaded by the web server, which never renders
+    code = ("import sys; import ckanext.dc_view.plugin; "
+            "assert 'matplotlib' not in sys.modules; "
+            "assert 'ckanext.dc_view.jobs' not in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True)
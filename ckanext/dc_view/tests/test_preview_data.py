@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+import pathlib
+
+import dclab
+from dclab import kde_methods
+import numpy as np
+
+from ckanext.dc_view.preview_data import (
+    compute_scatter_statistics, get_chunk_sample_slices, get_preview_data
+)
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+def test_preview_data_bounded_read():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        data = get_preview_data(ds, size=20, event_index=47)
+        assert np.allclose(data["scatter"]["x"], ds["area_um"][:20])
+        assert np.allclose(data["scatter"]["y"], ds["deform"][:20])
+        assert data["scatter"]["density"].shape == (20,)
+        # the last event of the first 20 events is shown
+        assert np.all(data["image"] == ds["image"][19])
+        assert np.all(data["mask"] == ds["mask"][19])
+        assert np.all(data["contour"] == ds["contour"][19])
+        assert list(data["trace"].keys()) == ["fl1_raw", "fl2_raw", "fl3_raw"]
+        assert data["fltime"].size == data["trace"]["fl1_raw"].size
+
+
+def test_preview_data_threads():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        data = get_preview_data(ds, size=20)
+        with ThreadPoolExecutor(4) as executor:
+            data_threads = get_preview_data(ds, size=20, executor=executor)
+    assert list(data_threads) == list(data)
+    assert np.all(data_threads["scatter"]["density"]
+                  == data["scatter"]["density"])
+    assert np.all(data_threads["image"] == data["image"])
+    assert np.all(data_threads["mask"] == data["mask"])
+    for key in data["trace"]:
+        assert np.all(data_threads["trace"][key] == data["trace"][key])
+
+
+def test_preview_data_does_not_load_full_feature():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        get_preview_data(ds, size=20)
+        # dclab caches the full array when a scalar feature is indexed
+        assert ds["area_um"]._array is None
+        assert ds["deform"]._array is None
+
+
+def test_chunk_sample_slices():
+    slices = get_chunk_sample_slices(num_events=100_000,
+                                     size=5000,
+                                     chunk_size=1000,
+                                     seed=42)
+    assert len(slices) == 5
+    assert sum(sl.stop - sl.start for sl in slices) == 5000
+    for ii, sl in enumerate(slices):
+        # whole chunks, one in each fifth of the dataset
+        assert sl.start % 1000 == 0
+        assert sl.stop - sl.start == 1000
+        assert ii * 20_000 <= sl.start < (ii + 1) * 20_000
+    # deterministic
+    assert slices == get_chunk_sample_slices(num_events=100_000,
+                                             size=5000,
+                                             chunk_size=1000,
+                                             seed=42)
+    # small datasets are read entirely
+    assert get_chunk_sample_slices(num_events=3000,
+                                   size=5000,
+                                   chunk_size=1000) == [slice(0, 3000)]
+
+
+def test_preview_data_sampling_chunks():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        chunk_size = ds["area_um"].h5ds.chunks[0]
+        slices = get_chunk_sample_slices(num_events=len(ds),
+                                         size=10,
+                                         chunk_size=chunk_size)
+        data = get_preview_data(ds, size=10, sampling="chunks")
+        index = np.concatenate([np.arange(sl.start, sl.stop)
+                                for sl in slices])
+        assert np.allclose(data["scatter"]["x"], ds["area_um"][index])
+
+
+def test_scatter_statistics():
+    rng = np.random.default_rng(42)
+    xy = np.stack([rng.lognormal(3, .3, 5000), rng.normal(.05, .01, 5000)])
+    xy[0, 10] = np.nan
+    xy[1, 20] = np.inf
+    lims, density = compute_scatter_statistics(xy)
+    valid = np.all(np.isfinite(xy), axis=0)
+    assert np.allclose(lims, [np.percentile(xy[0, valid], 1),
+                              np.percentile(xy[0, valid], 99),
+                              np.percentile(xy[1, valid], 1),
+                              np.percentile(xy[1, valid], 99)])
+    assert np.isnan(density[10]) and np.isnan(density[20])
+    # similar to the density estimate of dclab
+    reference = kde_methods.kde_histogram(events_x=xy[0, valid],
+                                          events_y=xy[1, valid])
+    assert np.corrcoef(reference, density[valid])[0, 1] > 0.99
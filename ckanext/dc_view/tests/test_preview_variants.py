@@ -0,0 +1,38 @@
+import io
+
+from PIL import Image
+
+from ckanext.dc_view.preview_variants import (
+    PREVIEW_VARIANTS, THUMBNAIL_WIDTH, encode_preview_variants,
+    save_preview_variants
+)
+
+
+def test_save_preview_variants(tmp_path):
+    img = Image.new("RGB", (320, 960), color=(200, 100, 50))
+    paths = save_preview_variants(img, tmp_path)
+    assert list(paths.keys()) == list(PREVIEW_VARIANTS.keys())
+    # the full-size JPEG (known from older versions) is uploaded last
+    assert list(paths.keys())[-1] == "preview"
+    for artifact, (name, width, fmt) in PREVIEW_VARIANTS.items():
+        assert paths[artifact].name == name
+        with Image.open(paths[artifact]) as vimg:
+            assert vimg.format == fmt
+            if width is None:
+                assert vimg.size == (320, 960)
+            else:
+                assert vimg.size == (THUMBNAIL_WIDTH, 480)
+    with Image.open(paths["preview"]) as vimg:
+        assert vimg.info.get("progressive")
+    # WebP is smaller than JPEG
+    assert (paths["preview_webp"].stat().st_size
+            < paths["preview"].stat().st_size)
+
+
+def test_encode_preview_variants():
+    img = Image.new("RGB", (320, 960), color=(200, 100, 50))
+    data = encode_preview_variants(img)
+    assert list(data.keys()) == list(PREVIEW_VARIANTS.keys())
+    for artifact, (_, _, fmt) in PREVIEW_VARIANTS.items():
+        with Image.open(io.BytesIO(data[artifact])) as vimg:
+            assert vimg.format == fmt
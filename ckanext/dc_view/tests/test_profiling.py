@@ -0,0 +1,35 @@
+import pstats
+import tracemalloc
+
+from ckanext.dc_view import profiling
+
+
+def busy_function(resource, override=False):
+    """Test job"""
+    return sum(ii**2 for ii in range(10000))
+
+
+def test_profile_writes_stats_and_snapshot(tmp_path):
+    with profiling.profile("test", path_dir=tmp_path, trace_memory=True):
+        busy_function({})
+        # nested profiles are ignored
+        with profiling.profile("nested", path_dir=tmp_path):
+            pass
+    path_prof = list(tmp_path.glob("test_*.prof"))[0]
+    stats = pstats.Stats(str(path_prof))
+    assert any(func[2] == "busy_function" for func in stats.stats)
+    path_snap = list(tmp_path.glob("test_*.tracemalloc"))[0]
+    assert tracemalloc.Snapshot.load(str(path_snap))
+    assert not list(tmp_path.glob("nested_*"))
+    assert not tracemalloc.is_tracing()
+
+
+def test_profiled_job(tmp_path, monkeypatch):
+    monkeypatch.setenv("CKANEXT_DC_VIEW_PROFILE_DIR", str(tmp_path))
+    monkeypatch.setenv("CKANEXT_DC_VIEW_PROFILE_TRACEMALLOC", "false")
+    job = profiling.profiled(busy_function)
+    assert job.__name__ == "busy_function"
+    assert job.__doc__ == "Test job"
+    assert job({"id": "abc"}, override=True) == busy_function({})
+    assert len(list(tmp_path.glob("busy_function_abc_*.prof"))) == 1
+    assert not list(tmp_path.glob("*.tracemalloc"))
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+import pathlib
+
+import dclab
+import numpy as np
+from PIL import Image
+
+from ckanext.dc_view import jobs, raster
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+def test_raster_same_size_as_matplotlib(tmp_path):
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        jobs.render_preview(ds, tmp_path / "mpl.jpg", renderer="matplotlib")
+    with dclab.new_dataset(path) as ds:
+        jobs.render_preview(ds, tmp_path / "raster.jpg", renderer="raster")
+    with Image.open(tmp_path / "mpl.jpg") as img_mpl, \
+            Image.open(tmp_path / "raster.jpg") as img_raster:
+        assert img_raster.format == "JPEG"
+        assert img_raster.size == img_mpl.size
+
+
+def test_raster_scatter_only():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        ds_child = dclab.new_dataset(ds)
+        # only keep the scalar features
+        ds_scalar = dclab.new_dataset(
+            {"area_um": ds_child["area_um"], "deform": ds_child["deform"]})
+        img = raster.overview_raster(ds_scalar)
+    assert img.size == (raster.WIDTH, 4 * raster.UNIT_HEIGHT)
+    # the scatter plots are not empty
+    assert img.convert("L").getextrema()[0] < 100
+
+
+def test_raster_threads():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        img = raster.overview_raster(ds)
+        with ThreadPoolExecutor(4) as executor:
+            img_threads = raster.overview_raster(ds, executor=executor)
+    # concurrently drawn panels result in the same image
+    assert img_threads.tobytes() == img.tobytes()
+
+
+def test_raster_event_image_contrast():
+    img = Image.new("RGB", (raster.WIDTH, raster.UNIT_HEIGHT), "white")
+    # low-contrast image as recorded by the camera
+    image = np.linspace(100, 110, 80 * 250).reshape(80, 250)
+    raster.draw_event_image(img, (0, 0, raster.WIDTH, raster.UNIT_HEIGHT),
+                            image.astype(np.uint8))
+    extrema = img.convert("L").getextrema()
+    assert extrema == (0, 255)
+    # a constant image is black, as with `imshow`
+    assert np.all(raster.normalize_image(np.full((3, 4), 7)) == 0)
+
+
+def test_raster_colorbar_ticks():
+    img_kde = Image.new("RGB", (raster.WIDTH, 2 * raster.UNIT_HEIGHT),
+                        "white")
+    x = np.linspace(0, 1, 100)
+    raster.draw_scatter_kde(img_kde,
+                            (0, 0, raster.WIDTH, 2 * raster.UNIT_HEIGHT),
+                            x, x, density=x, lims=(0, 1, 0, 1),
+                            xlabel="x", ylabel="y")
+    arr = np.asarray(img_kde.convert("L"))
+    # one tick mark right of the colorbar for each tick label
+    cb_right = raster.WIDTH - raster.COLORBAR_SPACE - raster.MARGINS[2] + 14
+    ticks = np.sum(arr[:, cb_right + 2] < 128)
+    assert ticks == len(raster.nice_ticks(0, 1))
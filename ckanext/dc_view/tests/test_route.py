@@ -1,16 +1,20 @@
 import pathlib
+import uuid
 from unittest import mock
 
 import ckan.common
 import ckan.model
 import ckan.tests.factories as factories
+import ckan.tests.helpers
 import dcor_shared
+from dcor_shared import s3cc
 from dcor_shared.testing import (  # noqa: F401
     make_dataset_via_s3, synchronous_enqueue_job,
     create_with_upload_no_temp
 )
 
 import pytest
+import requests
 
 
 data_path = pathlib.Path(__file__).parent / "data"
@@ -103,3 +107,227 @@ def test_route_s3_redirect_preview_to_s3_public(enqueue_job_mock, app):
     assert redirect.status_code == 302
     assert redirect.location.startswith(f"{endpoint}/{bucket_name}/preview/"
                                         f"{rid[:3]}/{rid[3:6]}/{rid[6:]}")
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_route_s3_redirect_preview_variants(enqueue_job_mock, app):
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    did = ds_dict["id"]
+    bucket_name = dcor_shared.get_ckan_config_option(
+        "dcor_object_store.bucket_name").format(
+        organization_id=ds_dict["organization"]["id"])
+    for name, artifact in [("preview.webp", "preview_webp"),
+                           ("preview_thumb.jpg", "preview_thumb"),
+                           ("preview_thumb.webp", "preview_thumb_webp"),
+                           ]:
+        resp = app.get(f"/dataset/{did}/resource/{rid}/{name}",
+                       follow_redirects=False)
+        assert resp.status_code == 302
+        assert f"/{bucket_name}/{artifact}/{rid[:3]}/" in resp.location
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_route_preview_url_cached(enqueue_job_mock, app):
+    from ckanext.dc_view import route_funcs
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    did = ds_dict["id"]
+    route_funcs.preview_url_cache.clear()
+
+    with mock.patch.object(route_funcs.s3cc, "artifact_exists",
+                           wraps=route_funcs.s3cc.artifact_exists) as ae:
+        resp1 = app.get(f"/dataset/{did}/resource/{rid}/preview.jpg",
+                        follow_redirects=False)
+        assert resp1.status_code == 302
+        assert ae.call_count == 1
+        # second request is served from the cache
+        resp2 = app.get(f"/dataset/{did}/resource/{rid}/preview.jpg",
+                        follow_redirects=False)
+        assert resp2.status_code == 302
+        assert resp2.location == resp1.location
+        assert ae.call_count == 1
+        # invalidation (e.g. after a resource update) forces a new lookup
+        route_funcs.invalidate_preview_url_cache(rid)
+        app.get(f"/dataset/{did}/resource/{rid}/preview.jpg",
+                follow_redirects=False)
+        assert ae.call_count == 2
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_route_preview_not_found(enqueue_job_mock, app):
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    did = ds_dict["id"]
+    rid_invalid = str(uuid.uuid4())
+    did_invalid = str(uuid.uuid4())
+    # resource does not exist
+    app.get(f"/dataset/{did}/resource/{rid_invalid}/preview.jpg",
+            status=404,
+            follow_redirects=False)
+    # dataset does not exist
+    app.get(f"/dataset/{did_invalid}/resource/{rid}/preview.jpg",
+            status=404,
+            follow_redirects=False)
+    # resource does not belong to the dataset
+    ds_dict_other, _ = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    app.get(f"/dataset/{ds_dict_other['id']}/resource/{rid}/preview.jpg",
+            status=404,
+            follow_redirects=False)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_route_preview_conditional_request(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True,
+        private=True)
+    url = f"/dataset/{ds_dict['id']}/resource/{res_dict['id']}/preview.jpg"
+    resp1 = app.get(url,
+                    headers={"Authorization": user["token"]},
+                    follow_redirects=False)
+    assert resp1.status_code == 302
+    assert resp1.headers["Cache-Control"].startswith("private, max-age=")
+    etag = resp1.headers["ETag"]
+    # the browser revalidates its cached redirect
+    resp2 = app.get(url,
+                    headers={"Authorization": user["token"],
+                             "If-None-Match": etag},
+                    follow_redirects=False)
+    assert resp2.status_code == 304
+    assert resp2.headers["ETag"] == etag
+    # authorization is still checked for conditional requests
+    app.get(url,
+            headers={"If-None-Match": etag},
+            status=404,
+            follow_redirects=False)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_template_public_preview_urls(enqueue_job_mock):
+    from ckanext.dc_view.plugin import DCViewPlugin
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    res_dict = ckan.tests.helpers.call_action("resource_show", id=rid)
+    ds_dict = ckan.tests.helpers.call_action("package_show",
+                                             id=ds_dict["id"])
+    variables = DCViewPlugin().setup_template_variables(
+        context={}, data_dict={"package": ds_dict, "resource": res_dict})
+    endpoint = dcor_shared.get_ckan_config_option(
+        "dcor_object_store.endpoint_url")
+    # previews of public datasets are served directly from S3
+    assert variables["preview_url"].startswith(endpoint)
+    assert variables["preview_url"].endswith(f"{rid[:3]}/{rid[3:6]}/{rid[6:]}")
+    for url in variables["preview_srcset_webp"].split(", "):
+        assert url.startswith(f"{endpoint}/")
+        assert "preview" in url and "webp" in url
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_template_public_preview_urls_after_publishing(enqueue_job_mock):
+    from ckanext.dc_view.jobs import DC_VIEW_ARTIFACTS
+    from ckanext.dc_view.plugin import DCViewPlugin
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context,
+        owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True,
+        private=True)
+    rid = res_dict["id"]
+    # editing a private dataset (without `private` in the patch) does
+    # not make its artifacts public
+    ckan.tests.helpers.call_action("package_patch",
+                                   id=ds_dict["id"],
+                                   title="Private dataset")
+    # the artifacts of private datasets are not accessible anonymously
+    for artifact in DC_VIEW_ARTIFACTS:
+        assert s3cc.artifact_exists(resource_id=rid, artifact=artifact)
+        url = s3cc.get_s3_url_for_artifact(resource_id=rid, artifact=artifact)
+        assert not requests.get(url).ok, artifact
+
+    # publish the dataset
+    ckan.tests.helpers.call_action("package_patch",
+                                   id=ds_dict["id"],
+                                   private=False)
+    for artifact in DC_VIEW_ARTIFACTS:
+        url = s3cc.get_s3_url_for_artifact(resource_id=rid, artifact=artifact)
+        assert requests.get(url).ok, artifact
+
+    # all preview variants are linked directly and accessible anonymously
+    res_dict = ckan.tests.helpers.call_action("resource_show", id=rid)
+    ds_dict = ckan.tests.helpers.call_action("package_show",
+                                             id=ds_dict["id"])
+    assert not ds_dict["private"]
+    variables = DCViewPlugin().setup_template_variables(
+        context={}, data_dict={"package": ds_dict, "resource": res_dict})
+    endpoint = dcor_shared.get_ckan_config_option(
+        "dcor_object_store.endpoint_url")
+    urls = [variables["preview_url"]]
+    for key in ["preview_srcset_jpeg", "preview_srcset_webp"]:
+        urls += [item.split()[0] for item in variables[key].split(", ")]
+    assert len(urls) == 5
+    for url in urls:
+        assert url.startswith(f"{endpoint}/")
+        assert requests.get(url).ok, url
+    # fallback to the route if an image cannot be loaded from S3
+    assert variables["preview_route_url"] == (
+        f"/dataset/{ds_dict['id']}/resource/{rid}/preview.jpg")
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_make_artifacts_public_only_when_published(enqueue_job_mock):
+    from ckanext.dc_view.jobs import job_make_artifacts_public
+    ds_dict, _ = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    enqueue_job_mock.reset_mock()
+    # editing a public dataset does not tag its artifacts again
+    ckan.tests.helpers.call_action("package_patch",
+                                   id=ds_dict["id"],
+                                   title="Public dataset")
+    assert job_make_artifacts_public not in [
+        call.args[0] for call in enqueue_job_mock.call_args_list]
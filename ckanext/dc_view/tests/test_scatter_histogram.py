@@ -0,0 +1,55 @@
+import io
+import pathlib
+
+import dclab
+import numpy as np
+
+from ckanext.dc_view.preview_data import get_preview_data
+from ckanext.dc_view.scatter_histogram import (
+    MAX_BINS, MIN_BINS, compute_scatter_histogram, encode_scatter_histogram
+)
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+def test_scatter_histogram_levels():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        data = get_preview_data(ds)
+        hist, nbytes = compute_scatter_histogram(
+            ds, lims=data["scatter"]["lims"], ret_nbytes=True)
+        # both features of all events are read once
+        assert nbytes == 2 * 8 * len(ds)
+        assert str(hist["x_feature"]) == "area_um"
+        assert str(hist["y_feature"]) == "deform"
+        # the range of the preview is extended
+        assert hist["x_range"][0] < data["scatter"]["lims"][0]
+        assert hist["x_range"][1] > data["scatter"]["lims"][1]
+        assert hist["num_events"] + hist["num_outside"] == len(ds)
+        bins = MAX_BINS
+        while bins >= MIN_BINS:
+            counts = hist[f"counts_{bins}"]
+            assert counts.shape == (bins, bins)
+            # all levels contain the same events
+            assert counts.sum() == hist["num_events"]
+            bins //= 2
+        assert f"counts_{bins}" not in hist
+        # the finest level matches numpy
+        ref, _, _ = np.histogram2d(ds["area_um"], ds["deform"],
+                                   bins=MAX_BINS,
+                                   range=(hist["x_range"], hist["y_range"]))
+        assert np.all(hist[f"counts_{MAX_BINS}"] == ref)
+
+
+def test_scatter_histogram_encode():
+    path = data_path / "calibration_beads_47.rtdc"
+    with dclab.new_dataset(path) as ds:
+        hist = compute_scatter_histogram(ds, lims=(0, 100, 0, 0.1),
+                                         xlabel="Area [µm²]")
+    loaded = np.load(io.BytesIO(encode_scatter_histogram(hist)))
+    assert sorted(loaded.files) == sorted(hist)
+    assert str(loaded["x_label"]) == "Area [µm²]"
+    assert str(loaded["y_label"]) == "deform"
+    for key in hist:
+        assert np.all(loaded[key] == hist[key])